@@ -0,0 +1,112 @@
+# Typed number and date columns for the Glue jobs reading extracted files written before the extraction typed them
+# (pass this file to the jobs with --extra-py-files).
+#
+# The extraction writes the numbers and dates as float64, int32 and date32 (serverless/typed_columns.py), the files of
+# the years before are still strings. Read together, a column is a choice of the two types in the dynamic frame, and
+# the mappings of the jobs (double, int, date) left the strings unparsed. cast_frame resolves these choices to
+# strings and parses every string column of TYPED_COLS with Spark SQL expressions that follow
+# typed_columns.parse_numbers and parse_dates: spaces and commas as thousands separators, a decimal comma, "12,000"
+# and "1.234,50" left null as ambiguous, YYYYMMDD or YYYY-MM-DD dates. The unparsable values are null and named in
+# PARSE_ERRORS, like in the files the extraction writes now; a column that is typed in every file is kept as it is.
+
+from pyspark.sql import functions as F
+from pyspark.sql.types import ArrayType, StringType
+
+FLOAT64 = 'float64'
+INT32 = 'int32'
+DATE32 = 'date32'
+ERROR_COLUMN = 'PARSE_ERRORS'
+# serverless/typed_columns.TYPED_COLS
+TYPED_COLS = {
+    'DATE': DATE32, 'DS_DATE_DISPATCH': DATE32, 'COMPLEMENTARY_INFO__DATE_DISPATCH_NOTICE': DATE32,
+    'PROCEDURE__DATE_RECEIPT_TENDERS': DATE32, 'PROCEDURE__OPENING_CONDITION__DATE_OPENING_TENDERS': DATE32,
+    'AWARD_CONTRACT__AWARDED_CONTRACT__DATE_CONCLUSION_CONTRACT': DATE32,
+    'VALUES__VALUE': FLOAT64, 'VALUE_EUR': FLOAT64, 'OBJECT_CONTRACT__VAL_TOTAL': FLOAT64,
+    'AWARD_CONTRACT__AWARDED_CONTRACT__VALUES__VAL_TOTAL': FLOAT64,
+    'AWARD_CONTRACT__AWARDED_CONTRACT__TENDERS__NB_TENDERS_RECEIVED': INT32,
+    'PROCEDURE__DURATION_TENDER_VALID': INT32,
+    'OBJECT_CONTRACT__OBJECT_DESCR__DURATION': INT32, 'MAIN_OBJECT_CONTRACT__OBJECT_DESCR__DURATION': INT32,
+}
+INT32_MAX = 2147483647
+
+
+def _number(text):
+    # SQL expression of the double parsed from the string expression text, null if it can't be parsed
+    cleaned = r"regexp_replace(%s, '\\s', '')" % text
+    return ("CASE WHEN {c} RLIKE '^[+-]?[0-9]+,[0-9]{{3}}$' OR ({c} LIKE '%.%' AND {c} RLIKE ',[^.]*$') THEN NULL"
+            " WHEN {c} LIKE '%,%' AND {c} NOT LIKE '%.%' THEN CAST(replace({c}, ',', '.') AS DOUBLE)"
+            " ELSE CAST(replace({c}, ',', '') AS DOUBLE) END").format(c=cleaned)
+
+
+def parse_expression(text, kind):
+    """
+    :param text: SQL expression of a string, e.g. a quoted column name
+    :param kind: FLOAT64, INT32 or DATE32
+    :return: SQL expression of the parsed value, null for missing and unparsable values
+    """
+    if kind == DATE32:
+        return "to_date(substring(replace(trim(%s), '-', ''), 1, 8), 'yyyyMMdd')" % text
+    if kind == INT32:
+        number = _number(text)
+        return ("CASE WHEN ({n}) = round({n}) AND abs({n}) <= {max} THEN CAST({n} AS INT) END"
+                .format(n=number, max=INT32_MAX))
+    return _number(text)
+
+
+def error_expression(text, kind):
+    """
+    :return: SQL expression, true when the string expression text is present but can't be parsed
+    """
+    return "(%s IS NOT NULL AND trim(%s) != '' AND (%s) IS NULL)" % (text, text, parse_expression(text, kind))
+
+
+def cast_columns(df):
+    """
+    Parses the string and array<string> columns of TYPED_COLS (in any case) and adds their errors to PARSE_ERRORS.
+    :param df: DataFrame of extracted files
+    :return: DataFrame with these columns typed
+    """
+    columns = []
+    errors = []
+    for field in df.schema.fields:
+        kind = TYPED_COLS.get(field.name.upper())
+        quoted = '`%s`' % field.name
+        if kind is not None and field.dataType == StringType():
+            columns.append(F.expr(parse_expression(quoted, kind)).alias(field.name))
+            errors.append("CASE WHEN %s THEN '%s' END" % (error_expression(quoted, kind), field.name.upper()))
+        elif (kind is not None and isinstance(field.dataType, ArrayType)
+              and field.dataType.elementType == StringType()):
+            columns.append(F.expr('transform(%s, x -> %s)' % (quoted, parse_expression('x', kind))).alias(field.name))
+            errors.append("CASE WHEN exists(%s, x -> %s) THEN '%s' END"
+                          % (quoted, error_expression('x', kind), field.name.upper()))
+        else:
+            columns.append(F.col(quoted))
+    if not errors:
+        return df
+    names = dict((name.upper(), name) for name in df.columns)
+    error_column = names.get(ERROR_COLUMN, ERROR_COLUMN)
+    previous = ("coalesce(`%s`, CAST(array() AS array<string>))" % error_column
+                if ERROR_COLUMN in names else "CAST(array() AS array<string>)")
+    new_errors = F.expr("concat(%s, filter(array(%s), n -> n IS NOT NULL))" % (previous, ', '.join(errors)))
+    columns = [column for column, name in zip(columns, df.columns) if name != error_column]
+    return df.select(*columns).withColumn(error_column, new_errors)
+
+
+def cast_frame(frame):
+    """
+    :param frame: DynamicFrame of extracted files, typed and untyped
+    :return: DataFrame with the columns of TYPED_COLS typed, see cast_columns
+    """
+    specs = []
+    for field in frame.schema().fields:
+        if field.name.upper() not in TYPED_COLS:
+            continue
+        data_type = field.dataType
+        # a column typed in some files and a string in the others
+        if data_type.typeName() == 'choice':
+            specs.append((field.name, 'cast:string'))
+        elif data_type.typeName() == 'array' and data_type.elementType.typeName() == 'choice':
+            specs.append((field.name + '[]', 'cast:string'))
+    if specs:
+        frame = frame.resolveChoice(specs=specs)
+    return cast_columns(frame.toDF())
@@ -2,99 +2,363 @@ from awsglue.context import GlueContext
 from awsglue.transforms import *
 from awsglue.utils import getResolvedOptions
 import boto3
+from datetime import datetime
+import itertools
+import logging
+import numpy as np
+import os
+import scipy.sparse as sp
+import sqlite3
+import sys
+import tempfile
 from pyspark.context import SparkContext
 from pyspark.ml.feature import StringIndexer, IndexToString
 from pyspark.ml.recommendation import ALS
-from pyspark.sql.functions import explode, lit, col
+from pyspark.sql import functions as F
+from pyspark.sql.functions import broadcast, crc32, explode, lit, col, pmod
+
+# passed to the job with --extra-py-files (scripts/implicit_als.py for the warm start, serverless/ann_index.py for the
+# similarity indexes of the API, serverless/s3_listing.py for the listing, serverless/cpv_hierarchy.py and
+# serverless/columnar.py for the CPV levels)
+import ann_index
+import cpv_hierarchy
+import implicit_als
+import s3_listing
+
+# optional --CPV_LEVEL (division, group, class or category): the services are the ancestors of the CPV codes at that
+# level (serverless/cpv_hierarchy.py) instead of the ~9,450 leaf CPV texts, for a denser service x contractor matrix;
+# the codes are those of serverless/cpv_codes.npz, passed to the job with --extra-files
+cpv_level = getResolvedOptions(sys.argv, ['CPV_LEVEL'])['CPV_LEVEL'] if '--CPV_LEVEL' in sys.argv else None
+if cpv_level is not None:
+    cpv_level = cpv_hierarchy.level_number(cpv_level)
+service_field = 'original_cpv_code' if cpv_level else 'original_cpv_text'
+
+# extracted bucket, the recommendations and the lookup files of the API are written there
+bucket = getResolvedOptions(sys.argv, ['BUCKET'])['BUCKET']
+
+# optional --WARM_START true (the daily trigger in terraform/glue): update the state of the last run with the extracted
+# files it hasn't counted yet instead of retraining on all of them, see implicit_als.warm_start; without a state the
+# job trains from scratch
+warm_start = (getResolvedOptions(sys.argv, ['WARM_START'])['WARM_START'].lower() == 'true'
+              if '--WARM_START' in sys.argv else False)
+
+CONTRACTOR_FIELD = 'award_contract__awarded_contract__contractors__contractor__address_contractor__officialname'
+FIRST_YEAR = 2011
+# lookup artifacts of the API, and the state of the model for the next warm start
+LOOKUP_KEY = 'recommendations_lookup/recommendations.sqlite'
+FACTORS_KEY = 'recommendations_lookup/factors.npz'
+INDEXES_KEY = 'recommendations_lookup/indexes.npz'
+STATE_KEY = 'recommendations_lookup/state.npz'
+# recommendations/contractor_group=N/: a warm start only rewrites the groups of the contractors whose recommendations
+# changed
+RECOMMENDATIONS_PREFIX = 'recommendations/'
+GROUP_COLUMN = 'contractor_group'
+CONTRACTOR_GROUPS = 256
 
 spark_context = SparkContext.getOrCreate()
 glue_context = GlueContext(spark_context)
+spark = glue_context.spark_session
+# the standard logger (sent to CloudWatch like the output of the job): the GlueLogger of get_logger() has no warning
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger('make_recommendations')
+s3 = boto3.client('s3')
+
+
+def list_extracted_files():
+    """
+    :return: {package: key} of the extracted files: the YYYY/ prefixes in both layouts and the daily extractions of
+        merged/new_data/, the newest key when a package was extracted more than once
+    """
+    objects = []
+    # the months of every year are listed in parallel (YYYY/MM/, and the YYYY/YYYYMMDD_NNN.parquet files on the way)
+    for prefix in ['%d/' % year for year in range(FIRST_YEAR, datetime.utcnow().year + 1)]:
+        objects.extend(object_ for object_ in s3_listing.walk(s3, bucket, prefix, depth=1)
+                       if object_['Key'].endswith('.parquet'))
+    objects.extend(object_ for object_ in s3_listing.list_prefix(s3, bucket, 'merged/new_data/')
+                   if object_['Key'].endswith('.parquet'))
+    return {implicit_als.package_name(object_['Key']): object_['Key']
+            for object_ in sorted(objects, key=lambda object_: object_['LastModified'])}
 
-# TODO Pass the region in as a parameter
-glue = boto3.client('glue', 'eu-west-1')
-tables = glue.get_tables(DatabaseName='cca_ted_extracted_dev')['TableList']
-tables = [table['Name'] for table in tables if table['Name'].startswith('year_')]
 
-dfs = [
-    glue_context.create_dynamic_frame \
-        .from_catalog('cca_ted_extracted_dev', table)
+def read_pairs(keys):
+    """
+    (service, contractor) pairs of the original contract award notices with services and a single contractor.
+    :param keys: keys of extracted files
+    :return: DataFrame with the columns service and contractor, one row per pair
+    """
+    notices = glue_context.create_dynamic_frame_from_options(
+        connection_type='s3', connection_options={'paths': ['s3://%s/%s' % (bucket, key) for key in keys]},
+        format='parquet'
+    )
+    # the extracted files have upper case names
+    service_column = service_field.upper()
+    contractor_column = CONTRACTOR_FIELD.upper()
+    pairs = notices \
         .filter(
-            lambda record: record['category'] == 'ORIGINAL' and record['td_document_type'] == 'Contract award notice'
-        )
-        .select_fields(
-            [
-                'original_cpv_text',
-                'award_contract__awarded_contract__contractors__contractor__address_contractor__officialname'
-            ]
-        )
-        .rename_field('original_cpv_text', 'service')
-        .rename_field(
-            'award_contract__awarded_contract__contractors__contractor__address_contractor__officialname',
-            'contractor'
-        )
-        .filter(lambda row: all(row['service']) and all(row['contractor']) and len(row['contractor']) == 1)
+            lambda record: record['CATEGORY'] == 'ORIGINAL' and record['TD_DOCUMENT_TYPE'] == 'Contract award notice'
+        ) \
+        .select_fields([service_column, contractor_column]) \
+        .rename_field(service_column, 'service') \
+        .rename_field(contractor_column, 'contractor') \
+        .filter(lambda row: all(row['service']) and all(row['contractor']) and len(row['contractor']) == 1) \
         .toDF()
-    for table in tables
-]
-
-combined = spark_context \
-    .union([df.rdd for df in dfs]) \
-    .toDF()
-
-combined = combined \
-    .select(
-        explode('service'),
-        combined.contractor.getItem(0)
-    ) \
-    .withColumnRenamed('col', 'service') \
-    .withColumnRenamed('contractor[0]', 'contractor')
-
-service_string_indexer = StringIndexer(inputCol='service', outputCol='service_id').fit(combined)
-contractor_string_indexer = StringIndexer(inputCol='contractor', outputCol="contractor_id").fit(combined)
-
-indexed = service_string_indexer.transform(combined)
-indexed = contractor_string_indexer.transform(indexed)
-indexed = indexed.withColumn('rating', lit(1))
-
-als = ALS(
-    maxIter=5,
-    regParam=0.01,
-    userCol='service_id',
-    itemCol='contractor_id',
-    implicitPrefs=True,
-    coldStartStrategy='drop'
-)
-
-model = als.fit(indexed)
-
-recommendations = model.recommendForAllItems(10)
-
-recommendations = recommendations \
-    .select(
-        recommendations.contractor_id,
-        explode('recommendations')
-    ) \
-    .select(
-        recommendations.contractor_id,
-        col('col.service_id'),
-        col('col.rating')
+
+    pairs = pairs \
+        .select(
+            explode('service'),
+            pairs.contractor.getItem(0)
+        ) \
+        .withColumnRenamed('col', 'service') \
+        .withColumnRenamed('contractor[0]', 'contractor')
+
+    if cpv_level:
+        # the distinct codes are rolled up on the driver and joined back, the unknown codes are left out
+        codes = [row['service'] for row in pairs.select('service').distinct().collect()]
+        ancestors = get_cpv_hierarchy().rollup(codes, cpv_level).tolist()
+        rollup = spark.createDataFrame([(code, ancestor) for code, ancestor in zip(codes, ancestors)
+                                        if ancestor is not None], 'service string, ancestor string')
+        pairs = pairs.join(broadcast(rollup), 'service').select(col('ancestor').alias('service'), 'contractor')
+    return pairs
+
+
+def get_cpv_hierarchy():
+    """
+    :return: CpvHierarchy of cpv_codes.npz in the working directory of the job (--extra-files), of the path next to
+        cpv_hierarchy.py otherwise
+    """
+    path = os.path.basename(cpv_hierarchy.INDEX_PATH)
+    return cpv_hierarchy.CpvHierarchy.load(path) if os.path.exists(path) else cpv_hierarchy.get_hierarchy()
+
+
+def read_state():
+    """
+    :return: the state of the last run (implicit_als.load_state), None if there is none
+    """
+    if not s3.list_objects_v2(Bucket=bucket, Prefix=STATE_KEY).get('Contents'):
+        return None
+    path = os.path.join(tempfile.mkdtemp(), 'state.npz')
+    s3.download_file(bucket, STATE_KEY, path)
+    return implicit_als.load_state(path)
+
+
+def train(pairs):
+    """
+    Trains the model from scratch with Spark's ALS.
+    :param pairs: DataFrame of (service, contractor) pairs
+    :return: (recommendations DataFrame (rating, contractor, service), counts, service factors, contractor factors,
+        service labels, contractor labels)
+    """
+    service_string_indexer = StringIndexer(inputCol='service', outputCol='service_id').fit(pairs)
+    contractor_string_indexer = StringIndexer(inputCol='contractor', outputCol="contractor_id").fit(pairs)
+
+    indexed = service_string_indexer.transform(pairs)
+    indexed = contractor_string_indexer.transform(indexed)
+    indexed = indexed.withColumn('rating', lit(1))
+
+    als = ALS(
+        maxIter=5,
+        regParam=0.01,
+        userCol='service_id',
+        itemCol='contractor_id',
+        implicitPrefs=True,
+        coldStartStrategy='drop'
     )
 
-contractor_index_to_string = IndexToString(
-    inputCol='contractor_id',
-    outputCol='contractor',
-    labels=contractor_string_indexer.labels
-)
+    model = als.fit(indexed)
+
+    recommendations = model.recommendForAllItems(10)
+
+    recommendations = recommendations \
+        .select(
+            recommendations.contractor_id,
+            explode('recommendations')
+        ) \
+        .select(
+            recommendations.contractor_id,
+            col('col.service_id'),
+            col('col.rating')
+        )
+
+    contractor_index_to_string = IndexToString(
+        inputCol='contractor_id',
+        outputCol='contractor',
+        labels=contractor_string_indexer.labels
+    )
+
+    service_index_to_string = IndexToString(
+        inputCol='service_id',
+        outputCol='service',
+        labels=service_string_indexer.labels
+    )
+
+    recommendations = contractor_index_to_string.transform(recommendations)
+    recommendations = service_index_to_string.transform(recommendations)
+
+    recommendations = recommendations.drop('contractor_id', 'service_id')
+
+    def factor_matrix(factors, size):
+        # ALS returns (id, features) rows, the ids are the StringIndexer indices of the labels
+        matrix = np.zeros((size, als.getRank()), dtype=np.float32)
+        for row in factors.toLocalIterator():
+            matrix[row['id']] = row['features']
+        return matrix
+
+    service_labels = np.array(service_string_indexer.labels, dtype=object)
+    contractor_labels = np.array(contractor_string_indexer.labels, dtype=object)
+    service_factors = factor_matrix(model.userFactors, len(service_labels))
+    contractor_factors = factor_matrix(model.itemFactors, len(contractor_labels))
+
+    # the pair counts, kept in the state for the warm starts
+    counts_rows, counts_cols, counts_values = [], [], []
+    for row in indexed.groupBy('service_id', 'contractor_id').count().toLocalIterator():
+        counts_rows.append(int(row['service_id']))
+        counts_cols.append(int(row['contractor_id']))
+        counts_values.append(row['count'])
+    counts = sp.coo_matrix(
+        (np.array(counts_values, dtype=np.float32), (np.array(counts_rows), np.array(counts_cols))),
+        shape=(len(service_labels), len(contractor_labels))
+    ).tocsr()
+    return recommendations, counts, service_factors, contractor_factors, service_labels, contractor_labels
+
+
+def recommendations_path():
+    return 's3://%s/%s' % (bucket, RECOMMENDATIONS_PREFIX)
+
+
+def with_contractor_group(recommendations):
+    """
+    :param recommendations: DataFrame (rating, contractor, service)
+    :return: recommendations with the GROUP_COLUMN of their contractor
+    """
+    return recommendations.select('rating', 'contractor', 'service') \
+        .withColumn(GROUP_COLUMN, pmod(crc32(col('contractor')), lit(CONTRACTOR_GROUPS)).cast('int'))
+
+
+def write_recommendations(recommendations, groups_only):
+    """
+    :param recommendations: DataFrame (rating, contractor, service)
+    :param groups_only: if True only the contractor groups in recommendations are replaced, the others are kept
+    """
+    writer = with_contractor_group(recommendations).write.partitionBy(GROUP_COLUMN)
+    if groups_only:
+        writer = writer.option('partitionOverwriteMode', 'dynamic')
+    writer.parquet(recommendations_path(), mode='overwrite')
+
+
+def update(state, pairs):
+    """
+    Adds the new pairs to the state, re-solves the factors they touch and recomputes the recommendations that can
+    have changed (implicit_als.warm_start), on the driver.
+    :param state: see implicit_als.load_state, updated in place
+    :param pairs: DataFrame of the new (service, contractor) pairs
+    :return: (recommendations DataFrame (rating, contractor, service) of the contractor groups to write, True if these
+        are only the groups with changed contractors, False for the whole table), None if nothing changed
+    """
+    interactions = pairs.toPandas()
+    services, contractors = implicit_als.add_interactions(state, interactions)
+    implicit_als.warm_start(state, services, contractors)
+
+    previous = spark.read.parquet(recommendations_path())
+    # the thresholds of implicit_als.changed_contractors, aggregated by Spark: a row per contractor instead of the table
+    updated_services = list(set(state['service_labels'][services].tolist()))
+    summary = previous.groupBy('contractor').agg(
+        F.min('rating').alias('rating'),
+        F.count('*').alias('count'),
+        F.max(col('service').isin(updated_services).cast('int')).alias('updated')
+    ).toPandas()
+    changed = implicit_als.changed_from_summary(summary, state, services, contractors)
+    logger.info('%d new pairs, recomputing the recommendations of %d of %d contractors'
+                % (len(interactions), len(changed), len(state['contractor_labels'])))
+    if not len(changed):
+        return None
+
+    labels = state['contractor_labels'][changed]
+    updated = spark.createDataFrame(implicit_als.recommendations_table(
+        state['service_factors'], state['contractor_factors'][changed], state['service_labels'], labels
+    ).to_pandas()[['rating', 'contractor', 'service']])
+    kept = previous.join(broadcast(spark.createDataFrame([(label,) for label in labels.tolist()], 'contractor string')),
+                         'contractor', 'left_anti')
+    # written before the contractor groups: the whole table is rewritten once
+    groups_only = GROUP_COLUMN in previous.columns
+    if groups_only:
+        groups = [row[GROUP_COLUMN] for row in with_contractor_group(updated).select(GROUP_COLUMN).distinct().collect()]
+        kept = kept.filter(col(GROUP_COLUMN).isin(groups))
+    # collected before their files are replaced
+    kept = spark.createDataFrame(kept.select('rating', 'contractor', 'service').toPandas(), updated.schema)
+    return kept.union(updated), groups_only
+
+
+def write_lookup(recommendations):
+    # lookup artifact for the API: the same recommendations in an SQLite file indexed by contractor and by service, so
+    # recommendations.fetch answers from memory instead of running an Athena query per request
+    lookup_path = os.path.join(tempfile.mkdtemp(), 'recommendations.sqlite')
+    connection = sqlite3.connect(lookup_path)
+    connection.execute('CREATE TABLE recommendations (contractor TEXT NOT NULL, service TEXT NOT NULL, rating REAL)')
+    rows = (
+        (row['contractor'], row['service'], row['rating'])
+        for row in recommendations.select('contractor', 'service', 'rating').toLocalIterator()
+    )
+    while True:
+        batch = list(itertools.islice(rows, 10000))
+        if not batch:
+            break
+        connection.executemany('INSERT INTO recommendations VALUES (?, ?, ?)', batch)
+    connection.execute('CREATE INDEX recommendations_contractor ON recommendations (contractor, rating DESC)')
+    connection.execute('CREATE INDEX recommendations_service ON recommendations (service, rating DESC)')
+    connection.execute('CREATE TABLE metadata (key TEXT PRIMARY KEY, value TEXT)')
+    connection.execute("INSERT INTO metadata VALUES ('created', ?)", (datetime.utcnow().isoformat(),))
+    connection.commit()
+    connection.execute('VACUUM')
+    connection.close()
+
+    # a single PUT, the API sees the old or the new file (it checks the ETag)
+    s3.upload_file(lookup_path, bucket, LOOKUP_KEY)
+
+
+files = list_extracted_files()
+state = read_state() if warm_start else None
+if warm_start and state is None:
+    logger.warning('No state in s3://%s/%s, training from scratch' % (bucket, STATE_KEY))
 
-service_index_to_string = IndexToString(
-    inputCol='service_id',
-    outputCol='service',
-    labels=service_string_indexer.labels
-)
+if state is None:
+    recommendations, counts, service_factors, contractor_factors, service_labels, contractor_labels = \
+        train(read_pairs(sorted(files.values())))
+    write_recommendations(recommendations, groups_only=False)
+    counted = sorted(files)
+else:
+    counted = set(state['files'])
+    new_files = sorted(package for package in files if package not in counted)
+    if not new_files:
+        logger.info('No new extracted files since the last run')
+        sys.exit(0)
+    updated = update(state, read_pairs([files[package] for package in new_files]))
+    if updated is not None:
+        write_recommendations(*updated)
+    counts, service_factors, contractor_factors = state['counts'], state['service_factors'], state['contractor_factors']
+    service_labels, contractor_labels = state['service_labels'], state['contractor_labels']
+    counted = state['files'] + new_files
 
-recommendations = contractor_index_to_string.transform(recommendations)
-recommendations = service_index_to_string.transform(recommendations)
+write_lookup(spark.read.parquet(recommendations_path()))
 
-recommendations = recommendations.drop('contractor_id', 'service_id')
+# factors of the model, for the similar contractor / similar service queries of the API (serverless/ann_index.py);
+# the same file as scripts/train_recommendations.py --factors
+factors = {
+    'service_factors': service_factors,
+    'contractor_factors': contractor_factors,
+    'service_labels': service_labels.astype(str),
+    'contractor_labels': contractor_labels.astype(str)
+}
+factors_path = os.path.join(tempfile.mkdtemp(), 'factors.npz')
+np.savez(factors_path, **factors)
+# the indexes are built here once, the API only loads them
+indexes_path = os.path.join(tempfile.mkdtemp(), 'indexes.npz')
+ann_index.save_indexes(indexes_path, ann_index.build_indexes(factors))
+s3.upload_file(indexes_path, bucket, INDEXES_KEY)
+s3.upload_file(factors_path, bucket, FACTORS_KEY)
 
-recommendations.write.parquet('s3://af-cca-ted-extracted-dev/recommendations/', mode='overwrite')
\ No newline at end of file
+# the pair counts with the factors, the labels and the files counted, the next --WARM_START run only reads the files
+# extracted after this one
+state_path = os.path.join(tempfile.mkdtemp(), 'state.npz')
+implicit_als.save_state(state_path, counts, service_factors, contractor_factors, service_labels, contractor_labels,
+                        counted)
+s3.upload_file(state_path, bucket, STATE_KEY)
@@ -0,0 +1,165 @@
+# Output layout of the merged tables, shared by the Glue jobs (pass this file to the jobs with --extra-py-files).
+#
+# The jobs used to repartition(1) before writing merged/ partitioned by YEAR, so a whole year went through a single
+# executor and Athena scanned one huge file for any query. write_partitioned instead sizes the output from the input:
+# the number of files is the input bytes divided by the target file size, the rows are range partitioned on the
+# partition and sort columns so every task writes a contiguous slice of a few year/month directories, and each file is
+# sorted on the columns queries filter on, so the Parquet min/max statistics of the row groups let Athena skip them.
+#
+# The year/month table is written under TABLE_PREFIX, crawled as its own table (terraform/glue), and not into merged/:
+# the crawler of merged/ would mix its YEAR= partitions with year=/month= ones. merged/ keeps the tables written before.
+#
+# A job run for a year replaces the months it writes (dynamic partition overwrite) instead of appending to them, so
+# running a year again doesn't duplicate its rows. serverless/merge_new_data.py adds the daily files of merged/new_data/
+# to the same months, so the jobs read them too (year_files) and keep one file per package, the newest, when a day was
+# extracted both to YYYY/ and to merged/new_data/. write_marker then records the new_data files the job wrote, and
+# merge_new_data doesn't append them again. A day whose new_data file was deleted ({"delete_new_data": true}) is lost
+# from its month when the year is run again.
+#
+# Optional job arguments:
+#   --TARGET_FILE_MB   target size of the output files, 128 by default
+#   --PARTITION_BY     "country" or "document_type" to add iso_country__value or td_document_type__code to the
+#                      year and month partitions
+
+import json
+import logging
+import math
+import os
+
+from awsglue.utils import getResolvedOptions
+from pyspark.sql import functions as F
+
+# serverless/s3_listing.py, passed to the jobs with --extra-py-files too
+import s3_listing
+
+TARGET_FILE_MB = 128
+TABLE_PREFIX = 'merged_by_month'
+# serverless/merge_new_data.NEW_DATA_PREFIX and MARKER_PREFIX
+NEW_DATA_PREFIX = 'merged/new_data/'
+MARKER_PREFIX = '_bookmarks/merged_by_month/'
+PARTITION_COLUMNS = ['year', 'month']
+EXTRA_PARTITION_COLUMNS = {
+    'country': 'iso_country__value',
+    'document_type': 'td_document_type__code',
+}
+# most selective first: the first column is sorted globally in a file, the others within its runs
+SORT_COLUMNS = ['iso_country__value', 'td_document_type__code', 'main_cpv_code', 'date']
+
+
+def get_options(argv):
+    """
+    :param argv: sys.argv of the job
+    :return: (target file size in bytes, extra partition key or None)
+    """
+    options = {'TARGET_FILE_MB': str(TARGET_FILE_MB), 'PARTITION_BY': ''}
+    for name in options:
+        if '--' + name in argv:
+            options[name] = getResolvedOptions(argv, [name])[name]
+    partition_by = options['PARTITION_BY'] or None
+    if partition_by is not None and partition_by not in EXTRA_PARTITION_COLUMNS:
+        raise ValueError('PARTITION_BY must be one of %s, not %s' % (', '.join(EXTRA_PARTITION_COLUMNS), partition_by))
+    return int(options['TARGET_FILE_MB']) * 1024 * 1024, partition_by
+
+
+def table_path(bucket):
+    """
+    :return: s3:// path of the year/month table in bucket
+    """
+    return 's3://%s/%s' % (bucket, TABLE_PREFIX)
+
+
+def package_name(key):
+    """
+    :param key: YYYY/MM/YYYYMMDD-NNN.parquet, YYYY/YYYYMMDD_NNN.parquet or merged/new_data/YYYYMMDD_NNN.parquet
+    :return: the daily package of the file, e.g. 20190102_001
+    """
+    return os.path.basename(key).split('.')[0].replace('-', '_')
+
+
+def latest_per_package(objects):
+    """
+    :param objects: listed S3 objects
+    :return: the newest object of every package, in key order
+    """
+    latest = {package_name(object_['Key']): object_
+              for object_ in sorted(objects, key=lambda object_: object_['LastModified'])}
+    return sorted(latest.values(), key=lambda object_: object_['Key'])
+
+
+def new_data_objects(s3_client, bucket, year):
+    """
+    :return: the Parquet files of year in merged/new_data/
+    """
+    return [object_ for object_ in s3_listing.list_prefix(s3_client, bucket, '%s%s' % (NEW_DATA_PREFIX, year))
+            if '.parquet' in object_['Key']]
+
+
+def year_files(s3_client, bucket, year):
+    """
+    :return: the Parquet files of a year, YYYY/ and merged/new_data/, one per package (see latest_per_package)
+    """
+    # the months of the year (YYYY/MM/) are listed in parallel
+    objects = [object_ for object_ in s3_listing.walk(s3_client, bucket, '%s/' % year, depth=1)
+               if '.parquet' in object_['Key']]
+    return latest_per_package(objects + new_data_objects(s3_client, bucket, year))
+
+
+def marker_key(year):
+    """
+    :return: key of the marker of the new_data files of year written by a job, outside the table
+    """
+    return '%s%s.json' % (MARKER_PREFIX, year)
+
+
+def write_marker(s3_client, bucket, year, objects):
+    """
+    Records the new_data files among objects as written to the table, merge_new_data skips them while their ETag is the
+    same.
+    :param objects: the objects the job read
+    """
+    keys = dict((object_['Key'], object_['ETag']) for object_ in objects if object_['Key'].startswith(NEW_DATA_PREFIX))
+    s3_client.put_object(Bucket=bucket, Key=marker_key(year), Body=json.dumps({'keys': keys}).encode())
+
+
+def file_count(size, target_file_bytes):
+    """
+    :return: number of output files of about target_file_bytes for size bytes of input, at least 1
+    """
+    return max(1, int(math.ceil(float(size) / target_file_bytes)))
+
+
+def write_partitioned(df, path, size, target_file_bytes=TARGET_FILE_MB * 1024 * 1024, partition_by=None,
+                      mode='overwrite', logger=None):
+    """
+    Writes a DataFrame as Parquet partitioned by year and month (and partition_by), in files of about
+    target_file_bytes sorted on SORT_COLUMNS.
+    :param df: DataFrame with the mapped (lower case) columns
+    :param path: s3:// path of the table
+    :param size: bytes of Parquet input the DataFrame was read from
+    :param partition_by: None, "country" or "document_type"
+    :param mode: Spark save mode, 'overwrite' replaces the partitions in df only
+    :param logger: logger of the job, the logger of this module by default
+    :return: number of tasks writing the table
+    """
+    # DATE is a date since the extraction types it (serverless/typed_columns.py)
+    df = df.withColumn('month', F.date_format(F.col('date'), 'MM'))
+    partition_columns = list(PARTITION_COLUMNS)
+    if partition_by is not None:
+        partition_columns.append(EXTRA_PARTITION_COLUMNS[partition_by])
+    # DropNullFields may have removed a sort column in old years
+    sort_columns = [column for column in SORT_COLUMNS if column in df.columns and column not in partition_columns]
+
+    # range partitioning samples the data to give every task the same number of rows, a task whose slice spans a
+    # partition boundary writes one file on each side
+    tasks = file_count(size, target_file_bytes)
+    (logger or logging.getLogger(__name__)).info(
+        "Writing %d input bytes to %s in about %d files partitioned by %s, sorted by %s"
+        % (size, path, tasks, ', '.join(partition_columns), ', '.join(sort_columns)))
+    (df.repartitionByRange(tasks, *[F.col(column) for column in partition_columns + sort_columns])
+       .sortWithinPartitions(*(partition_columns + sort_columns))
+       .write
+       .option('partitionOverwriteMode', 'dynamic')
+       .partitionBy(*partition_columns)
+       .mode(mode)
+       .parquet(path))
+    return tasks
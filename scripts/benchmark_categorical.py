@@ -0,0 +1,68 @@
+## Script to measure what the dictionary-encoded CATEGORICAL_COLS of extract_xml_lambda.py save: every input file is
+## written once with these columns as plain strings and once dictionary-encoded (code_lists.encode_table), and the
+## script prints the file sizes and the compressed size of the categorical columns, which is what Athena scans for a
+## query that only filters or groups on them.
+##
+## Arguments:
+##   -i --input (str, one or more) - extracted Parquet files
+##
+## Example:
+##   python scripts/benchmark_categorical.py -i tmp/2019/01/20190102-001.parquet
+
+import argparse
+import io
+import os
+import sys
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# extract_xml_lambda reads these at import time to build the bucket names
+os.environ.setdefault("INITIALS", "benchmark")
+os.environ.setdefault("STAGE", "dev")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "serverless"))
+
+import code_lists
+import extract_xml_lambda
+
+parser = argparse.ArgumentParser(description='Process parameters')
+parser.add_argument("-i", "--input", help="Extracted Parquet files", nargs="+", required=True, type=str)
+args = parser.parse_args()
+
+
+def plain(table):
+    # the categorical columns as plain strings, like the files written before
+    arrays = [pa.array(table.column(i).to_pylist(), type=pa.string())
+              if name in extract_xml_lambda.CATEGORICAL_COLS else table.column(i)
+              for i, name in enumerate(table.schema.names)]
+    return pa.Table.from_arrays(arrays, names=table.schema.names)
+
+
+def measure(table):
+    # (file size, compressed bytes of the categorical columns)
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer)
+    metadata = pq.ParquetFile(io.BytesIO(buffer.getvalue())).metadata
+    columns = set(extract_xml_lambda.CATEGORICAL_COLS)
+    scanned = 0
+    for i in range(metadata.num_row_groups):
+        row_group = metadata.row_group(i)
+        for j in range(row_group.num_columns):
+            if row_group.column(j).path_in_schema in columns:
+                scanned += row_group.column(j).total_compressed_size
+    return len(buffer.getvalue()), scanned
+
+
+totals = [0, 0, 0, 0]
+for path in args.input:
+    table = plain(pq.read_table(path))
+    before = measure(table)
+    after = measure(code_lists.encode_table(table, extract_xml_lambda.CATEGORICAL_COLS))
+    print("%s: %d rows, file %d -> %d bytes, categorical columns %d -> %d bytes"
+          % (os.path.basename(path), table.num_rows, before[0], after[0], before[1], after[1]))
+    for i, value in enumerate(before + after):
+        totals[i] += value
+
+print("Total: file %d -> %d bytes (%.1f%%), categorical columns %d -> %d bytes (%.1f%%)"
+      % (totals[0], totals[2], 100.0 * (totals[2] - totals[0]) / max(totals[0], 1),
+         totals[1], totals[3], 100.0 * (totals[3] - totals[1]) / max(totals[1], 1)))
@@ -0,0 +1,70 @@
+## Script to compare the xmltodict + extract_xml parsing path of load_data with the streaming parser in xml_stream.py
+## (with and without the USE_COLS projection, on one and on several processes, and straight from the tar.gz stream) on
+## a real daily package. The package is extracted again into a temporary directory for every run (load_data deletes
+## what it reads), each path is timed and the resulting tables are checked to be identical.
+##
+## Arguments:
+##   -f --file (str) - daily package to use, e.g. 20190102_001.tar.gz
+##   -l --language (str, default="EN") - language passed to load_data
+##   -w --workers (int, default=number of cores) - number of processes for the parallel run
+##
+## Example:
+##   python scripts/benchmark_extract.py -f tmp/201901/20190102_001.tar.gz
+
+import argparse
+import os
+import sys
+import tarfile
+import tempfile
+import time
+
+# extract_xml_lambda reads these at import time to build the bucket names
+os.environ.setdefault("INITIALS", "benchmark")
+os.environ.setdefault("STAGE", "dev")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "serverless"))
+
+import extract_xml_lambda
+
+parser = argparse.ArgumentParser(description='Process parameters')
+parser.add_argument("-f", "--file", help="Daily package (tar.gz) to parse", required=True, type=str)
+parser.add_argument("-l", "--language", help="Language to extract", default="EN", type=str)
+parser.add_argument("-w", "--workers", help="Number of processes for the parallel run", default=os.cpu_count(), type=int)
+args = parser.parse_args()
+
+# the currency conversion is the same for all the paths so leave it out of the timings
+extract_xml_lambda.convert_currencies = lambda values, currencies, dates: values
+
+def run(**kwargs):
+    with tempfile.TemporaryDirectory() as data_dir:
+        with tarfile.open(args.file, "r:gz") as tar:
+            tar.extractall(data_dir)
+        start = time.time()
+        table = extract_xml_lambda.load_data(data_dir, language=args.language, **kwargs)
+        return table, time.time() - start
+
+legacy_table, legacy_time = run(streaming=False)
+print("%-24s %d rows in %.2fs" % ("xmltodict + extract_xml:", legacy_table.num_rows, legacy_time))
+
+failed = False
+for name, kwargs in [("xml_stream", {'streaming': True, 'projected': False, 'workers': 1}),
+                     ("xml_stream + projection", {'streaming': True, 'projected': True, 'workers': 1}),
+                     ("%d processes" % args.workers, {'streaming': True, 'projected': True, 'workers': args.workers})]:
+    table, run_time = run(**kwargs)
+    print("%-24s %d rows in %.2fs, speed-up %.2fx" % (name + ":", table.num_rows, run_time, legacy_time / run_time))
+    if not legacy_table.equals(table):
+        print("[ERROR] Output of %s differs" % name)
+        failed = True
+
+# no extraction at all, the archive is read as a stream
+start = time.time()
+with open(args.file, "rb") as f:
+    table = extract_xml_lambda.load_data_from_archives([f], language=args.language)
+run_time = time.time() - start
+print("%-24s %d rows in %.2fs, speed-up %.2fx" % ("tar.gz stream:", table.num_rows, run_time, legacy_time / run_time))
+if not legacy_table.equals(table):
+    print("[ERROR] Output of tar.gz stream differs")
+    failed = True
+
+if failed:
+    sys.exit(1)
+print("Outputs are identical")
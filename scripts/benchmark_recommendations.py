@@ -0,0 +1,71 @@
+## Script to compare implicit_als.py with Spark's ALS (the model of glue/make_recommendations.py, run in local mode)
+## on the same sample, e.g. a year of extracted Parquet files: both are trained with the parameters of the Glue job,
+## the training and recommendation times are printed, and the overlap of the 10 recommended services of every
+## contractor measures how close the two models are (ALS starts from random factors, so they never match exactly).
+## Needs pyspark; without it only the local trainer is timed.
+##
+## Arguments:
+##   -i --input (str, one or more) - extracted Parquet files or directories of Parquet files
+##
+## Example:
+##   python scripts/benchmark_recommendations.py -i tmp/2019
+
+import argparse
+import glob
+import os
+import time
+
+import numpy as np
+
+import implicit_als
+
+parser = argparse.ArgumentParser(description='Process parameters')
+parser.add_argument("-i", "--input", help="Extracted Parquet files or directories", nargs="+", required=True, type=str)
+args = parser.parse_args()
+
+paths = []
+for path in args.input:
+    paths += sorted(glob.glob(os.path.join(path, "**", "*.parquet"), recursive=True)) if os.path.isdir(path) else [path]
+
+interactions = implicit_als.read_interactions(paths)
+counts, service_labels, contractor_labels = implicit_als.build_matrix(interactions)
+print("%d pairs: %d services x %d contractors, %d non-zeros"
+      % (len(interactions), counts.shape[0], counts.shape[1], counts.nnz))
+
+start = time.time()
+service_factors, contractor_factors = implicit_als.train(counts)
+contractor_ids, service_ids, scores = implicit_als.recommend_for_all_items(service_factors, contractor_factors)
+local_time = time.time() - start
+print("%-16s %.2fs" % ("implicit_als:", local_time))
+
+try:
+    from pyspark.sql import SparkSession
+    from pyspark.ml.recommendation import ALS
+except ImportError:
+    print("pyspark is not installed, skipping the Spark run")
+    raise SystemExit(0)
+
+spark = SparkSession.builder.master("local[*]").appName("benchmark_recommendations").getOrCreate()
+coo = counts.tocoo()
+ratings = spark.createDataFrame(
+    [(int(service), int(contractor), float(count)) for service, contractor, count in zip(coo.row, coo.col, coo.data)],
+    ["service_id", "contractor_id", "rating"]
+).cache()
+ratings.count()
+
+start = time.time()
+model = ALS(maxIter=5, regParam=0.01, userCol="service_id", itemCol="contractor_id", implicitPrefs=True,
+            coldStartStrategy="drop").fit(ratings)
+spark_recommendations = {
+    row["contractor_id"]: set(recommendation["service_id"] for recommendation in row["recommendations"])
+    for row in model.recommendForAllItems(10).collect()
+}
+spark_time = time.time() - start
+print("%-16s %.2fs, implicit_als is %.1fx faster" % ("Spark ALS:", spark_time, spark_time / local_time))
+
+local_recommendations = {}
+for contractor, service in zip(contractor_ids, service_ids):
+    local_recommendations.setdefault(int(contractor), set()).add(int(service))
+overlaps = [len(local_recommendations.get(contractor, set()) & services) / float(len(services))
+            for contractor, services in spark_recommendations.items() if services]
+print("Mean overlap of the top 10 services: %.2f" % np.mean(overlaps))
@@ -0,0 +1,25 @@
+## Script to rebuild serverless/code_lists.npz, the code lists of the TED schemas the extraction encodes the code
+## columns with (see serverless/code_lists.py), after a new release of the schemas.
+##
+## Arguments:
+##   -s --schemas (str, default=schemas) - directory of the XSD files
+##   -o --output (str, default=serverless/code_lists.npz) - output .npz file
+##
+## Example:
+##   python scripts/build_code_lists.py
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "serverless"))
+
+import code_lists
+
+parser = argparse.ArgumentParser(description='Process parameters')
+parser.add_argument("-s", "--schemas", help="Directory of the XSD files", default=code_lists.SCHEMA_DIR, type=str)
+parser.add_argument("-o", "--output", help="Output .npz file", default=code_lists.INDEX_PATH, type=str)
+args = parser.parse_args()
+
+for name, code_list in sorted(code_lists.build(args.schemas, args.output).items()):
+    print("%s: %d codes" % (name, len(code_list)))
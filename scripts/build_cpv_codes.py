@@ -0,0 +1,26 @@
+## Script to rebuild serverless/cpv_codes.npz, the CPV codes the code columns are rolled up with (see
+## serverless/cpv_hierarchy.py), after a new release of schemas/cpv_codes.xsd.
+##
+## Arguments:
+##   -s --schema (str, default=schemas/cpv_codes.xsd) - XSD file of the CPV codes
+##   -o --output (str, default=serverless/cpv_codes.npz) - output .npz file
+##
+## Example:
+##   python scripts/build_cpv_codes.py
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "serverless"))
+
+import cpv_hierarchy
+
+parser = argparse.ArgumentParser(description='Process parameters')
+parser.add_argument("-s", "--schema", help="XSD file of the CPV codes", default=cpv_hierarchy.SCHEMA_PATH, type=str)
+parser.add_argument("-o", "--output", help="Output .npz file", default=cpv_hierarchy.INDEX_PATH, type=str)
+args = parser.parse_args()
+
+hierarchy = cpv_hierarchy.CpvHierarchy.from_xsd(args.schema)
+hierarchy.save(args.output)
+print("%d codes" % len(hierarchy))
@@ -0,0 +1,69 @@
+## Script to build the full-text index of the notices (see serverless/text_index.py) from extracted Parquet files: one
+## compressed segment per month, <output>/YYYYMM.npz, over the title and the short descriptions of every notice. A
+## month is rebuilt from the input files of that month, so pass every file of the months to update; the other
+## segments of the output directory are left as they are. Query the segments with scripts/search_text_index.py.
+##
+## Arguments:
+##   -i --input (str, one or more) - extracted Parquet files or directories of Parquet files
+##   -o --output (str, default="text_index") - directory of the segments
+##   -s --stopwords (str, default=notebooks/stopwords-en.txt) - stop words, one per line
+##
+## Example:
+##   python scripts/build_text_index.py -i tmp/2019 -o tmp/text_index
+##   python scripts/search_text_index.py -i tmp/text_index -q "road maintenance"
+
+import argparse
+import glob
+import os
+import sys
+import time
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+# extract_xml_lambda reads these at import time to build the bucket names
+os.environ.setdefault("INITIALS", "benchmark")
+os.environ.setdefault("STAGE", "dev")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "serverless"))
+
+import extract_xml_lambda
+import text_index
+
+parser = argparse.ArgumentParser(description='Process parameters')
+parser.add_argument("-i", "--input", help="Extracted Parquet files or directories", nargs="+", required=True, type=str)
+parser.add_argument("-o", "--output", help="Directory of the segments", default="text_index", type=str)
+parser.add_argument("-s", "--stopwords", help="Stop words file", default=text_index.STOPWORDS_PATH, type=str)
+args = parser.parse_args()
+
+paths = []
+for path in args.input:
+    paths += sorted(glob.glob(os.path.join(path, "**", "*.parquet"), recursive=True)) if os.path.isdir(path) else [path]
+
+
+def read_notices(path):
+    # DataFrame of the NO_DOC_OJS, month (YYYYMM) and text of the notices of a file
+    table = pq.read_table(path, columns=[text_index.ID_COLUMN, 'DATE'] + text_index.TEXT_COLUMNS)
+    texts = None
+    for column in text_index.TEXT_COLUMNS:
+        values = pd.Series(extract_xml_lambda.unwind_descriptions(table.column(column).to_pylist())).fillna('')
+        texts = values if texts is None else texts + ' ' + values
+    # DATE is a date, or a YYYYMMDD string in the files extracted before the typed columns
+    months = pd.Series(table.column('DATE').to_pylist()).astype(str).str.replace('-', '', regex=False).str[:6]
+    return pd.DataFrame({'id': table.column(text_index.ID_COLUMN).to_pylist(), 'month': months, 'text': texts})
+
+
+start = time.time()
+notices = pd.concat([read_notices(path) for path in paths], ignore_index=True)
+# a notice extracted twice (a package processed again) is indexed once
+notices = notices[notices['id'].notnull()].drop_duplicates('id', keep='last')
+print("Read %d notices from %d files in %.2fs" % (len(notices), len(paths), time.time() - start))
+
+stopwords = text_index.read_stopwords(args.stopwords)
+os.makedirs(args.output, exist_ok=True)
+for month, group in notices.groupby('month', sort=True):
+    start = time.time()
+    segment = text_index.Segment.build(group['id'].values, group['text'].values, stopwords)
+    path = os.path.join(args.output, "%s.npz" % month)
+    segment.save(path)
+    print("%s: %d notices, %d terms, %d postings, %d bytes in %.2fs"
+          % (month, len(segment), len(segment.terms), len(segment.gaps), os.path.getsize(path), time.time() - start))
@@ -0,0 +1,335 @@
+## Implicit-feedback ALS on a single machine, the same model as glue/make_recommendations.py without Spark.
+##
+## The service x contractor matrix is built sparse (CSR) straight from the extracted Parquet files: the award notices
+## give (service, contractor) pairs, repeated pairs add up. Training follows Hu, Koren and Volinsky with the conjugate
+## gradient update of Takacs et al.: every half step runs a few CG iterations for all the rows at once, each iteration
+## being two sparse products with the confidence matrix and a few dense ones, so nothing is looped over in Python and
+## nothing of size services x contractors is ever allocated. The regularisation is scaled by the number of ratings
+## of each row, like Spark's ALS, and the defaults are the ones of the Glue job (rank 10, 5 iterations, regParam 0.01,
+## alpha 1).
+
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import scipy.sparse as sp
+
+SERVICE_COLUMN = 'ORIGINAL_CPV_TEXT'
+CONTRACTOR_COLUMN = 'AWARD_CONTRACT__AWARDED_CONTRACT__CONTRACTORS__CONTRACTOR__ADDRESS_CONTRACTOR__OFFICIALNAME'
+FILTERS = {'CATEGORY': 'ORIGINAL', 'TD_DOCUMENT_TYPE': 'Contract award notice'}
+
+
+def _column(table, name):
+    # extracted files have upper case names, the tables written by Glue lower case ones
+    for field in table.schema.names:
+        if field.upper() == name:
+            return table.column(field).to_pylist()
+    raise KeyError(name)
+
+
+def read_interactions(paths, service_column=SERVICE_COLUMN, service_map=None):
+    """
+    Reads (service, contractor) pairs from extracted Parquet files, with the filters of the Glue job: original contract
+    award notices with services and a single contractor.
+    :param paths: Parquet files
+    :param service_column: list column of the services, e.g. ORIGINAL_CPV_CODE instead of the texts
+    :param service_map: function(list of services) -> list of services applied to the pairs, e.g. a CPV rollup;
+        pairs mapped to None are dropped
+    :return: DataFrame with the columns service and contractor, one row per pair
+    """
+    services, contractors = [], []
+    for path in paths:
+        table = pq.read_table(path)
+        keep = None
+        for name, value in FILTERS.items():
+            matches = np.array([item == value for item in _column(table, name)], dtype=bool)
+            keep = matches if keep is None else keep & matches
+        for keep_row, row_services, row_contractors in zip(keep, _column(table, service_column),
+                                                           _column(table, CONTRACTOR_COLUMN)):
+            if (not keep_row or not row_services or not row_contractors or len(row_contractors) != 1
+                    or not all(row_services) or not row_contractors[0]):
+                continue
+            services.extend(row_services)
+            contractors.extend(row_contractors * len(row_services))
+    interactions = pd.DataFrame({'service': services, 'contractor': contractors})
+    if service_map is not None:
+        interactions['service'] = service_map(interactions['service'])
+        interactions = interactions[interactions['service'].notnull()].reset_index(drop=True)
+    return interactions
+
+
+def build_matrix(interactions):
+    """
+    :param interactions: DataFrame with the columns service and contractor
+    :return: (CSR float32 matrix services x contractors with the number of times each pair occurs,
+        service labels, contractor labels)
+    """
+    service_ids, service_labels = pd.factorize(interactions['service'])
+    contractor_ids, contractor_labels = pd.factorize(interactions['contractor'])
+    counts = sp.coo_matrix(
+        (np.ones(len(interactions), dtype=np.float32), (service_ids, contractor_ids)),
+        shape=(len(service_labels), len(contractor_labels))
+    ).tocsr()
+    # the duplicates of the COO matrix are summed by tocsr
+    counts.sum_duplicates()
+    return counts, np.asarray(service_labels, dtype=object), np.asarray(contractor_labels, dtype=object)
+
+
+def _row_ids(matrix):
+    return np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+
+
+def _cg_step(counts, X, Y, reg, alpha, cg_steps):
+    """
+    Updates X (rows of counts) for fixed Y (columns of counts), solving for every row u
+    (Y'Y + Y'(C_u - I)Y + reg * n_u I) x_u = Y'C_u p(u) with cg_steps conjugate gradient iterations started from X.
+    """
+    rows = _row_ids(counts)
+    cols = counts.indices
+    confidence = alpha * counts.data
+    # reg * number of ratings of the row, at least reg so empty rows stay defined
+    regularisation = (reg * np.maximum(np.diff(counts.indptr), 1)).astype(X.dtype)[:, None]
+    YtY = Y.T @ Y
+
+    def apply_a(P):
+        # A_u p_u for every row at once; (C_u - I) only has the observed entries
+        weights = confidence * np.einsum('ij,ij->i', P[rows], Y[cols])
+        return P @ YtY + sp.csr_matrix((weights, cols, counts.indptr), shape=counts.shape) @ Y + regularisation * P
+
+    # the right hand side: Y'C_u p(u), p is 1 on the observed entries
+    B = sp.csr_matrix(((1 + confidence).astype(X.dtype), cols, counts.indptr), shape=counts.shape) @ Y
+    R = B - apply_a(X)
+    P = R.copy()
+    rs_old = np.einsum('ij,ij->i', R, R)
+    for _ in range(cg_steps):
+        AP = apply_a(P)
+        denominator = np.einsum('ij,ij->i', P, AP)
+        step = np.divide(rs_old, denominator, out=np.zeros_like(rs_old), where=denominator > 0)
+        X += step[:, None] * P
+        R -= step[:, None] * AP
+        rs_new = np.einsum('ij,ij->i', R, R)
+        beta = np.divide(rs_new, rs_old, out=np.zeros_like(rs_new), where=rs_old > 0)
+        P = R + beta[:, None] * P
+        rs_old = rs_new
+    return X
+
+
+def train(counts, rank=10, iterations=5, reg=0.01, alpha=1.0, cg_steps=3, seed=0, user_factors=None,
+          item_factors=None):
+    """
+    Implicit ALS.
+    :param counts: CSR matrix users (services) x items (contractors)
+    :param rank: number of latent factors
+    :param iterations: number of alternating passes
+    :param reg: regularisation, scaled by the number of ratings of each row
+    :param alpha: confidence is 1 + alpha * count
+    :param cg_steps: conjugate gradient iterations per row and half step
+    :param user_factors: initial user factors, random by default
+    :param item_factors: initial item factors, random by default
+    :return: (user factors float32 users x rank, item factors float32 items x rank)
+    """
+    random = np.random.RandomState(seed)
+    if user_factors is None:
+        user_factors = (random.rand(counts.shape[0], rank).astype(np.float32) - 0.5) / rank
+    if item_factors is None:
+        item_factors = (random.rand(counts.shape[1], rank).astype(np.float32) - 0.5) / rank
+    counts = counts.astype(np.float32)
+    counts_t = counts.T.tocsr()
+    X = np.array(user_factors, dtype=np.float32)
+    Y = np.array(item_factors, dtype=np.float32)
+    for _ in range(iterations):
+        X = _cg_step(counts, X, Y, reg, alpha, cg_steps)
+        Y = _cg_step(counts_t, Y, X, reg, alpha, cg_steps)
+    return X, Y
+
+
+def recommend_for_all_items(user_factors, item_factors, n=10, batch_size=4096):
+    """
+    The n best users of every item, like Spark's recommendForAllItems.
+    :return: (item ids, user ids, scores), n rows per item, best first
+    """
+    users = min(n, user_factors.shape[0])
+    item_ids, user_ids, scores = [], [], []
+    for start in range(0, item_factors.shape[0], batch_size):
+        batch = item_factors[start:start + batch_size]
+        # items x users, a batch at a time
+        batch_scores = batch @ user_factors.T
+        top = np.argpartition(-batch_scores, users - 1, axis=1)[:, :users]
+        top_scores = np.take_along_axis(batch_scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        item_ids.append(np.repeat(np.arange(start, start + len(batch)), users))
+        user_ids.append(top.ravel())
+        scores.append(np.take_along_axis(top_scores, order, axis=1).ravel())
+    if not item_ids:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+    return np.concatenate(item_ids), np.concatenate(user_ids), np.concatenate(scores)
+
+
+def recommendations_table(user_factors, item_factors, service_labels, contractor_labels, n=10):
+    """
+    :return: pyarrow Table (rating, contractor, service) like the output of glue/make_recommendations.py
+    """
+    item_ids, user_ids, scores = recommend_for_all_items(user_factors, item_factors, n)
+    return pa.Table.from_arrays([
+        pa.array(scores.astype(np.float32)),
+        pa.array(contractor_labels[item_ids].tolist(), type=pa.string()),
+        pa.array(service_labels[user_ids].tolist(), type=pa.string()),
+    ], names=['rating', 'contractor', 'service'])
+
+
+## Warm start: the counts, labels and factors of a run are kept in a state file; a later run adds the pairs of the new
+## notices to the counts (new services and contractors get new rows and columns), re-solves only the rows and columns
+## the new pairs touch for a few sweeps starting from the previous factors, and recomputes only the recommendations
+## that can have changed, so the cost follows the new data instead of the history.
+
+def package_name(path):
+    """
+    :param path: path or S3 key of an extracted file, YYYYMMDD-NNN.parquet (extract_xml_lambda) or YYYYMMDD_NNN.parquet
+    :return: the daily package of the file, e.g. 20190102_001, the name of the file in the files of a state
+    """
+    return os.path.basename(path).split('.')[0].replace('-', '_')
+
+
+def save_state(path, counts, service_factors, contractor_factors, service_labels, contractor_labels, files=()):
+    """
+    :param counts: sparse matrix services x contractors
+    :param files: packages of the input files already counted (package_name), a warm start skips them
+    """
+    counts = counts.tocoo()
+    np.savez(path, counts_rows=counts.row, counts_cols=counts.col, counts_values=counts.data,
+             counts_shape=np.array(counts.shape), service_factors=service_factors,
+             contractor_factors=contractor_factors, service_labels=np.asarray(service_labels, dtype=str),
+             contractor_labels=np.asarray(contractor_labels, dtype=str), files=np.asarray(list(files), dtype=str))
+
+
+def load_state(path):
+    """
+    :return: dict with counts (CSR), service_factors, contractor_factors, service_labels, contractor_labels, files
+    """
+    with np.load(path) as data:
+        return {
+            'counts': sp.coo_matrix((data['counts_values'].astype(np.float32),
+                                     (data['counts_rows'], data['counts_cols'])),
+                                    shape=tuple(data['counts_shape'])).tocsr(),
+            'service_factors': data['service_factors'].astype(np.float32),
+            'contractor_factors': data['contractor_factors'].astype(np.float32),
+            'service_labels': data['service_labels'].astype(object),
+            'contractor_labels': data['contractor_labels'].astype(object),
+            # the states written before the files were named after their package have file names
+            'files': [package_name(name) for name in data['files'].tolist()] if 'files' in data else [],
+        }
+
+
+def _extend_labels(labels, new_values):
+    # previous labels keep their ids, unseen ones are appended in order of appearance
+    positions = {label: i for i, label in enumerate(labels)}
+    added = [value for value in pd.unique(new_values) if value not in positions]
+    for value in added:
+        positions[value] = len(positions)
+    return (np.concatenate([np.asarray(labels, dtype=object), np.asarray(added, dtype=object)]),
+            np.array([positions[value] for value in new_values], dtype=np.int64))
+
+
+def add_interactions(state, interactions, seed=0):
+    """
+    Adds new (service, contractor) pairs to a state; new services and contractors get small random factors.
+    :param state: see load_state, updated in place
+    :param interactions: DataFrame with the columns service and contractor
+    :return: (ids of the services touched, ids of the contractors touched)
+    """
+    service_labels, service_ids = _extend_labels(state['service_labels'], interactions['service'].values)
+    contractor_labels, contractor_ids = _extend_labels(state['contractor_labels'], interactions['contractor'].values)
+    counts = state['counts'].tocoo()
+    counts = sp.coo_matrix((np.concatenate([counts.data, np.ones(len(service_ids), dtype=np.float32)]),
+                            (np.concatenate([counts.row, service_ids]), np.concatenate([counts.col, contractor_ids]))),
+                           shape=(len(service_labels), len(contractor_labels))).tocsr()
+    counts.sum_duplicates()
+    state['counts'] = counts
+
+    random = np.random.RandomState(seed)
+    for name, size in (('service_factors', counts.shape[0]), ('contractor_factors', counts.shape[1])):
+        factors = state[name]
+        rank = factors.shape[1]
+        new = (random.rand(size - len(factors), rank).astype(np.float32) - 0.5) / rank
+        state[name] = np.vstack([factors, new])
+    state['service_labels'] = service_labels
+    state['contractor_labels'] = contractor_labels
+    return np.unique(service_ids), np.unique(contractor_ids)
+
+
+def warm_start(state, services, contractors, sweeps=2, reg=0.01, alpha=1.0, cg_steps=3):
+    """
+    Runs a few ALS sweeps on the touched rows and columns only, the other factors stay as they are.
+    :param state: see load_state, updated in place
+    :param services: ids of the services to update
+    :param contractors: ids of the contractors to update
+    """
+    counts = state['counts']
+    counts_t = counts.T.tocsr()
+    X = state['service_factors']
+    Y = state['contractor_factors']
+    for _ in range(sweeps):
+        X[services] = _cg_step(counts[services], X[services].copy(), Y, reg, alpha, cg_steps)
+        Y[contractors] = _cg_step(counts_t[contractors], Y[contractors].copy(), X, reg, alpha, cg_steps)
+
+
+def changed_contractors(previous, state, services, contractors, n=10, batch_size=4096):
+    """
+    The contractors whose recommendations can have changed: the ones with new pairs, the ones recommended one of the
+    updated services and the ones for which an updated service now scores above their n-th recommendation. The other
+    services keep their factors, so the other contractors keep their recommendations.
+    :param previous: previous recommendations table (rating, contractor, service)
+    :param state: see load_state, after warm_start
+    :param services: ids of the updated services
+    :param contractors: ids of the updated contractors
+    :return: sorted array of contractor ids
+    """
+    previous = previous.to_pandas()
+    updated = previous['service'].isin(set(state['service_labels'][services].tolist()))
+    grouped = previous.groupby('contractor')
+    summary = pd.DataFrame({'rating': grouped['rating'].min(), 'count': grouped.size(),
+                            'updated': updated.groupby(previous['contractor']).any()}).reset_index()
+    return changed_from_summary(summary, state, services, contractors, n, batch_size)
+
+
+def changed_from_summary(summary, state, services, contractors, n=10, batch_size=4096):
+    """
+    changed_contractors from a summary of the previous recommendations, e.g. aggregated by Spark.
+    :param summary: DataFrame with a row per contractor of the previous recommendations: contractor, rating (the
+        lowest), count (of recommendations) and updated (True if one of the services is an updated one)
+    :return: sorted array of contractor ids
+    """
+    positions = {label: i for i, label in enumerate(state['contractor_labels'].tolist())}
+    ids = summary['contractor'].map(positions)
+    summary = summary[ids.notnull()]
+    ids = ids[ids.notnull()].values.astype(np.int64)
+    changed = np.zeros(len(positions), dtype=bool)
+    changed[contractors] = True
+    changed[ids[summary['updated'].values.astype(bool)]] = True
+
+    # lowest rating kept per contractor, -inf when there are fewer than n recommendations
+    threshold = np.full(len(positions), np.inf, dtype=np.float32)
+    threshold[ids] = np.where(summary['count'].values < n, -np.inf, summary['rating'].values)
+    X = state['service_factors'][services]
+    Y = state['contractor_factors']
+    for start in range(0, len(Y), batch_size):
+        scores = Y[start:start + batch_size] @ X.T
+        changed[start:start + batch_size] |= (scores > threshold[start:start + batch_size, None]).any(axis=1)
+    return np.flatnonzero(changed)
+
+
+def update_recommendations(previous, state, contractors, n=10):
+    """
+    Replaces the recommendations of contractors in the previous table.
+    :return: pyarrow Table (rating, contractor, service)
+    """
+    labels = state['contractor_labels'][contractors]
+    updated = recommendations_table(state['service_factors'], state['contractor_factors'][contractors],
+                                    state['service_labels'], labels, n)
+    kept = previous.to_pandas()
+    kept = kept[~kept['contractor'].isin(set(labels.tolist()))]
+    merged = pd.concat([kept, updated.to_pandas()], ignore_index=True)
+    return pa.Table.from_pandas(merged[['rating', 'contractor', 'service']], preserve_index=False)
@@ -5,29 +5,40 @@
 ##   -m --month (int, default=1) - month to download
 ##   -y --year (int, default=2019) - year to download
 ##   -b --bucket (str, default="1-cca-ted-extracted-dev") - S3 bucket to upload to
+##   -w --workers (int, default=number of cores) - number of processes to parse the XML files with
 
 from ftplib import FTP
 import datetime
 import os
 import urllib.request
-import json
 import boto3
 import tarfile
-import json
 import urllib.request
 import boto3
 import io
+import sys
+
+# the parsing modules live with the Lambda functions
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "serverless"))
+
 import xmltodict
+import columnar
+import parallel_parse
+import xml_stream
 import pandas as pd
 import shutil
 import collections
 import logging
 import argparse
+import resource
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 parser = argparse.ArgumentParser(description='Process parameters')
 parser.add_argument("-m", "--month", help="Month to download", default=1, type=int)
 parser.add_argument("-y", "--year", help="Year to download", default=2019, type=int)
 parser.add_argument("-b", "--bucket", help="S3 bucket to upload to", default='1-cca-ted-extracted-dev', type=str)
+parser.add_argument("-w", "--workers", help="Number of processes to parse with", default=os.cpu_count(), type=int)
 args = parser.parse_args()
 
 month = args.month
@@ -160,6 +171,9 @@ LIST_COLS = ['ORIGINAL_CPV',
  'AWARD_CONTRACT__AWARDED_CONTRACT__VALUES__VAL_TOTAL__CURRENCY',
  'FD_OTH_NOT__TI_DOC']
 
+# path trie of everything that can end up in the output columns, compiled once
+PROJECTION = xml_stream.compile_projection(USE_COLS + LIST_COLS)
+
 # Function download_files:
 # FTPs to ftp_path, gets list of files in the directory for the current year and month (note that this may cause
 # problems on the first day of the month downloading the files from the last day of the previous month); makes a list 
@@ -265,28 +279,6 @@ def extract_files(files, delete_files=True, data_path="/tmp"):
     return extracted_files
 
 
-# convert all currencies to EUR
-def convert_currencies(values, currencies):
-    url = "https://api.exchangeratesapi.io/latest"
-    content = urllib.request.urlopen(url).read()
-    exchange_rates = json.loads(content.decode())
-    results = []
-    
-    for value, currency in zip(values, currencies):
-        if currency == "EUR":
-            results.append(value)
-            
-        else:
-            try:
-                exchange_rate = exchange_rates['rates'][currency]
-                converted_value = float(value) / exchange_rate
-                results.append(converted_value)
-            # if we don't have a rate for the currency use NaN
-            except:
-                results.append(np.nan)
-                
-    return results
-
 def unwind_descriptions(short_desc):
     # get the text from the OrderedDicts in the short descriptions
     for i, foo in enumerate(short_desc):
@@ -391,18 +383,21 @@ def extract_xml(xml_dict, parent_key="", results_dict={}):
     
     return results_dict
 
-## Function load_data - 
-## Params -
-## - data_dir - directory to extract from
-## - language - languages to extract from the XML
-## - doc_type_filter - if specified function will only return XML documents of the specified type
-## Returns - 
-## - dataframe of parsed documents
-def load_data(data_dir, language="EN", doc_type_filter=['Contract award notice', 'Contract notice', 'Additional information']):
+# parse the files with xml_stream on several processes, the workers send back the USE_COLS columns directly
+def parse_streaming(data_dir, language, doc_type_filter, workers=None):
+    xml_files = parallel_parse.list_xml_files(data_dir)
+    builder = parallel_parse.parse_files(xml_files, USE_COLS, LIST_COLS, language, doc_type_filter, PROJECTION,
+                                         workers=workers)
+    
+    return builder
+
+# parse the files with xmltodict and flatten them with extract_xml
+def parse_legacy(data_dir, language, doc_type_filter):
     language_tenders = []
     all_tenders = []
+    builder = columnar.TableBuilder(USE_COLS, LIST_COLS)
     
-    dirs = os.listdir(data_dir)
+    dirs = sorted(os.listdir(data_dir))
     # loop through the files
     for dir_ in dirs:
         try:
@@ -412,7 +407,7 @@ def load_data(data_dir, language="EN", doc_type_filter=['Contract award notice',
             continue
             
         date = dir_.split("_")[0]
-        xml_files = [file for file in files if file.endswith('.xml')]
+        xml_files = [file for file in sorted(files) if file.endswith('.xml')]
         for file in xml_files:
             # read the contents of the file
             # logger.info('Parsing data from %s', file)
@@ -479,8 +474,6 @@ def load_data(data_dir, language="EN", doc_type_filter=['Contract award notice',
     if language == None:
         language_tenders = all_tenders
     
-    parsed_data = []
-    
     # we don't need all tenders anymore, let's delete it
     del(all_tenders)
     
@@ -493,43 +486,29 @@ def load_data(data_dir, language="EN", doc_type_filter=['Contract award notice',
         
         flattened = extract_xml(tender, "", flattened)
         
-        parsed_data.append(flattened)
+        builder.append(flattened)
     
     # clean up unneeded data
     del(language_tenders)
     
-    df = pd.DataFrame(parsed_data)
-    
-    # garbage collecting       
-    del(parsed_data)
-    
-    # try convert Currencies to Euros, some doc types don't have this so it's not a big deal if there's an error
-    try:
-        df['VALUE_EUR'] = convert_currencies(df['VALUES_VALUE'].values, df['VALUES_VALUE_CURRENCY'].values)
-    except:
-        pass
-    
-    return_df = pd.DataFrame(columns=USE_COLS)
-    for col in USE_COLS:
-        try:
-            column_data = df[col].values
-
-            is_list_col = (col in LIST_COLS)
-            for i, item in enumerate(column_data):
-                if is_list_col and not isinstance(item, list):
-                    column_data[i] = [item]
-                elif is_list_col:
-                    column_data[i] = item
-                elif not is_list_col and isinstance(item, list):
-                    column_data[i] = ";".join(item)
-                else:
-                    column_data[i] = item
+    return builder
 
-            return_df[col] = column_data   
-        except:
-            pass
-      
-    return return_df
+## Function load_data - 
+## Params -
+## - data_dir - directory to extract from
+## - language - languages to extract from the XML
+## - doc_type_filter - if specified function will only return XML documents of the specified type
+## - streaming - if True parse the files with xml_stream on several processes instead of xmltodict + extract_xml
+## - workers - number of processes to parse with when streaming, by default one per (v)CPU
+## Returns - 
+## - pyarrow Table of parsed documents with the USE_COLS columns, rows ordered by directory and file name
+def load_data(data_dir, language="EN", doc_type_filter=['Contract award notice', 'Contract notice', 'Additional information'], streaming=True, workers=None):
+    if streaming:
+        builder = parse_streaming(data_dir, language, doc_type_filter, workers)
+    else:
+        builder = parse_legacy(data_dir, language, doc_type_filter)
+    
+    return builder.finish()
 
 prefix = str(year) + str(month).zfill(2)
 year = int(prefix[:4])
@@ -552,14 +531,22 @@ new_files = download_files(data_path=data_path, max_files=30, month=month, year=
         
 extracted_files = extract_files(new_files, delete_files=False, data_path=os.path.join(data_path, "extracted"))
 
+# peak resident memory in MB of this process and of the parsing workers (ru_maxrss is in KB on Linux)
+def peak_memory():
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024)
+
+print("Peak memory before parsing: %.0f MB" % peak_memory()[0])
 print("Parsing XML files from", data_path)
 # load and parse the data
-df = load_data(os.path.join(data_path, "extracted"), language="FR")
+table = load_data(os.path.join(data_path, "extracted"), language="FR", workers=args.workers)
+print("Parsed %d documents, Arrow table %.0f MB" % (table.num_rows, pa.total_allocated_bytes() / 2**20))
+print("Peak memory after parsing: %.0f MB (largest worker %.0f MB)" % peak_memory())
 
 # write to Parquet
 month_file = prefix + "00_ALL.parquet"
 data_file_path = os.path.join(data_path, month_file)
-df.to_parquet(data_file_path)
+pq.write_table(table, data_file_path)
 
 print("Uploading to S3", AWS_BUCKET_NAME)
 # upload to S3
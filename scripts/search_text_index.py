@@ -0,0 +1,35 @@
+## Script to query the full-text index of the notices (see serverless/text_index.py) built by
+## scripts/build_text_index.py: loads the segments of a directory and prints the best notices for a query with their
+## BM25 scores, and the load and search times.
+##
+## Arguments:
+##   -i --input (str) - directory of the segments
+##   -q --query (str) - words to search for
+##   -k --results (int, default=10) - number of notices to print
+##
+## Example:
+##   python scripts/search_text_index.py -i tmp/text_index -q "road maintenance"
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "serverless"))
+
+import text_index
+
+parser = argparse.ArgumentParser(description='Process parameters')
+parser.add_argument("-i", "--input", help="Directory of the segments", required=True, type=str)
+parser.add_argument("-q", "--query", help="Words to search for", required=True, type=str)
+parser.add_argument("-k", "--results", help="Number of notices", default=10, type=int)
+args = parser.parse_args()
+
+start = time.time()
+index = text_index.TextIndex.load([args.input])
+print("%d notices in %d segments, loaded in %.2fs" % (len(index), len(index.segments), time.time() - start))
+start = time.time()
+hits = index.search(args.query, args.results)
+print("%d hits in %.1fms" % (len(hits), 1000 * (time.time() - start)))
+for notice, score in hits:
+    print("%.3f %s" % (score, notice))
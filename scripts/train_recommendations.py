@@ -0,0 +1,124 @@
+## Script to train the contractor recommendations on a single machine (see implicit_als.py) from extracted Parquet
+## files and write them in the format of glue/make_recommendations.py: a Parquet file with rating, contractor and
+## service, the 10 best services of every contractor.
+##
+## With --warm-start the previous state (saved with --state, or by glue/make_recommendations.py) is updated with the new
+## files only: the new services and contractors are appended, a few ALS sweeps re-solve the factors the new pairs
+## touch, starting from the previous ones, and only the contractors whose recommendations can have changed are
+## replaced in the previous recommendations. Files already counted in the state are skipped.
+##
+## Arguments:
+##   -i --input (str, one or more) - extracted Parquet files or directories of Parquet files
+##   -o --output (str, default="recommendations.parquet") - output Parquet file
+##   -f --factors (str, optional) - also save the factors and labels to this .npz file
+##   -s --state (str, optional) - save the counts, factors, labels and input files to this .npz file
+##   -w --warm-start (str, optional) - state .npz file to update with the input files instead of training from scratch
+##   -p --previous (str, default=the output file) - previous recommendations, for --warm-start
+##   --sweeps (int, default=2) - ALS sweeps of a warm start
+##   -c --cpv-level (str, optional) - division, group, class or category: the services are the CPV codes rolled up to
+##     this level (serverless/cpv_hierarchy.py) instead of the CPV texts
+##   -r --rank (int, default=10) - number of latent factors
+##   -n --iterations (int, default=5) - ALS iterations
+##   --reg (float, default=0.01) - regularisation
+##   --alpha (float, default=1.0) - confidence weight of the counts
+##
+## Example:
+##   python scripts/train_recommendations.py -i tmp/2019 -o tmp/recommendations.parquet -s tmp/state.npz
+##   python scripts/train_recommendations.py -i tmp/new_data -o tmp/recommendations.parquet -w tmp/state.npz \
+##     -s tmp/state.npz
+
+import argparse
+import glob
+import os
+import sys
+import time
+
+import numpy as np
+import pyarrow.parquet as pq
+
+import implicit_als
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "serverless"))
+
+import cpv_hierarchy
+
+parser = argparse.ArgumentParser(description='Process parameters')
+parser.add_argument("-i", "--input", help="Extracted Parquet files or directories", nargs="+", required=True, type=str)
+parser.add_argument("-o", "--output", help="Output Parquet file", default="recommendations.parquet", type=str)
+parser.add_argument("-f", "--factors", help="Output .npz file for the factors", default=None, type=str)
+parser.add_argument("-s", "--state", help="Output .npz file for the state", default=None, type=str)
+parser.add_argument("-w", "--warm-start", help="State .npz file to start from", default=None, type=str)
+parser.add_argument("-p", "--previous", help="Previous recommendations Parquet file", default=None, type=str)
+parser.add_argument("--sweeps", help="Number of ALS sweeps of a warm start", default=2, type=int)
+parser.add_argument("-c", "--cpv-level", help="Roll the CPV codes up to this level", default=None, type=str,
+                    choices=cpv_hierarchy.LEVELS)
+parser.add_argument("-r", "--rank", help="Number of latent factors", default=10, type=int)
+parser.add_argument("-n", "--iterations", help="Number of ALS iterations", default=5, type=int)
+parser.add_argument("--reg", help="Regularisation", default=0.01, type=float)
+parser.add_argument("--alpha", help="Confidence weight", default=1.0, type=float)
+args = parser.parse_args()
+
+paths = []
+for path in args.input:
+    paths += sorted(glob.glob(os.path.join(path, "**", "*.parquet"), recursive=True)) if os.path.isdir(path) else [path]
+
+state = implicit_als.load_state(args.warm_start) if args.warm_start else None
+if state is not None:
+    # the state holds packages, like the one of glue/make_recommendations.py
+    counted = set(state['files'])
+    skipped = [path for path in paths if implicit_als.package_name(path) in counted]
+    paths = [path for path in paths if implicit_als.package_name(path) not in counted]
+    if skipped:
+        print("Skipping %d files already in %s" % (len(skipped), args.warm_start))
+
+start = time.time()
+if args.cpv_level:
+    hierarchy = cpv_hierarchy.get_hierarchy()
+    interactions = implicit_als.read_interactions(paths, service_column="ORIGINAL_CPV_CODE",
+                                                  service_map=lambda codes: hierarchy.rollup(codes, args.cpv_level))
+else:
+    interactions = implicit_als.read_interactions(paths)
+if state is None:
+    counts, service_labels, contractor_labels = implicit_als.build_matrix(interactions)
+    print("Read %d pairs from %d files: %d services x %d contractors, %d non-zeros in %.2fs"
+          % (len(interactions), len(paths), counts.shape[0], counts.shape[1], counts.nnz, time.time() - start))
+
+    start = time.time()
+    service_factors, contractor_factors = implicit_als.train(counts, rank=args.rank, iterations=args.iterations,
+                                                             reg=args.reg, alpha=args.alpha)
+    print("Trained in %.2fs" % (time.time() - start))
+
+    table = implicit_als.recommendations_table(service_factors, contractor_factors, service_labels,
+                                               contractor_labels)
+    files = [implicit_als.package_name(path) for path in paths]
+else:
+    services, contractors = implicit_als.add_interactions(state, interactions)
+    print("Read %d new pairs from %d files: %d services and %d contractors touched in %.2fs"
+          % (len(interactions), len(paths), len(services), len(contractors), time.time() - start))
+
+    start = time.time()
+    implicit_als.warm_start(state, services, contractors, sweeps=args.sweeps, reg=args.reg, alpha=args.alpha)
+    print("Updated the factors in %.2fs" % (time.time() - start))
+
+    start = time.time()
+    previous = pq.read_table(args.previous or args.output)
+    changed = implicit_als.changed_contractors(previous, state, services, contractors)
+    table = implicit_als.update_recommendations(previous, state, changed)
+    print("Recomputed the recommendations of %d of %d contractors in %.2fs"
+          % (len(changed), len(state['contractor_labels']), time.time() - start))
+    counts, service_factors, contractor_factors = state['counts'], state['service_factors'], state['contractor_factors']
+    service_labels, contractor_labels = state['service_labels'], state['contractor_labels']
+    files = state['files'] + [implicit_als.package_name(path) for path in paths]
+
+pq.write_table(table, args.output)
+print("Wrote %d recommendations to %s" % (table.num_rows, args.output))
+
+if args.factors:
+    np.savez(args.factors, service_factors=service_factors, contractor_factors=contractor_factors,
+             service_labels=service_labels.astype(str), contractor_labels=contractor_labels.astype(str))
+    print("Wrote the factors to %s" % args.factors)
+
+if args.state:
+    implicit_als.save_state(args.state, counts, service_factors, contractor_factors, service_labels,
+                            contractor_labels, files)
+    print("Wrote the state to %s" % args.state)
@@ -0,0 +1,185 @@
+# Approximate nearest neighbours over the ALS factors, for "contractors similar to X" and "services similar to Y".
+#
+# Brute force is a scan of every factor vector per query. RandomProjectionIndex hashes the normalised vectors with
+# random hyperplanes (the sign pattern of a vector against `bits` planes is its bucket) in several independent tables.
+# A query collects the vectors of its bucket and of the buckets one bit away in every table, at most max_candidates
+# of them, and ranks only those by cosine similarity, so the work per query is bounded whatever the number of
+# vectors. Vectors close in angle share buckets with high probability; more tables give a better recall for more
+# candidates. Only NumPy is needed, so it runs in the API Lambda.
+#
+# Hashing and sorting every vector is the expensive part of a build, so the tables are saved with the index
+# (save_indexes, written by glue/make_recommendations.py next to factors.npz) and a cold start only reads them.
+
+import numpy as np
+
+DEFAULT_TABLES = 8
+# the number of bits is chosen so that a bucket holds about this many vectors
+BUCKET_SIZE = 16
+MAX_BITS = 20
+DEFAULT_MAX_CANDIDATES = 4096
+# the indexes of the API
+KINDS = ('contractor', 'service')
+
+
+def _normalise(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1)
+
+
+class RandomProjectionIndex(object):
+    """
+    Cosine similarity index over labelled vectors.
+    """
+
+    def __init__(self, vectors, labels, planes, order=None, sorted_codes=None):
+        """
+        Use build or load.
+        :param vectors: float32 array (n x dim)
+        :param labels: array of n labels
+        :param planes: float32 array (tables x bits x dim) of hyperplane normals
+        :param order: saved tables (tables x n positions sorted by bucket), computed if None
+        :param sorted_codes: saved tables (tables x n sorted buckets), computed if None
+        """
+        self.labels = np.asarray(labels)
+        self.planes = np.asarray(planes, dtype=np.float32)
+        self._positions = {label: i for i, label in enumerate(self.labels.tolist())}
+        self._weights = np.left_shift(1, np.arange(self.planes.shape[1], dtype=np.int64))
+        if order is None or sorted_codes is None:
+            self.vectors = _normalise(vectors)
+            # per table: the positions of the vectors sorted by bucket, and the sorted buckets to search them
+            codes = self._codes(self.vectors)
+            self._order = np.argsort(codes, axis=1, kind='mergesort')
+            self._sorted_codes = np.take_along_axis(codes, self._order, axis=1)
+        else:
+            # saved by save, already normalised
+            self.vectors = np.asarray(vectors, dtype=np.float32)
+            self._order = np.asarray(order, dtype=np.int64)
+            self._sorted_codes = np.asarray(sorted_codes, dtype=np.int64)
+
+    @classmethod
+    def build(cls, vectors, labels, tables=DEFAULT_TABLES, bits=None, seed=0):
+        """
+        :param vectors: array (n x dim), e.g. the contractor factors
+        :param labels: array of n labels, e.g. the contractor names
+        :param tables: number of hash tables
+        :param bits: bits per table, by default about n / BUCKET_SIZE buckets
+        :return: RandomProjectionIndex
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if bits is None:
+            bits = int(np.clip(np.ceil(np.log2(max(len(vectors), 1) / float(BUCKET_SIZE))), 1, MAX_BITS))
+        planes = np.random.RandomState(seed).randn(tables, bits, vectors.shape[1]).astype(np.float32)
+        return cls(vectors, labels, planes)
+
+    def _codes(self, vectors):
+        # tables x n bucket numbers
+        signs = np.einsum('tbd,nd->tnb', self.planes, vectors) > 0
+        return signs.astype(np.int64) @ self._weights
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __contains__(self, label):
+        return label in self._positions
+
+    def vector(self, label):
+        return self.vectors[self._positions[label]]
+
+    def candidates(self, vector, max_candidates=DEFAULT_MAX_CANDIDATES):
+        """
+        :return: positions of the vectors in the buckets of vector and in the buckets one bit away, the exact buckets
+            of every table first, at most max_candidates
+        """
+        codes = self._codes(_normalise(vector)[None, :])[:, 0]
+        probes = [codes] + [codes ^ weight for weight in self._weights]
+        found = []
+        total = 0
+        for probe in probes:
+            for table, code in enumerate(probe):
+                sorted_codes = self._sorted_codes[table]
+                start, end = np.searchsorted(sorted_codes, code, 'left'), np.searchsorted(sorted_codes, code, 'right')
+                if end > start:
+                    found.append(self._order[table, start:end])
+                    total += end - start
+            if total >= max_candidates:
+                break
+        if not found:
+            return np.zeros(0, dtype=np.int64)
+        found = np.concatenate(found)
+        # np.unique sorts by position, the first occurrences keep the exact buckets ahead of the truncation
+        _, first = np.unique(found, return_index=True)
+        positions = found[np.sort(first)]
+        return positions[:max_candidates] if len(positions) > max_candidates else positions
+
+    def query(self, vector, k=10, max_candidates=DEFAULT_MAX_CANDIDATES, exclude=None):
+        """
+        :param vector: query vector (dim)
+        :param k: number of neighbours
+        :param exclude: label to leave out, e.g. the label of the query
+        :return: list of (label, cosine similarity), most similar first
+        """
+        positions = self.candidates(vector, max_candidates)
+        if exclude is not None and exclude in self._positions:
+            positions = positions[positions != self._positions[exclude]]
+        if not len(positions):
+            return []
+        similarities = self.vectors[positions] @ _normalise(vector)
+        top = np.argsort(-similarities, kind='mergesort')[:k]
+        return [(self.labels[positions[i]].item(), float(similarities[i])) for i in top]
+
+    def similar(self, label, k=10, max_candidates=DEFAULT_MAX_CANDIDATES):
+        """
+        :return: the k labels most similar to label, see query
+        :raise KeyError: if label isn't in the index
+        """
+        return self.query(self.vector(label), k, max_candidates, exclude=label)
+
+    def brute_force(self, vector, k=10):
+        # exact answer, to measure the recall
+        similarities = self.vectors @ _normalise(vector)
+        top = np.argsort(-similarities, kind='mergesort')[:k]
+        return [(self.labels[i].item(), float(similarities[i])) for i in top]
+
+    def _arrays(self):
+        return {'vectors': self.vectors, 'labels': self.labels.astype(str), 'planes': self.planes,
+                'order': self._order, 'sorted_codes': self._sorted_codes}
+
+    def save(self, f):
+        np.savez(f, **self._arrays())
+
+    @classmethod
+    def load(cls, f):
+        with np.load(f) as data:
+            return cls(data['vectors'], data['labels'], data['planes'],
+                       data['order'] if 'order' in data else None,
+                       data['sorted_codes'] if 'sorted_codes' in data else None)
+
+
+def build_indexes(factors):
+    """
+    :param factors: the arrays of factors.npz (service_factors, contractor_factors, service_labels, contractor_labels)
+    :return: {'contractor': RandomProjectionIndex, 'service': RandomProjectionIndex}
+    """
+    return {kind: RandomProjectionIndex.build(factors[kind + '_factors'], factors[kind + '_labels'])
+            for kind in KINDS}
+
+
+def save_indexes(f, indexes):
+    """
+    Saves several indexes to one .npz file, the arrays of each one prefixed with its name.
+    :param indexes: {name: RandomProjectionIndex}
+    """
+    np.savez(f, **{f'{name}_{array}': value
+                   for name, index in indexes.items() for array, value in index._arrays().items()})
+
+
+def load_indexes(f):
+    """
+    :return: {'contractor': RandomProjectionIndex, 'service': RandomProjectionIndex} saved by save_indexes, without
+        rebuilding the tables
+    """
+    with np.load(f) as data:
+        return {kind: RandomProjectionIndex(data[kind + '_vectors'], data[kind + '_labels'], data[kind + '_planes'],
+                                            data[kind + '_order'], data[kind + '_sorted_codes'])
+                for kind in KINDS}
@@ -0,0 +1,142 @@
+# Runs an Athena query and returns its rows as dicts of typed values.
+#
+# recommendations.fetch used to sleep 15 s after starting the query and read a single page of results: every call
+# took at least 15 s, a slower query failed and only the first 1000 rows came back. run_query polls the execution
+# with exponential backoff (starting at POLL_SECONDS, so a fast query returns in a fraction of a second), pages
+# through get_query_results with NextToken and decodes the values with the column types of the result set. The
+# client is a parameter, so it can be a local stub implementing start_query_execution, get_query_execution,
+# get_query_results and stop_query_execution.
+
+from decimal import Decimal
+import logging
+import time
+
+import boto3
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# first wait between two status checks, doubled up to MAX_POLL_SECONDS
+POLL_SECONDS = 0.1
+MAX_POLL_SECONDS = 2.0
+DEFAULT_TIMEOUT = 60
+PAGE_SIZE = 1000
+
+
+class QueryFailed(RuntimeError):
+    """
+    The query ended in the FAILED or CANCELLED state, or didn't finish in time.
+    """
+
+    def __init__(self, query_execution_id, state, reason):
+        super(QueryFailed, self).__init__(f'Query {query_execution_id} {state}: {reason}')
+        self.query_execution_id = query_execution_id
+        self.state = state
+        self.reason = reason
+
+
+def _to_bool(value):
+    return value.lower() == 'true'
+
+
+# Athena type -> decoder of VarCharValue; the other types (varchar, date, timestamp, array, map, ...) stay str
+DECODERS = {
+    'boolean': _to_bool,
+    'tinyint': int,
+    'smallint': int,
+    'integer': int,
+    'bigint': int,
+    'float': float,
+    'real': float,
+    'double': float,
+    'decimal': Decimal,
+}
+
+
+def decode_rows(rows, columns):
+    """
+    :param rows: Rows of a ResultSet (without the header row)
+    :param columns: ColumnInfo of the ResultSetMetadata
+    :return: list of dicts column name -> value, None for NULL
+    """
+    names = [column['Name'] for column in columns]
+    decoders = [DECODERS.get(column['Type'].lower(), str) for column in columns]
+    decoded = []
+    for row in rows:
+        record = {}
+        for name, decoder, datum in zip(names, decoders, row['Data']):
+            value = datum.get('VarCharValue')
+            record[name] = None if value is None else decoder(value)
+        decoded.append(record)
+    return decoded
+
+
+def wait(query_execution_id, athena=None, timeout=DEFAULT_TIMEOUT):
+    """
+    Polls a query until it ends.
+    :raise QueryFailed: if it failed, was cancelled or is still running after timeout seconds (it is then stopped)
+    :return: the QueryExecution of the succeeded query
+    """
+    athena = athena or boto3.client('athena')
+    deadline = time.time() + timeout
+    delay = POLL_SECONDS
+    while True:
+        execution = athena.get_query_execution(QueryExecutionId=query_execution_id)['QueryExecution']
+        state = execution['Status']['State']
+        if state == 'SUCCEEDED':
+            return execution
+        if state in ('FAILED', 'CANCELLED'):
+            raise QueryFailed(query_execution_id, state, execution['Status'].get('StateChangeReason', ''))
+        if time.time() + delay > deadline:
+            athena.stop_query_execution(QueryExecutionId=query_execution_id)
+            raise QueryFailed(query_execution_id, 'TIMEOUT', f'still {state} after {timeout} s')
+        time.sleep(delay)
+        delay = min(delay * 2, MAX_POLL_SECONDS)
+
+
+def results(query_execution_id, athena=None, max_rows=None):
+    """
+    Reads every page of the results of a succeeded query.
+    :param max_rows: stop after this many rows, None for all
+    :return: list of dicts column name -> typed value
+    """
+    athena = athena or boto3.client('athena')
+    records = []
+    kwargs = {'QueryExecutionId': query_execution_id, 'MaxResults': PAGE_SIZE}
+    first_page = True
+    while True:
+        response = athena.get_query_results(**kwargs)
+        rows = response['ResultSet']['Rows']
+        if first_page:
+            # the first row of a SELECT result is the header
+            rows = rows[1:]
+            first_page = False
+        records.extend(decode_rows(rows, response['ResultSet']['ResultSetMetadata']['ColumnInfo']))
+        if 'NextToken' not in response or (max_rows is not None and len(records) >= max_rows):
+            break
+        kwargs['NextToken'] = response['NextToken']
+    return records if max_rows is None else records[:max_rows]
+
+
+def run_query(query, database, output_location, athena=None, timeout=DEFAULT_TIMEOUT, max_rows=None):
+    """
+    Runs a query and waits for its results.
+    :param query: SQL
+    :param database: Glue database
+    :param output_location: s3:// location of the result files
+    :param athena: boto3 Athena client or a stub, a new client by default
+    :param timeout: seconds to wait for the query
+    :param max_rows: stop reading after this many rows, None for all
+    :return: list of dicts column name -> typed value
+    """
+    athena = athena or boto3.client('athena')
+    query_execution_id = athena.start_query_execution(
+        QueryExecutionContext={'Database': database},
+        QueryString=query,
+        ResultConfiguration={'OutputLocation': output_location}
+    )['QueryExecutionId']
+    started = time.time()
+    execution = wait(query_execution_id, athena, timeout)
+    logger.info('Query %s succeeded in %.2f s (%s bytes scanned)', query_execution_id, time.time() - started,
+                execution.get('Statistics', {}).get('DataScannedInBytes'))
+    return results(query_execution_id, athena, max_rows)
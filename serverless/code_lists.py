@@ -0,0 +1,180 @@
+# Code lists of the TED schemas as fixed vocabularies, to write code columns as dictionary-encoded Arrow arrays.
+#
+# The reference data of the extracted columns (country, NUTS, language, document type, procedure ... codes) is only
+# in the enumerations of the XSDs in schemas/, which aren't deployed with the functions. build() reads the
+# enumerations of SOURCES into one array per list and saves them in code_lists.npz next to this module
+# (`python scripts/build_code_lists.py` rebuilds it); get_code_list loads that file once per process, or parses the schemas if there
+# is no file.
+#
+# CodeList.dictionary_encode encodes a column against the fixed vocabulary: the values are int32 indices, and a value
+# of the column is looked up once however many rows hold it. The dictionary of an array only holds the codes it uses,
+# in the order of the vocabulary: Parquet bit-packs the indices of a column chunk with the width its dictionary needs,
+# and writing the whole vocabulary (251 countries for 4 used) was measured to double the size of the column. A value
+# that isn't in the vocabulary (a newer schema release, a typo in a notice) isn't lost: it is appended to the
+# dictionary of that array, with a warning. encode_table does that for several columns of a table; the columns without
+# a code list (the labels of the codes) get the dictionary of their own values.
+
+import logging
+import os
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+import columnar
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+SCHEMA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'schemas')
+INDEX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'code_lists.npz')
+
+# name -> (schema file in SCHEMA_DIR, simple type holding the enumeration)
+SOURCES = {
+    'countries': ('countries.xsd', 't_country_list'),
+    'nuts': ('nuts_codes_2016.xsd', 't_nuts_code_list'),
+    'languages': ('languages.xsd', 't_language_list'),
+    'authority_type': ('common_prod.xsd', 't_AA'),
+    'award_criteria': ('common_prod.xsd', 't_AC'),
+    'main_activities': ('common_prod.xsd', 't_MA'),
+    'contract_nature': ('common_prod.xsd', 't_NC'),
+    'procedure': ('common_prod.xsd', 't_PR'),
+    'regulation': ('common_prod.xsd', 't_RP'),
+    'document_type': ('common_prod.xsd', 't_TD'),
+    'bid_type': ('common_prod.xsd', 't_TY'),
+}
+
+XS = '{http://www.w3.org/2001/XMLSchema}'
+
+
+def read_enumeration(path, type_name):
+    """
+    :param path: XSD file
+    :param type_name: name of the simpleType
+    :return: list of the enumeration values, in the order of the schema
+    """
+    root = ET.parse(path).getroot()
+    for simple_type in root.iter(XS + 'simpleType'):
+        if simple_type.get('name') == type_name:
+            return [enumeration.get('value') for enumeration in simple_type.iter(XS + 'enumeration')]
+    raise KeyError('No simpleType %s in %s' % (type_name, path))
+
+
+class CodeList(object):
+    """
+    Fixed vocabulary of a code column.
+    """
+
+    def __init__(self, values):
+        """
+        :param values: the codes, in the order of the dictionary
+        """
+        self.values = np.asarray(values, dtype=object)
+        self._positions = {value: i for i, value in enumerate(self.values.tolist())}
+
+    def __len__(self):
+        return len(self.values)
+
+    def __contains__(self, value):
+        return value in self._positions
+
+    def position(self, value):
+        """
+        :return: index of value in the vocabulary, -1 if it isn't in it
+        """
+        return self._positions.get(value, -1)
+
+    def encode(self, values):
+        """
+        :param values: sequence of codes (None for missing ones)
+        :return: int32 array of the indices of the values in the vocabulary, -1 for missing and unknown values
+        """
+        ids, uniques = pd.factorize(np.asarray(values, dtype=object))
+        positions = np.array([self.position(value) for value in uniques] + [-1], dtype=np.int32)
+        return positions[ids]
+
+    def dictionary_array(self, indices, values=None):
+        """
+        :param indices: int32 indices into the vocabulary, -1 for null
+        :param values: vocabulary of the indices, self.values by default
+        :return: pyarrow DictionaryArray whose dictionary is the codes of the vocabulary used by indices, in the order
+            of the vocabulary
+        """
+        indices = np.asarray(indices, dtype=np.int32)
+        values = self.values if values is None else values
+        mask = indices < 0
+        used = np.unique(indices[~mask])
+        remap = np.zeros(max(len(values), 1), dtype=np.int32)
+        remap[used] = np.arange(len(used), dtype=np.int32)
+        return pa.DictionaryArray.from_arrays(pa.array(np.where(mask, 0, remap[np.where(mask, 0, indices)]),
+                                                       type=pa.int32(), mask=mask),
+                                              pa.array(values[used].tolist(), type=pa.string()))
+
+    def dictionary_encode(self, values, name=''):
+        """
+        :param values: sequence of codes (None for missing ones)
+        :param name: name of the column, for the warning about unknown values
+        :return: pyarrow DictionaryArray, see dictionary_array; the unknown values come after the codes
+        """
+        ids, uniques = pd.factorize(np.asarray(values, dtype=object))
+        positions = [self.position(value) for value in uniques]
+        unknown = [value for value, position in zip(uniques, positions) if position < 0]
+        if not unknown:
+            return self.dictionary_array(np.array(positions + [-1], dtype=np.int32)[ids])
+        if len(self):
+            logger.warning('%d values of %s not in the code list: %s', len(unknown), name, ', '.join(unknown[:10]))
+        extra = {value: len(self) + i for i, value in enumerate(unknown)}
+        positions = [extra[value] if position < 0 else position for value, position in zip(uniques, positions)]
+        return self.dictionary_array(np.array(positions + [-1], dtype=np.int32)[ids],
+                                     np.concatenate([self.values, np.array(unknown, dtype=object)]))
+
+
+def encode_table(table, columns):
+    """
+    Dictionary-encodes string columns of a table.
+    :param table: pyarrow Table
+    :param columns: column -> name of its code list in SOURCES, or None to use the values of the column as dictionary;
+        the columns missing from table are skipped
+    :return: table with the same columns in the same order
+    """
+    names = list(table.schema.names)
+    arrays = []
+    for i, name in enumerate(names):
+        column = columnar.column_data(table.column(i))
+        if name in columns:
+            code_list = CodeList(()) if columns[name] is None else get_code_list(columns[name])
+            column = code_list.dictionary_encode(column.to_pandas(), name)
+        arrays.append(column)
+    return pa.Table.from_arrays(arrays, names=names)
+
+
+def build(schema_dir=SCHEMA_DIR, path=INDEX_PATH):
+    """
+    Reads the enumerations of SOURCES and saves them to path.
+    :return: dict name -> CodeList
+    """
+    values = {name: read_enumeration(os.path.join(schema_dir, file_name), type_name)
+              for name, (file_name, type_name) in SOURCES.items()}
+    np.savez_compressed(path, **{name: np.array(codes, dtype=str) for name, codes in values.items()})
+    return {name: CodeList(codes) for name, codes in values.items()}
+
+
+_code_lists = None
+
+
+def get_code_list(name):
+    """
+    :param name: key of SOURCES
+    :return: CodeList, the lists are loaded once per process
+    """
+    global _code_lists
+    if _code_lists is None:
+        if os.path.exists(INDEX_PATH):
+            with np.load(INDEX_PATH) as data:
+                _code_lists = {key: CodeList(data[key].tolist()) for key in data.files}
+        else:
+            logger.warning('No %s, reading the code lists from %s', INDEX_PATH, SCHEMA_DIR)
+            _code_lists = {name: CodeList(read_enumeration(os.path.join(SCHEMA_DIR, file_name), type_name))
+                           for name, (file_name, type_name) in SOURCES.items()}
+    return _code_lists[name]
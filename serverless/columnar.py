@@ -0,0 +1,169 @@
+# Builds the output table of load_data column by column while the notices are parsed.
+#
+# load_data used to collect the flattened notices as a list of wide dicts, turn them into a DataFrame and then loop
+# over every cell of USE_COLS in Python to wrap scalars into lists (LIST_COLS) or join lists with ";" (the other
+# columns), copying the data twice more on the way. TableBuilder does that conversion once, when a row is appended,
+# into one buffer per output column:
+#   - string columns: a list of str or None
+#   - list columns: int32 offsets into a flat list of values, like an Arrow ListArray (a missing value is an empty
+#     list, a scalar a list of one value)
+# and finish() turns the buffers into a pyarrow.Table with a fixed schema, so every file has the same columns and
+# types whatever the notices it contains. Builders are plain Python objects, they can be sent back from worker
+# processes and merged in order.
+
+from array import array
+
+import numpy as np
+import pyarrow as pa
+
+
+def column_data(column):
+    """
+    :param column: a column of a table: a Column in pyarrow 0.11 (the Lambda layer), a ChunkedArray in later versions
+    :return: the ChunkedArray of the column; Table.from_arrays takes Arrays and ChunkedArrays together, but not Columns
+        with them, and ignores the names when it gets Columns only
+    """
+    if hasattr(pa, 'Column') and isinstance(column, pa.Column):
+        return column.data
+    return column
+
+
+def list_values(array):
+    """
+    :param array: pyarrow ListArray
+    :return: the values of every list of array, in order, as one Array (ListArray.flatten, which pyarrow 0.11 lacks)
+    """
+    if hasattr(array, 'flatten'):
+        return array.flatten()
+    return pa.array([value for values in array.to_pandas() if values is not None for value in values],
+                    type=array.type.value_type)
+
+
+def valid_mask(array):
+    """
+    :param array: pyarrow Array
+    :return: NumPy bool array, False for the nulls of array (Array.is_valid, which pyarrow 0.11 lacks)
+    """
+    bitmap = array.buffers()[0]
+    if array.null_count == 0 or bitmap is None:
+        return np.ones(len(array), dtype=bool)
+    # the validity bitmap is least significant bit first
+    bits = np.unpackbits(np.frombuffer(bitmap, dtype=np.uint8)).reshape(-1, 8)[:, ::-1].ravel()
+    return bits[array.offset:array.offset + len(array)].astype(bool)
+
+
+def table_schema(columns, list_columns=()):
+    """
+    Schema of the output table: list<string> for the list columns, string for the others.
+    :param columns: output columns, in order
+    :param list_columns: columns that hold lists
+    :return: pyarrow.Schema
+    """
+    list_columns = set(list_columns)
+    return pa.schema([pa.field(column, pa.list_(pa.string()) if column in list_columns else pa.string())
+                      for column in columns])
+
+
+class TableBuilder(object):
+    """
+    Incremental columnar accumulator for flattened notices, see the module comment.
+    """
+
+    def __init__(self, columns, list_columns=()):
+        """
+        :param columns: output columns, in order
+        :param list_columns: columns that hold lists, every other column holds strings
+        """
+        self.columns = list(columns)
+        self.list_columns = [column for column in self.columns if column in set(list_columns)]
+        self.n_rows = 0
+        is_list = set(self.list_columns)
+        self._strings = {column: [] for column in self.columns if column not in is_list}
+        self._values = {column: [] for column in self.list_columns}
+        self._offsets = {column: array('i', [0]) for column in self.list_columns}
+
+    def __len__(self):
+        return self.n_rows
+
+    def append(self, row):
+        """
+        Adds one flattened notice; columns that aren't in the row are null (string) or empty (list).
+        :param row: dict of flattened key -> str or list of str
+        """
+        for column, values in self._strings.items():
+            value = row.get(column)
+            if isinstance(value, list):
+                # empty elements are None, they would be written as "None"
+                value = ';'.join(str(x) for x in value if x is not None) or None
+            elif value is not None and not isinstance(value, str):
+                value = str(value)
+            values.append(value)
+        for column, values in self._values.items():
+            value = row.get(column)
+            if isinstance(value, list):
+                values.extend(value)
+            elif value is not None:
+                values.append(value)
+            self._offsets[column].append(len(values))
+        self.n_rows += 1
+
+    def extend(self, rows):
+        for row in rows:
+            self.append(row)
+
+    def merge(self, other):
+        """
+        Appends the rows of another builder with the same columns.
+        :param other: TableBuilder
+        """
+        for column, values in self._strings.items():
+            values.extend(other._strings[column])
+        for column, values in self._values.items():
+            shift = len(values)
+            values.extend(other._values[column])
+            self._offsets[column].extend(offset + shift for offset in other._offsets[column][1:])
+        self.n_rows += other.n_rows
+
+    def get(self, column):
+        """
+        :param column: string column
+        :return: the values of the column so far (str or None), e.g. to derive another column from it
+        """
+        return self._strings[column]
+
+    def set(self, column, values):
+        """
+        Replaces the values of a string column.
+        :param column: string column
+        :param values: one str or None per row
+        """
+        if len(values) != self.n_rows:
+            raise ValueError("Expected %d values for %s, got %d" % (self.n_rows, column, len(values)))
+        self._strings[column] = [None if value is None else str(value) for value in values]
+
+    def nbytes(self):
+        """
+        :return: approximate size of the buffered data in bytes (string payloads and offsets)
+        """
+        size = 0
+        for values in self._strings.values():
+            size += sum(len(value) for value in values if value is not None)
+        for column, values in self._values.items():
+            size += sum(len(value) for value in values) + 4 * len(self._offsets[column])
+        return size
+
+    def finish(self):
+        """
+        Builds the table; the buffers are released as the columns are converted.
+        :return: pyarrow.Table with table_schema(columns, list_columns)
+        """
+        arrays = []
+        for column in self.columns:
+            if column in self._strings:
+                arrays.append(pa.array(self._strings.pop(column), type=pa.string()))
+            else:
+                offsets = pa.array(np.frombuffer(self._offsets.pop(column), dtype=np.int32), type=pa.int32())
+                values = pa.array(self._values.pop(column), type=pa.string())
+                arrays.append(pa.ListArray.from_arrays(offsets, values))
+        self.n_rows = 0
+        return pa.Table.from_arrays(arrays, names=self.columns)
@@ -0,0 +1,196 @@
+# CPV code hierarchy, to roll code columns up to coarser levels.
+#
+# ORIGINAL_CPV_CODE and MAIN_CPV_CODE hold the ~9,450 leaf codes of schemas/cpv_codes.xsd, too fine for most
+# aggregations and for the service x contractor matrix of the recommender. A CPV code is 8 digits; its division,
+# group, class and category are its first 2, 3, 4 and 5 digits padded with zeros (45213100 -> 45000000, 45200000,
+# 45210000, 45213000). A few of these padded prefixes aren't codes of the list, the ancestor is then the nearest
+# upper level that is.
+#
+# CpvHierarchy keeps the codes as a sorted int32 array and the position of the ancestor of every code at every level
+# in a (codes x 4) array, so an ancestor is a dict lookup and an array index. rollup maps a whole column (pandas,
+# NumPy, Arrow string or list<string> arrays) by mapping its distinct values only and taking the result with the
+# value ids. The XSD is parsed once into cpv_codes.npz (shipped next to this module, scripts/build_cpv_codes.py rebuilds
+# it from the schema); the ancestor arrays are recomputed from the codes when the file is loaded.
+
+import os
+import re
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+import columnar
+
+LEVELS = ('division', 'group', 'class', 'category')
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'schemas', 'cpv_codes.xsd')
+INDEX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cpv_codes.npz')
+
+CODE_LENGTH = 8
+ENUMERATION = re.compile(r'<xs:enumeration value="(\d{8})"\s*/>')
+
+
+def level_number(level):
+    """
+    :param level: 1 to 4 or the name of the level (division, group, class, category)
+    :return: 1 to 4
+    """
+    if isinstance(level, str):
+        if level.lower() not in LEVELS:
+            raise ValueError('Unknown CPV level %s, expected one of %s' % (level, ', '.join(LEVELS)))
+        return LEVELS.index(level.lower()) + 1
+    if not 1 <= level <= len(LEVELS):
+        raise ValueError('CPV level must be between 1 and %d, not %s' % (len(LEVELS), level))
+    return level
+
+
+def _prefix(codes, level):
+    # the first level + 1 digits padded with zeros
+    scale = 10 ** (CODE_LENGTH - level - 1)
+    return (codes // scale) * scale
+
+
+class CpvHierarchy(object):
+    """
+    Ancestors of the CPV codes at the division, group, class and category levels.
+    """
+
+    def __init__(self, codes):
+        """
+        :param codes: CPV codes as integers or 8 digit strings
+        """
+        self.codes = np.unique(np.asarray(codes).astype(np.int32))
+        self.labels = np.array(['%08d' % code for code in self.codes.tolist()], dtype=object)
+        self._positions = {label: i for i, label in enumerate(self.labels.tolist())}
+        self.ancestors = np.full((len(self.codes), len(LEVELS)), -1, dtype=np.int32)
+        for level in range(1, len(LEVELS) + 1):
+            prefixes = _prefix(self.codes, level)
+            positions = np.minimum(np.searchsorted(self.codes, prefixes), len(self.codes) - 1)
+            found = self.codes[positions] == prefixes
+            self.ancestors[:, level - 1] = np.where(found, positions, -1)
+            if level > 1:
+                # padded prefix that isn't a code: the ancestor of the level above
+                missing = self.ancestors[:, level - 1] < 0
+                self.ancestors[missing, level - 1] = self.ancestors[missing, level - 2]
+
+    @classmethod
+    def from_xsd(cls, path=SCHEMA_PATH):
+        with open(path, encoding='utf-8') as f:
+            return cls([int(code) for code in ENUMERATION.findall(f.read())])
+
+    @classmethod
+    def load(cls, path=INDEX_PATH):
+        with np.load(path) as data:
+            return cls(data['codes'])
+
+    def save(self, path=INDEX_PATH):
+        np.savez_compressed(path, codes=self.codes)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __contains__(self, code):
+        return code in self._positions
+
+    def _position(self, code):
+        position = self._positions.get(code)
+        if position is None and isinstance(code, str):
+            # codes are sometimes written with their check digit, 45213100-4
+            position = self._positions.get(code.strip().split('-')[0])
+        return position
+
+    def ancestor(self, code, level):
+        """
+        :param code: 8 digit CPV code
+        :param level: see level_number
+        :return: the code of the ancestor at level (the code itself if it is at that level or above), None if the code
+            is unknown and its division too
+        """
+        level = level_number(level)
+        position = self._position(code)
+        if position is not None:
+            ancestor = self.ancestors[position, level - 1]
+            return None if ancestor < 0 else self.labels[ancestor]
+        # not in the list: the nearest padded prefix that is
+        digits = str(code).strip().split('-')[0]
+        if len(digits) != CODE_LENGTH or not digits.isdigit():
+            return None
+        for upper in range(level, 0, -1):
+            prefix = '%08d' % _prefix(int(digits), upper)
+            if prefix in self._positions:
+                return prefix
+        return None
+
+    def lineage(self, code):
+        """
+        :return: list of the ancestors of code from the division to the category, see ancestor
+        """
+        return [self.ancestor(code, level) for level in range(1, len(LEVELS) + 1)]
+
+    def _rollup_values(self, values, level):
+        # maps the distinct values only, None stays None
+        ids, uniques = pd.factorize(np.asarray(values, dtype=object))
+        mapped = np.array([self.ancestor(code, level) for code in uniques] + [None], dtype=object)
+        return mapped[ids]
+
+    def rollup(self, values, level):
+        """
+        Rolls a column of CPV codes up to a level, unknown codes become None.
+        :param values: pandas Series, NumPy array or list of codes, pyarrow string Array, list<string> Array (every
+            code of the lists, the lists keep their lengths and the null lists stay null) or ChunkedArray / Column of
+            these
+        :param level: see level_number
+        :return: the rolled up codes, of the same kind as values (a NumPy object array for a list)
+        """
+        level = level_number(level)
+        values = columnar.column_data(values)
+        if isinstance(values, pa.ChunkedArray):
+            return pa.chunked_array([self.rollup(chunk, level) for chunk in values.chunks], type=values.type)
+        if isinstance(values, pa.ListArray):
+            if len(values) == 0:
+                return pa.array([], type=pa.list_(pa.string()))
+            offsets = np.frombuffer(values.buffers()[1], dtype=np.int32)[values.offset:values.offset + len(values) + 1]
+            # list_values leaves out the values of the null lists, a null offset makes its list null
+            valid = columnar.valid_mask(values)
+            lengths = np.where(valid, np.diff(offsets), 0)
+            flat = self._rollup_values(columnar.list_values(values).to_pandas(), level)
+            return pa.ListArray.from_arrays(
+                pa.array(np.concatenate([[0], np.cumsum(lengths)]).astype(np.int32), type=pa.int32(),
+                         mask=np.append(~valid, False)),
+                pa.array(flat.tolist(), type=pa.string()))
+        if isinstance(values, pa.Array):
+            return pa.array(self._rollup_values(values.to_pandas(), level).tolist(), type=pa.string())
+        if isinstance(values, pd.Series):
+            return pd.Series(self._rollup_values(values.values, level), index=values.index, name=values.name)
+        return self._rollup_values(values, level)
+
+    def add_rollup_columns(self, table, columns, levels):
+        """
+        :param table: pyarrow Table
+        :param columns: CPV code columns of table to roll up
+        :param levels: levels to roll them up to
+        :return: table with a <column>__<LEVEL> column per column and level, e.g. MAIN_CPV_CODE__DIVISION
+        """
+        # from_arrays takes Arrays and ChunkedArrays, not a mix with the Columns of pyarrow 0.11
+        arrays = [columnar.column_data(table.column(i)) for i in range(table.num_columns)]
+        names = list(table.schema.names)
+        for column in columns:
+            values = arrays[table.schema.names.index(column)]
+            for level in levels:
+                level = level_number(level)
+                arrays.append(self.rollup(values, level))
+                names.append('%s__%s' % (column, LEVELS[level - 1].upper()))
+        return pa.Table.from_arrays(arrays, names=names)
+
+
+_hierarchy = None
+
+
+def get_hierarchy():
+    """
+    The hierarchy of INDEX_PATH, or of the schema if there is no index file, loaded once per process.
+    :return: CpvHierarchy
+    """
+    global _hierarchy
+    if _hierarchy is None:
+        _hierarchy = CpvHierarchy.load() if os.path.exists(INDEX_PATH) else CpvHierarchy.from_xsd()
+    return _hierarchy
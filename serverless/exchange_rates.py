@@ -0,0 +1,211 @@
+# Dated euro exchange rates for the VALUE_EUR column.
+#
+# convert_currencies used to fetch today's rates from an API on every load_data call, so the extraction blocked on
+# the network and a notice from 2011 was converted with the current rate. The rates now come from a local snapshot of
+# the ECB reference rate history (eurofxref-hist.csv: one row per business day, one column per currency, units of
+# currency for 1 EUR, "N/A" where there is no rate), loaded once per process and kept for CACHE_TTL seconds.
+#
+# The snapshot is looked up at EXCHANGE_RATES_PATH (default /tmp/exchange_rates.csv, writable on Lambda) and then
+# next to this module (exchange_rates.csv, to ship one with the deployment). Unless EXCHANGE_RATES_OFFLINE=1, a
+# snapshot older than CACHE_TTL is refreshed from the ECB with a short timeout; if that fails the old snapshot is
+# used. In offline mode nothing is ever downloaded and, without a snapshot, only EUR values are converted.
+#
+# Conversion is vectorised: values are parsed to floats by typed_columns.parse_numbers (so "1 234,50" gives the same
+# amount as in the typed VALUES__VALUE column), currencies mapped to rate columns and notice dates to the last
+# business day on or before them with numpy.searchsorted.
+
+import csv
+import io
+import logging
+import os
+import time
+import urllib.request
+import zipfile
+
+import numpy as np
+
+import typed_columns
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+ECB_HISTORY_URL = 'https://www.ecb.europa.eu/stats/eurofxref/eurofxref-hist.zip'
+SNAPSHOT_PATH = os.environ.get('EXCHANGE_RATES_PATH', '/tmp/exchange_rates.csv')
+BUNDLED_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'exchange_rates.csv')
+OFFLINE = os.environ.get('EXCHANGE_RATES_OFFLINE', '0') == '1'
+
+# seconds a loaded table (and a snapshot on disk) is considered fresh
+CACHE_TTL = 24 * 3600
+# seconds to wait for the ECB before falling back to the snapshot
+DOWNLOAD_TIMEOUT = 10
+
+
+class RateTable(object):
+    """
+    Exchange rates by date and currency, in units of currency for 1 EUR.
+    """
+
+    def __init__(self, dates, currencies, rates):
+        """
+        :param dates: sorted int64 array of dates as YYYYMMDD
+        :param currencies: list of currency codes, one per column of rates
+        :param rates: float64 array (dates x currencies), NaN where there is no rate
+        """
+        self.dates = dates
+        self.currencies = list(currencies)
+        self.rates = _forward_fill(rates)
+        self._index = {currency: i for i, currency in enumerate(self.currencies)}
+
+    @classmethod
+    def from_csv(cls, f):
+        """
+        Reads rates in the ECB history format (Date,USD,JPY,...; dates as YYYY-MM-DD, in any order).
+        :param f: path or text file object
+        :return: RateTable
+        """
+        if isinstance(f, str):
+            with io.open(f, 'r', encoding='utf-8') as file:
+                return cls.from_csv(file)
+        reader = csv.reader(f)
+        header = next(reader)
+        # the ECB file ends every line with a comma
+        currencies = [currency.strip() for currency in header[1:] if currency.strip()]
+        dates = []
+        rows = []
+        for line in reader:
+            if not line or not line[0].strip():
+                continue
+            dates.append(int(line[0].strip().replace('-', '')))
+            rows.append([_to_float(value) for value in line[1:len(currencies) + 1]])
+        dates = np.array(dates, dtype=np.int64)
+        rates = np.array(rows, dtype=np.float64).reshape(len(dates), len(currencies))
+        order = np.argsort(dates, kind='mergesort')
+        return cls(dates[order], currencies, rates[order])
+
+    def to_eur(self, values, currencies, dates):
+        """
+        Converts amounts to EUR with the rate of the notice date (or the last business day before it).
+        :param values: amounts as str, float or None
+        :param currencies: currency codes, one per value
+        :param dates: notice dates as 'YYYYMMDD', one per value
+        :return: float64 array, NaN where the amount, currency or rate is unknown
+        """
+        amounts = parse_amounts(values)
+        currencies = _as_strings(currencies)
+        currency_codes, inverse = np.unique(currencies, return_inverse=True)
+        columns = np.array([self._index.get(code, -1) for code in currency_codes], dtype=np.int64)[inverse]
+        rows = np.searchsorted(self.dates, _parse_dates(dates), side='right') - 1
+
+        known = (columns >= 0) & (rows >= 0)
+        rates = np.full(len(amounts), np.nan)
+        rates[known] = self.rates[rows[known], columns[known]]
+        rates[currencies == 'EUR'] = 1.0
+        return amounts / rates
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _forward_fill(rates):
+    # a currency that isn't quoted on a day keeps its previous rate
+    rates = np.array(rates, dtype=np.float64)
+    for j in range(rates.shape[1] if rates.ndim == 2 else 0):
+        column = rates[:, j]
+        valid = ~np.isnan(column)
+        index = np.where(valid, np.arange(len(column)), 0)
+        np.maximum.accumulate(index, out=index)
+        filled = column[index]
+        # before the first quote there is nothing to carry forward
+        filled[np.cumsum(valid) == 0] = np.nan
+        rates[:, j] = filled
+    return rates
+
+
+def _as_strings(values):
+    # fixed width unicode, so numpy.unique and the comparisons run in C
+    return np.array(['' if not isinstance(value, str) else value for value in values], dtype=np.str_)
+
+
+def parse_amounts(values):
+    """
+    Parses amounts like the typed VALUES__VALUE column, see typed_columns.parse_numbers.
+    :param values: amounts as str, float or None
+    :return: float64 array, NaN for missing or malformed amounts
+    """
+    texts = [value if value is None or isinstance(value, str) else str(value) for value in values]
+    return typed_columns.parse_numbers(texts)[0]
+
+
+def _parse_dates(dates):
+    dates = _as_strings(dates)
+    try:
+        return dates.astype(np.int64)
+    except ValueError:
+        parsed = parse_amounts([date[:8] for date in dates])
+        # unknown dates sort before every rate and get no rate
+        parsed[np.isnan(parsed)] = -1
+        return parsed.astype(np.int64)
+
+
+def download_snapshot(path=SNAPSHOT_PATH, url=ECB_HISTORY_URL, timeout=DOWNLOAD_TIMEOUT):
+    """
+    Downloads the ECB rate history and saves it as the snapshot.
+    :param path: where to write the CSV
+    :return: path
+    """
+    content = urllib.request.urlopen(url, timeout=timeout).read()
+    with zipfile.ZipFile(io.BytesIO(content)) as archive:
+        data = archive.read(archive.namelist()[0])
+    # write next to the target and rename, a reader never sees half a file
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return path
+
+
+def _snapshot_path():
+    for path in (SNAPSHOT_PATH, BUNDLED_PATH):
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def load_rate_table(offline=OFFLINE):
+    """
+    Loads the rates from the snapshot, refreshing it first if it is stale and offline is False.
+    :return: RateTable, empty if there is no snapshot
+    """
+    path = _snapshot_path()
+    if not offline and (path is None or time.time() - os.path.getmtime(path) > CACHE_TTL):
+        try:
+            path = download_snapshot()
+        except Exception:
+            logger.warning('Could not refresh the exchange rates, using %s', path)
+    if path is None:
+        logger.warning('No exchange rate snapshot, only EUR values will be converted')
+        return RateTable(np.zeros(0, dtype=np.int64), [], np.zeros((0, 0)))
+    return RateTable.from_csv(path)
+
+
+_cache = {'table': None, 'loaded': 0.0}
+
+
+def get_rate_table(offline=OFFLINE, ttl=CACHE_TTL):
+    """
+    Rate table cached in the process (e.g. across invocations of a warm Lambda container) for ttl seconds.
+    :return: RateTable
+    """
+    if _cache['table'] is None or time.time() - _cache['loaded'] > ttl:
+        _cache['table'] = load_rate_table(offline)
+        _cache['loaded'] = time.time()
+    return _cache['table']
+
+
+def clear_cache():
+    _cache['table'] = None
+    _cache['loaded'] = 0.0
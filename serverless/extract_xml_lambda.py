@@ -1,14 +1,20 @@
 import json
 import numpy as np
 import collections
-import datetime
 import os
-import tarfile
-import urllib.request
 import boto3
 import io
 import xmltodict
-import pandas as pd
+import code_lists
+import columnar
+import cpv_hierarchy
+import exchange_rates
+import parallel_parse
+import regions
+import typed_columns
+import xml_stream
+import pyarrow as pa
+import pyarrow.parquet as pq
 import shutil
 import logging
 
@@ -141,72 +147,46 @@ LIST_COLS = ['ORIGINAL_CPV',
  'AWARD_CONTRACT__AWARDED_CONTRACT__VALUES__VAL_TOTAL',
  'AWARD_CONTRACT__AWARDED_CONTRACT__VALUES__VAL_TOTAL__CURRENCY',
  'FD_OTH_NOT__TI_DOC']
- 
-def download_file(event):
-    objects = event['Records']
-    
-    downloaded_files = []
-    
-    for object_ in objects:
-        key = object_['s3']['object']['key']
-        bucket = object_['s3']['bucket']['name']
-        logger.info('Downloading %s from %s', key, bucket)
-    
-        file_name = key.split("/")[-1]
-    
-        s3.Bucket(bucket).download_file(key, os.path.join("/tmp", file_name))
-        
-        downloaded_files.append(os.path.join("/tmp", file_name))
-        logger.info('Finished downloading %s from %s', key, bucket)
-        
-    return downloaded_files
 
-def extract_files(files, delete_files=True, data_path="/tmp"):
-    extracted_files = []
-    
-    for file in files:
-        print("\nExtracting:", file)
-        try:
-            if (file.endswith("tar.gz")):
-                tar = tarfile.open(file, "r:gz")
-                tar.extractall(data_path)
-                tar.close()
-            elif (file.endswith("tar")):
-                tar = tarfile.open(file, "r:")
-                tar.extractall()
-                tar.close()
-            
-            extracted_files.append(file)
-            if delete_files:
-                # if everything was properly extracted we can delete the file
-                os.remove(file)
-        except:
-            logger.error("Error extracting %s", file)
-            
-    return extracted_files
+# additional columns containing the first item of some of the list columns
+MAIN_COLS = collections.OrderedDict([
+ ('MAIN_CPV_CODE', 'ORIGINAL_CPV_CODE'),
+ ('MAIN_n2016:TENDERER_NUTS__CODE', 'n2016:TENDERER_NUTS__CODE'),
+ ('MAIN_n2016:PERFORMANCE_NUTS__CODE', 'n2016:PERFORMANCE_NUTS__CODE'),
+ ('MAIN_MA_MAIN_ACTIVITIES__CODE', 'MA_MAIN_ACTIVITIES__CODE'),
+ ('MAIN_OBJECT_CONTRACT__OBJECT_DESCR__DURATION', 'OBJECT_CONTRACT__OBJECT_DESCR__DURATION'),
+ ('MAIN_AWARD_CONTRACT__AWARDED_CONTRACT__CONTRACTORS__CONTRACTOR__ADDRESS_CONTRACTOR__COUNTRY__VALUE', 'AWARD_CONTRACT__AWARDED_CONTRACT__CONTRACTORS__CONTRACTOR__ADDRESS_CONTRACTOR__COUNTRY__VALUE')])
 
-# convert all currencies to EUR
-def convert_currencies(values, currencies):
-    url = "https://api.exchangeratesapi.io/latest"
-    content = urllib.request.urlopen(url).read()
-    exchange_rates = json.loads(content.decode())
-    results = []
-    
-    for value, currency in zip(values, currencies):
-        if currency == "EUR":
-            results.append(value)
-            
-        else:
-            try:
-                exchange_rate = exchange_rates['rates'][currency]
-                converted_value = float(value) / exchange_rate
-                results.append(str(converted_value))
-            # if we don't have a rate for the currency use NaN
-            except:
-                results.append("")
-                
-    return results
+# columns of the output table, the schema is the same for every file (build_table parses the typed_columns.TYPED_COLS
+# to numbers and dates, adds a PARSE_ERRORS column and dictionary-encodes CATEGORICAL_COLS)
+OUTPUT_COLS = USE_COLS + list(MAIN_COLS.keys())
+SCHEMA = columnar.table_schema(OUTPUT_COLS, LIST_COLS)
+
+# columns written dictionary-encoded, the codes over the vocabulary of their XSD enumeration (code_lists.SOURCES), the
+# labels (None) over the values of the file
+CATEGORICAL_COLS = collections.OrderedDict([
+ ('AA_AUTHORITY_TYPE', None), ('AA_AUTHORITY_TYPE__CODE', 'authority_type'),
+ ('AC_AWARD_CRIT', None), ('AC_AWARD_CRIT__CODE', 'award_criteria'),
+ ('NC_CONTRACT_NATURE', None), ('NC_CONTRACT_NATURE__CODE', 'contract_nature'),
+ ('PR_PROC', None), ('PR_PROC__CODE', 'procedure'),
+ ('RP_REGULATION', None), ('RP_REGULATION__CODE', 'regulation'),
+ ('TD_DOCUMENT_TYPE', None), ('TD_DOCUMENT_TYPE__CODE', 'document_type'),
+ ('TY_TYPE_BID', None), ('TY_TYPE_BID__CODE', 'bid_type'),
+ ('LG', 'languages'),
+ ('ISO_COUNTRY__VALUE', 'countries')])
+
+# CPV code columns rolled up to the levels of CPV_ROLLUP_LEVELS (e.g. "division,group"), each level adds a
+# <column>__<LEVEL> column after the SCHEMA columns; none by default
+CPV_ROLLUP_COLS = ['MAIN_CPV_CODE', 'ORIGINAL_CPV_CODE']
+CPV_ROLLUP_LEVELS = [level for level in os.environ.get('CPV_ROLLUP_LEVELS', '').split(',') if level]
 
+# add the country and NUTS 1 to 3 of the NUTS code columns (regions.NUTS_COLUMNS) as dictionary-encoded columns,
+# ENRICH_REGIONS=0 to leave them out
+ENRICH_REGIONS = os.environ.get('ENRICH_REGIONS', '1') == '1'
+
+# path trie of everything that can end up in the output columns, compiled once per container
+PROJECTION = xml_stream.compile_projection(USE_COLS + LIST_COLS)
+ 
 def unwind_descriptions(short_desc):
     # get the text from the OrderedDicts in the short descriptions
     for i, foo in enumerate(short_desc):
@@ -311,27 +291,56 @@ def extract_xml(xml_dict, parent_key="", results_dict={}):
     
     return results_dict
     
+# older documents have the value in different columns, we should catch those
+def fix_values(flattened):
+    if "VALUES_LIST__VALUES__SINGLE_VALUE__VALUE" in flattened and "VALUES__VALUE" not in flattened:
+        flattened['VALUES__VALUE'] = flattened['VALUES_LIST__VALUES__SINGLE_VALUE__VALUE']
+        flattened['VALUES__VALUE__CURRENCY'] = flattened['VALUES_LIST__VALUES__SINGLE_VALUE__VALUE__CURRENCY']
+    elif "VALUES_LIST__VALUES__RANGE_VALUE__VALUE" in flattened and "VALUES__VALUE" not in flattened:
+        flattened['VALUES__VALUE'] = flattened['VALUES_LIST__VALUES__RANGE_VALUE__VALUE'][0]
+        flattened['VALUES__VALUE__CURRENCY'] = flattened['VALUES_LIST__VALUES__RANGE_VALUE__VALUE__CURRENCY'][0]
+    return flattened
+
+# fix the values and add the MAIN_ columns, applied to every flattened document before it goes into the table
+def prepare_row(flattened):
+    flattened = fix_values(flattened)
+    for main_col, col in MAIN_COLS.items():
+        if col in flattened:
+            value = flattened[col]
+            flattened[main_col] = value[0] if isinstance(value, list) else value
+    return flattened
+
 data_path = "/tmp"
 
-## Function load_data - 
-## Params -
-## - data_dir - directory to extract from
-## - language - languages to extract from the XML
-## - doc_type_filter - if specified function will only return XML documents of the specified type
-## Returns - 
-## - dataframe of parsed documents
-def load_data(data_dir, language="EN", doc_type_filter=['Contract award notice', 'Contract notice', 'Contract award', 'Additional information']):
+# parse the files with xml_stream on several processes, the workers send back the USE_COLS columns directly
+def parse_streaming(data_dir, language, doc_type_filter, projected=True, workers=None):
+    projection = PROJECTION if projected else None
+    xml_files = parallel_parse.list_xml_files(data_dir)
+    builder = parallel_parse.parse_files(xml_files, OUTPUT_COLS, LIST_COLS, language, doc_type_filter, projection,
+                                         row_hook=prepare_row, header_fields=('DATE', 'YEAR', 'FILE'),
+                                         workers=workers)
+    
+    # delete the directories we just read from to avoid conflicts and duplicates
+    for dir_ in os.listdir(data_dir):
+        if os.path.isdir(os.path.join(data_dir, dir_)):
+            shutil.rmtree(os.path.join(data_dir, dir_))
+    
+    return builder
+
+# parse the files with xmltodict and flatten them with extract_xml
+def parse_legacy(data_dir, language, doc_type_filter):
     language_tenders = []
     all_tenders = []
+    builder = columnar.TableBuilder(OUTPUT_COLS, LIST_COLS)
         
     # loop through the files
-    for dir_ in os.listdir(data_dir):
+    for dir_ in sorted(os.listdir(data_dir)):
         try:
             files = os.listdir(os.path.join(data_dir, dir_))
         except:
             continue
         date = dir_.split("_")[0]
-        xml_files = [file for file in files if file.endswith('.xml')]
+        xml_files = [file for file in sorted(files) if file.endswith('.xml')]
         for file in xml_files:
             # read the contents of the file
             # logger.info('Parsing data from %s', file)
@@ -400,8 +409,6 @@ def load_data(data_dir, language="EN", doc_type_filter=['Contract award notice',
     if language == None:
         language_tenders = all_tenders
     
-    parsed_data = []
-    
     # we don't need all tenders anymore, let's delete it
     del(all_tenders)
     
@@ -414,108 +421,99 @@ def load_data(data_dir, language="EN", doc_type_filter=['Contract award notice',
         
         flattened = extract_xml(tender, "", flattened)
         
-        # older documents have the value in different columns, we should catch those
-        if "VALUES_LIST__VALUES__SINGLE_VALUE__VALUE" in flattened and "VALUES__VALUE" not in flattened:
-            flattened['VALUES__VALUE'] = flattened['VALUES_LIST__VALUES__SINGLE_VALUE__VALUE']
-            flattened['VALUES__VALUE__CURRENCY'] = flattened['VALUES_LIST__VALUES__SINGLE_VALUE__VALUE__CURRENCY']
-        elif "VALUES_LIST__VALUES__RANGE_VALUE__VALUE" in flattened and "VALUES__VALUE" not in flattened:
-            flattened['VALUES__VALUE'] = flattened['VALUES_LIST__VALUES__RANGE_VALUE__VALUE'][0]
-            flattened['VALUES__VALUE__CURRENCY'] = flattened['VALUES_LIST__VALUES__RANGE_VALUE__VALUE__CURRENCY'][0]
-        parsed_data.append(flattened)
+        builder.append(prepare_row(flattened))
         
     # clean up unneeded data
     del(language_tenders)
     
-    df = pd.DataFrame(parsed_data)
+    return builder
+
+## Function load_data - 
+## Params -
+## - data_dir - directory to extract from
+## - language - languages to extract from the XML
+## - doc_type_filter - if specified function will only return XML documents of the specified type
+## - streaming - if True parse and flatten the files in one pass with xml_stream instead of xmltodict + extract_xml
+## - projected - if True (and streaming) only parse the paths that feed USE_COLS and skip everything else
+## - workers - number of processes to parse with when streaming, by default one per (v)CPU
+## Returns - 
+## - pyarrow Table of parsed documents with the SCHEMA columns, rows ordered by directory and file name
+def load_data(data_dir, language="EN", doc_type_filter=['Contract award notice', 'Contract notice', 'Contract award', 'Additional information'], streaming=True, projected=True, workers=None):
+    if streaming:
+        builder = parse_streaming(data_dir, language, doc_type_filter, projected, workers)
+    else:
+        builder = parse_legacy(data_dir, language, doc_type_filter)
     
-    # garbage collecting       
-    del(parsed_data)
+    return build_table(builder)
+
+## Function load_data_from_archives - 
+## Params -
+## - fileobjs - file-like objects with the content of the daily packages (tar.gz), e.g. S3 get_object bodies
+## - language - languages to extract from the XML
+## - doc_type_filter - if specified function will only return XML documents of the specified type
+## - projected - if True only parse the paths that feed USE_COLS and skip everything else
+## - workers - number of processes to parse with, by default one per (v)CPU
+## Returns - 
+## - pyarrow Table of parsed documents, same as extract_files + load_data but nothing is written to disk
+def load_data_from_archives(fileobjs, language="EN", doc_type_filter=['Contract award notice', 'Contract notice', 'Contract award', 'Additional information'], projected=True, workers=None):
+    projection = PROJECTION if projected else None
+    builder = parallel_parse.parse_archives(fileobjs, OUTPUT_COLS, LIST_COLS, language, doc_type_filter, projection,
+                                            row_hook=prepare_row, header_fields=('DATE', 'YEAR', 'FILE'),
+                                            workers=workers)
     
+    return build_table(builder)
+
+# convert the currencies and turn the column buffers into the typed output table
+def build_table(builder):
     # try convert Currencies to Euros, some doc types don't have this so it's not a big deal if there's an error
     try:
-        df['VALUE_EUR'] = convert_currencies(df['VALUES__VALUE'].values, df['VALUES__VALUE__CURRENCY'].values)
+        value_eur = convert_currencies(builder.get('VALUES__VALUE'), builder.get('VALUES__VALUE__CURRENCY'), builder.get('DATE'))
     except:
         logger.error("Error converting currencies")
-        
-    return_df = pd.DataFrame(columns=USE_COLS)
-    for col in USE_COLS:
-        # catch the possibility that the column doesn't exist in the dataframe
-        try:
-            column_data = df[col].values
-
-            is_list_col = (col in LIST_COLS)
-            for i, item in enumerate(column_data):
-                # if the column should be a list
-                if is_list_col:
-                    # if it is a list nothing needs to be done
-                    if isinstance(item, list):
-                        column_data[i] = list(item)
-                    # else if it is not a list make it into a list
-                    else:
-                        column_data[i] = [item]                   
-                # if the column should NOT be a list
-                else:
-                    # if it is NOT a list make sure it is a string
-                    if not isinstance(item, list):
-                        column_data[i] = item
-                    # else if it IS a list
-                    else:
-                        column_data[i] = ';'.join(str(x) for x in item)
-
-            return_df[col] = column_data   
-        except:
-            pass
-    
-    # add some additional columns containing the first items in some of the list columns
-    # if there is an error the column is not a list so just use the value in it
-    try:
-        return_df['MAIN_CPV_CODE'] = return_df['ORIGINAL_CPV_CODE'].map(lambda x: x[0])
-    except:
-        return_df['MAIN_CPV_CODE'] = return_df['ORIGINAL_CPV_CODE']
-    try:
-        return_df['MAIN_n2016:TENDERER_NUTS__CODE'] = return_df['n2016:TENDERER_NUTS__CODE'].map(lambda x: x[0])
-    except:
-        return_df['MAIN_n2016:TENDERER_NUTS__CODE'] = return_df['n2016:TENDERER_NUTS__CODE']
-    try:
-        return_df['MAIN_n2016:PERFORMANCE_NUTS__CODE'] = return_df['n2016:PERFORMANCE_NUTS__CODE'].map(lambda x: x[0])
-    except:
-        return_df['MAIN_n2016:PERFORMANCE_NUTS__CODE'] = return_df['n2016:PERFORMANCE_NUTS__CODE']
-    try:
-        return_df['MAIN_MA_MAIN_ACTIVITIES__CODE'] = return_df['MA_MAIN_ACTIVITIES__CODE'].map(lambda x: x[0])
-    except:
-        return_df['MAIN_MA_MAIN_ACTIVITIES__CODE'] = return_df['MA_MAIN_ACTIVITIES__CODE']
-    try:    
-        return_df['MAIN_OBJECT_CONTRACT__OBJECT_DESCR__DURATION'] = return_df['OBJECT_CONTRACT__OBJECT_DESCR__DURATION'].map(lambda x: x[0])
-    except:
-        return_df['MAIN_OBJECT_CONTRACT__OBJECT_DESCR__DURATION'] = return_df['OBJECT_CONTRACT__OBJECT_DESCR__DURATION']
-    try:    
-        return_df['MAIN_AWARD_CONTRACT__AWARDED_CONTRACT__CONTRACTORS__CONTRACTOR__ADDRESS_CONTRACTOR__COUNTRY__VALUE'] = return_df['AWARD_CONTRACT__AWARDED_CONTRACT__CONTRACTORS__CONTRACTOR__ADDRESS_CONTRACTOR__COUNTRY__VALUE'].map(lambda x: x[0])
-    except:
-        return_df['MAIN_AWARD_CONTRACT__AWARDED_CONTRACT__CONTRACTORS__CONTRACTOR__ADDRESS_CONTRACTOR__COUNTRY__VALUE'] = return_df['AWARD_CONTRACT__AWARDED_CONTRACT__CONTRACTORS__CONTRACTOR__ADDRESS_CONTRACTOR__COUNTRY__VALUE']
+        value_eur = None
     
-    return_df.dropna(axis=1, how="all", inplace=True)
+    logger.info('%d documents, %.1f MB of column buffers', len(builder), builder.nbytes() / 2**20)
+    table = builder.finish()
+    if value_eur is not None:
+        # the floats go in as they are, convert_table keeps a column that is already typed
+        names = table.schema.names
+        arrays = [columnar.column_data(table.column(i)) for i in range(len(names))]
+        arrays[names.index('VALUE_EUR')] = pa.array(value_eur, type=pa.float64(), mask=np.isnan(value_eur))
+        table = pa.Table.from_arrays(arrays, names=names)
+    table = code_lists.encode_table(typed_columns.convert_table(table), CATEGORICAL_COLS)
+    if ENRICH_REGIONS:
+        table = regions.enrich(table)
+    if CPV_ROLLUP_LEVELS:
+        table = cpv_hierarchy.get_hierarchy().add_rollup_columns(table, CPV_ROLLUP_COLS, CPV_ROLLUP_LEVELS)
+    logger.info('%.1f MB allocated by Arrow for the table', pa.total_allocated_bytes() / 2**20)
     
-    return return_df
+    return table
+
+# write a table to Parquet in memory, ready to be uploaded
+def to_parquet_buffer(table):
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer)
+    buffer.seek(0)
+    return buffer
 
 def lambda_handler(event, context):
-    downloaded_files = download_file(event)
-    logger.info("Extracting files")
-    extracted_files = extract_files(downloaded_files)
+    # read the packages straight from S3, nothing is extracted to /tmp
+    keys = [object_['s3']['object']['key'] for object_ in event['Records']]
+    bodies = (s3.Object(object_['s3']['bucket']['name'], object_['s3']['object']['key']).get()['Body'] for object_ in event['Records'])
     logger.info("Parsing data")
-    df = load_data("/tmp")
+    table = load_data_from_archives(bodies)
     logger.info("Done parsing")
-    file_name = downloaded_files[0].split("/")[-1].split(".")[0] + ".parquet"
+    file_name = keys[0].split("/")[-1].split(".")[0] + ".parquet"
     # replace "_" with "-" as underscores may cause problems with Glue?
     file_name = str.replace(file_name, "_", "-")
     logger.info("File name " + file_name)
-    df.to_parquet("/tmp/" + file_name)
     year = file_name[:4]
     month = file_name[4:6]
     prefix = year + "/" + month
     # upload the file to S3
-    s3.meta.client.upload_file(Filename = os.path.join("/tmp/", file_name), Bucket = s3_extracted_bucket, Key = prefix + "/" + file_name)
+    s3.meta.client.upload_fileobj(Fileobj = to_parquet_buffer(table), Bucket = s3_extracted_bucket, Key = prefix + "/" + file_name)
     
     return {
         'statusCode': 200,
         'body': json.dumps(file_name)
-    }
\ No newline at end of file
+    }
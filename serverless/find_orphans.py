@@ -1,61 +1,202 @@
+# Finds the raw packages that were never extracted and queues them for extraction again.
+#
+# A package counts as extracted when its name appears in one of the layouts of the extracted bucket:
+#
+#   YYYY/<package>.parquet                  batch extraction (batch_job.process_extractions)
+#   merged/new_data/<package>.parquet       daily extraction, not merged yet
+#   monthly/YYYYMM/_parts/<package>.json    part of the monthly dataset (monthly_dataset.py), or listed as folded in
+#                                           its _manifest.json
+#   merged_by_month/year=YYYY/month=MM/<package>.parquet
+#                                           daily extraction merged into the merged table (merge_new_data.py)
+#   YYYYMM00_ALL.parquet                    whole month file (scripts/parse_month.py), covers the raw packages
+#                                           uploaded before it was written
+#
+# All the prefixes of all the months are listed at the same time on a thread pool and diffed with sets. For every
+# month a small ledger (_orphans/YYYYMM.json in the extracted bucket) keeps the newest raw upload already checked (the
+# watermark) and the packages still missing, so the next run only diffs the packages uploaded after the watermark plus
+# the pending ones; "full": true checks everything again.
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 import json
+import logging
+import os
+
 import boto3
 
-raw_bucket_name = "2-cca-ted-raw-dev"
-extracted_bucket_name = "2-cca-ted-extracted-dev"
+import merge_new_data
+import monthly_dataset
+import s3_listing
+import sqs_batch
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+raw_bucket_name = f'{os.environ["INITIALS"]}-cca-ted-raw-{os.environ["STAGE"]}'
+extracted_bucket_name = f'{os.environ["INITIALS"]}-cca-ted-extracted-{os.environ["STAGE"]}'
+extractions_queue_url = f'https://sqs.eu-west-3.amazonaws.com/{os.environ["AWS_ACCOUNT_ID"]}/{os.environ["INITIALS"]}_cca_ted_extractions_{os.environ["STAGE"]}'
 
-s3 = boto3.resource('s3')
+s3 = boto3.client('s3')
 sqs = boto3.client('sqs')
 
-rBucket = s3.Bucket(raw_bucket_name)
-eBucket = s3.Bucket(extracted_bucket_name)
-
-def get_raw_files(year, month):
-    # get list of raw files
-    raw_files = []
-    raw_keys = []
-    for item in rBucket.objects.filter(Prefix=year + "/" + month):
-        file_name = item.key.split("/")[-1].split(".")[0]
-        raw_files.append(file_name)
-        raw_keys.append(item.key)    
-    
-    return raw_files, raw_keys
-    
-def get_extracted_files(year, month):
-    # get list of extracted files
-    extracted_files = []
-    for item in eBucket.objects.filter(Prefix=year+"/"+month):
-        file_name = item.key.split(".")[0]
-        extracted_files.append(file_name)
-    
-    return extracted_files
-    
-def compare_files(raw_files, raw_keys, extracted_files):
+LEDGER_PREFIX = '_orphans/'
+# raw packages uploaded up to this long before the watermark are checked again, S3 listings are not a snapshot
+WATERMARK_MARGIN = timedelta(hours=1)
+# prefixes listed at the same time
+LIST_CONCURRENCY = s3_listing.DEFAULT_CONCURRENCY
+FIRST_YEAR_MONTH = '201101'
+
+
+def month_range(start, end):
+    """
+    :param start: first month as 'YYYYMM'
+    :param end: last month as 'YYYYMM', included
+    :return: list of months as 'YYYYMM'
+    """
+    return s3_listing.month_prefixes(start, end, template='{year}{month}')
+
+
+def _package_name(key):
+    return os.path.basename(key).split('.')[0]
+
+
+def _list(bucket, prefix, cache=None):
+    return [(object_['Key'], object_['LastModified']) for object_ in s3_listing.list_prefix(s3, bucket, prefix, cache)]
+
+
+def _prefixes(year_month):
+    year, month = year_month[:4], year_month[4:]
+    return [
+        ('raw', raw_bucket_name, f'{year}/{month}/'),
+        ('batch', extracted_bucket_name, f'{year}/{year_month}'),
+        ('new_data', extracted_bucket_name, f'merged/new_data/{year_month}'),
+        ('monthly', extracted_bucket_name, monthly_dataset.month_prefix(year_month)),
+        ('merged', extracted_bucket_name, merge_new_data.month_prefix(year_month)),
+        ('month_file', extracted_bucket_name, f'{year_month}00_ALL'),
+    ]
+
+
+def list_months(year_months, cache=None):
+    """
+    Lists the raw and extracted prefixes of several months concurrently.
+    :param year_months: months as 'YYYYMM'
+    :param cache: s3_listing.ListingCache, None to always call S3
+    :return: dict of month -> {'raw': {package: (key, last modified)}, 'extracted': set of packages,
+        'month_file': last modified of YYYYMM00_ALL.parquet or None}
+    """
+    tasks = [(year_month, kind, bucket, prefix) for year_month in year_months
+             for kind, bucket, prefix in _prefixes(year_month)]
+    with ThreadPoolExecutor(max_workers=LIST_CONCURRENCY) as executor:
+        listings = list(executor.map(lambda task: _list(task[2], task[3], cache), tasks))
+
+    months = {year_month: {'raw': {}, 'extracted': set(), 'month_file': None} for year_month in year_months}
+    for (year_month, kind, bucket, prefix), objects in zip(tasks, listings):
+        month = months[year_month]
+        for key, modified in objects:
+            name = _package_name(key)
+            if kind == 'raw':
+                month['raw'][name] = (key, modified)
+            elif name == year_month + '00_ALL':
+                month['month_file'] = max(modified, month['month_file'] or modified)
+            elif kind == 'monthly':
+                if key.endswith('/_manifest.json'):
+                    month['extracted'].update(monthly_dataset.read_manifest(s3, bucket, year_month)['folded'])
+                elif '/_parts/' in key:
+                    month['extracted'].add(name)
+            else:
+                month['extracted'].add(name)
+    return months
+
+
+def read_ledger(year_month):
+    """
+    :return: the month's ledger {'watermark': ISO timestamp or None, 'pending': [packages]}
+    """
+    try:
+        body = s3.get_object(Bucket=extracted_bucket_name, Key=LEDGER_PREFIX + year_month + '.json')['Body']
+        return json.loads(body.read().decode())
+    except s3.exceptions.NoSuchKey:
+        return {'watermark': None, 'pending': []}
+
+
+def write_ledger(year_month, ledger):
+    s3.put_object(Bucket=extracted_bucket_name, Key=LEDGER_PREFIX + year_month + '.json',
+                  Body=json.dumps(ledger).encode())
+
+
+def compare_files(raw_files, extracted_files, month_file=None, candidates=None):
+    """
+    :param raw_files: dict of package -> (raw key, last modified)
+    :param extracted_files: set of extracted packages
+    :param month_file: last modified of the month file, it covers the packages uploaded before it
+    :param candidates: function(package, last modified) -> bool to restrict the packages examined, None for all
+    :return: (raw keys of the packages not extracted, number of packages examined)
+    """
     missing_files = []
-    # loop through the raw files and see which have not been extracted
-    for i, rFile in enumerate(raw_files):
-        if rFile not in extracted_files:
-            missing_files.append(raw_keys[i])
-            sqs.send_message(
-                    QueueUrl=f'https://sqs.eu-west-3.amazonaws.com/241824408229/2_cca_ted_extractions_dev',
-                    MessageBody=json.dumps({
-                        'key':raw_keys[i]
-                    })
-                )
-#         break
-    
-    return missing_files
-    
+    examined = 0
+    for name, (key, modified) in sorted(raw_files.items()):
+        if candidates is not None and not candidates(name, modified):
+            continue
+        examined += 1
+        if name in extracted_files or (month_file is not None and modified <= month_file):
+            continue
+        missing_files.append(key)
+    return missing_files, examined
+
+
+def reconcile(year_months, full=False, dry_run=False):
+    """
+    Finds the packages of several months that were not extracted and queues them for extraction.
+    :param year_months: months as 'YYYYMM'
+    :param full: if True the ledgers are ignored and every package is examined
+    :param dry_run: if True nothing is queued and the ledgers are not updated
+    :return: {'months': {month: {'raw', 'examined', 'missing'}}, 'missing': raw keys, 'queued': number queued}
+    """
+    result = {'months': {}, 'missing': [], 'queued': 0}
+    for year_month, month in sorted(list_months(year_months).items()):
+        ledger = {'watermark': None, 'pending': []} if full else read_ledger(year_month)
+        candidates = None
+        if ledger['watermark'] is not None:
+            since = datetime.fromisoformat(ledger['watermark']) - WATERMARK_MARGIN
+            pending = set(ledger['pending'])
+            candidates = lambda name, modified: modified > since or name in pending
+        missing_files, examined = compare_files(month['raw'], month['extracted'], month['month_file'], candidates)
+
+        result['months'][year_month] = {'raw': len(month['raw']), 'examined': examined, 'missing': len(missing_files)}
+        result['missing'].extend(missing_files)
+        if month['raw'] and not dry_run:
+            watermark = max(modified for key, modified in month['raw'].values())
+            if ledger['watermark'] is not None:
+                watermark = max(watermark, datetime.fromisoformat(ledger['watermark']))
+            write_ledger(year_month, {
+                'watermark': watermark.isoformat(),
+                'pending': sorted(_package_name(key) for key in missing_files),
+                'updated': datetime.utcnow().isoformat(),
+            })
+        logger.info('%s: %d raw packages, %d examined, %d missing', year_month, len(month['raw']), examined,
+                    len(missing_files))
+
+    queued = sqs_batch.enqueue(extractions_queue_url, ({'key': key} for key in result['missing']), sqs=sqs,
+                               dry_run=dry_run)
+    result['queued'] = queued['sent']
+    return result
+
+
+def _event_months(event):
+    # {"year": 2019, "month": 3}, {"year": 2019}, {"from": "201901", "to": "201906"} or nothing for every month
+    if 'from' in event or 'to' in event:
+        return month_range(str(event.get('from', FIRST_YEAR_MONTH)), str(event.get('to', datetime.today().strftime('%Y%m'))))
+    if 'year' in event and 'month' in event:
+        return [f'{int(event["year"])}{int(event["month"]):02d}']
+    if 'year' in event:
+        return month_range(f'{int(event["year"])}01', f'{int(event["year"])}12')
+    return month_range(FIRST_YEAR_MONTH, datetime.today().strftime('%Y%m'))
+
+
 def lambda_handler(event, context):
-    year = event['year']
-    month = event['month']
-    
-    raw_files, raw_keys = get_raw_files(year, month)
-    extracted_files = get_extracted_files(year, month)
-    
-    missing_files = compare_files(raw_files, raw_keys, extracted_files)
-    
+    result = reconcile(_event_months(event), full=event.get('full', False), dry_run=event.get('dry_run', False))
+
     return {
         'statusCode': 200,
-        'body': json.dumps(missing_files)
+        'body': json.dumps(result)
     }
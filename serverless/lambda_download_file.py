@@ -2,12 +2,12 @@ import json
 from ftplib import FTP
 import datetime
 import os
-# import tarfile
-import urllib.request
-import json
 import boto3
 import logging
 
+import sqs_batch
+import stream_upload
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
@@ -19,42 +19,21 @@ s3_extracted_bucket = f'{os.environ["INITIALS"]}-cca-ted-extracted-{os.environ["
 # Function download_files:
 # FTPs to ftp_path, gets list of files in the directory for the current year and month (note that this may cause
 # problems on the first day of the month downloading the files from the last day of the previous month); makes a list 
-# of files to be download. Then downloads the files with wget (ftp was not downloading the entire file); unzips the 
-# tarballs and then deletes the tar.gz file.
+# of files to be download. Then streams each file from the FTP data connection into a multipart upload to the raw
+# bucket (stream_upload.upload_stream), nothing is written to /tmp and a broken connection resumes where it stopped.
 # 
 # Params:
-# - data_path -> path to download data to
 # - ftp_path -> URI for FTP
 # - username, password -> username and password for FTP login
 # - year, month -> year and month to download data for, if None will use current month and year
 # - max_files -> max number of files to download, useful for debugging
-# - delete_files -> whether to delete the files that have been successfully extracted
 #
 # Returns:
-# - list of files downloaded and successfully extracted
+# - list of S3 keys of the files transferred
 #
 # Note that sometimes using the URL throws an error, in this case use the IP address: 91.250.107.123
 
-# Function download_files:
-# FTPs to ftp_path, gets list of files in the directory for the current year and month (note that this may cause
-# problems on the first day of the month downloading the files from the last day of the previous month); makes a list 
-# of files to be download. Then downloads the files with wget (ftp was not downloading the entire file); unzips the 
-# tarballs and then deletes the tar.gz file.
-# 
-# Params:
-# - data_path -> path to download data to
-# - ftp_path -> URI for FTP
-# - username, password -> username and password for FTP login
-# - year, month -> year and month to download data for, if None will use current month and year
-# - max_files -> max number of files to download, useful for debuggin
-# - delete_files -> whether to delete the files that have been successfully extracted
-#
-# Returns:
-# - list of files downloaded and successfully extracted
-#
-# Note that sometimes using the URL throws an error, in this case use the IP address: 91.250.107.123
-
-def download_files(data_path="/tmp", ftp_path="91.250.107.123", username="guest", password="guest", year=None, month=None, max_files=1, delete_files=True):
+def download_files(ftp_path="91.250.107.123", username="guest", password="guest", year=None, month=None, max_files=1):
     ## USE FTP TO GET THE LIST OF FILES TO DOWNLOAD
     with FTP(ftp_path, user=username, passwd=password) as ftp:
         # create the directory name for the current month and year
@@ -70,63 +49,45 @@ def download_files(data_path="/tmp", ftp_path="91.250.107.123", username="guest"
          
         # go to that directory and get the files in it
         ftp.cwd('daily-packages/' + year + "/" + month) 
-        dir_list = ftp.nlst() 
+        ftp.voidcmd('TYPE I')
         files_to_download = []
-
-        # loop through the files
-        for file in dir_list:
-            # download the file with wget since ftplib seems to only download a small part of the file
-            file_path = "ftp://"+username+":"+password+"@" + ftp_path + "/daily-packages/" + year + "/" + month + "/" + file
-            files_to_download.append(file_path)
+        for file in ftp.nlst():
+            files_to_download.append((file, ftp.size(file)))
     
     # the newest file will be the last one in the sorted list
     if max_files is not None:
         files_to_download = sorted(files_to_download)[-max_files:]
     
-    # download the files with wget so we can download the entire file without errors            
-    downloaded_files = []
-    for file in files_to_download:
+    transferred = []
+    for file, size in files_to_download:
+        key = year + "/" + month + "/" + file
         try:
-            logger.info('Downloading file %s', file)
-            file_name = file.split("/")[-1]
-            d_file = urllib.request.urlretrieve(file, os.path.join(data_path, file_name))[0]
-            downloaded_files.append(d_file)
+            logger.info('Transferring file %s to S3 bucket %s key %s', file, s3_raw_bucket, key)
+            stream_upload.upload_stream(
+                stream_upload.ftplib_opener(ftp_path, username, password, "/daily-packages/" + key),
+                s3.meta.client, s3_raw_bucket, key, size=size
+            )
+            transferred.append(key)
         except Exception as e:
-            logger.error('Error downloading file %s', file)
+            logger.exception('Error transferring file %s', file)
             
-    return downloaded_files
+    return transferred
 
-def upload_to_s3(data_path="/tmp", key="raw_data"):
-    bucket = s3.Bucket(s3_raw_bucket)
-    
-    # find the directories in the download dir
-    files = os.listdir(data_path)
-    
-    for file in files:
-        # check if the file already exists so we don't create duplicates
-        logger.info('Uploading %s to S3 bucket %s key %s', file, s3_raw_bucket, key)
-        year = file[:4]
-        month = file[4:6]
-        key = year + "/" + month
-        try:
-            # upload to S3
-            s3.meta.client.upload_file(Filename = os.path.join(data_path, file), Bucket = s3_raw_bucket, Key = key + "/" + file)
-            
-            # add file to queue for extraction
-            sqs.send_message(
-                QueueUrl=f'https://sqs.eu-west-3.amazonaws.com/{os.environ["AWS_ACCOUNT_ID"]}/{os.environ["INITIALS"]}_cca_ted_extractions_{os.environ["STAGE"]}',
-                MessageBody=json.dumps({
-                    'key': key + "/" + file,
-                    'batch': False,
-                })
-            )
-        except Exception as e:
-            logger.error('Error uploading %s to S3 bucket %s key %s', file, s3_raw_bucket, key)
+def queue_extractions(keys):
+    # add the files to the queue for extraction, in batches
+    result = sqs_batch.enqueue(
+        f'https://sqs.eu-west-3.amazonaws.com/{os.environ["AWS_ACCOUNT_ID"]}/{os.environ["INITIALS"]}_cca_ted_extractions_{os.environ["STAGE"]}',
+        ({'key': key, 'batch': False} for key in keys),
+        sqs=sqs
+    )
+    for body in result['failed']:
+        logger.error('Error queueing the extraction %s', body)
+    return result
 
 def lambda_handler(event, context):
-    new_files = download_files(max_files=1, delete_files=True)
+    new_files = download_files(max_files=1)
     
-    upload_to_s3(data_path="/tmp")
+    queue_extractions(new_files)
     
     # TODO implement
     return {
@@ -1,6 +1,7 @@
 # Does same thing as the other extract_data Lambda function except this version doesn't create a separate Parquet
-# file for every day, but appends the new data to one Parquet file per month. This may be better for performance
-# than having lots of little data files.
+# file for every day, but appends the new data to a monthly dataset (see monthly_dataset.py): every day adds one part
+# and a manifest entry, and compact_handler folds the parts into one file when the month closes. This may be better
+# for performance than having lots of little data files.
 # Note that if the function is being tested it will apppend the test data to the same Parquet file repeatedly. To avoid
 # this I added a check to see if key "test" is in the first object in "Records" in the notification from S3. If it is 
 # the function creates a new file for the day instead of appending to the monthly file.
@@ -11,16 +12,18 @@
 #           "eventSource": "aws:s3",
 
 import json
-import numpy as np
 import collections
 import datetime
 import os
-import tarfile
-import urllib.request
 import boto3
 import io
 import xmltodict
-import pandas as pd
+import columnar
+import parallel_parse
+import typed_columns
+import xml_stream
+import monthly_dataset
+import pyarrow.parquet as pq
 import shutil
 import logging
 
@@ -28,6 +31,7 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 s3 = boto3.resource('s3')
+s3_extracted_bucket = f'{os.environ["INITIALS"]}-cca-ted-extracted-{os.environ["STAGE"]}'
 
 AWS_BUCKET_NAME = 'cca498'
 USE_COLS = ['AA_AUTHORITY_TYPE', 'AA_AUTHORITY_TYPE__CODE', 'AC_AWARD_CRIT',
@@ -153,72 +157,10 @@ LIST_COLS = ['ORIGINAL_CPV',
  'AWARD_CONTRACT__AWARDED_CONTRACT__VALUES__VAL_TOTAL',
  'AWARD_CONTRACT__AWARDED_CONTRACT__VALUES__VAL_TOTAL__CURRENCY',
  'FD_OTH_NOT__TI_DOC']
- 
-def download_file(event):
-    objects = event['Records']
-    
-    downloaded_files = []
-    
-    for object_ in objects:
-        key = object_['s3']['object']['key']
-        bucket = object_['s3']['bucket']['name']
-        logger.info('Downloading %s from %s', key, bucket)
-    
-        file_name = key.split("/")[-1]
-    
-        s3.Bucket(bucket).download_file(key, os.path.join("/tmp", file_name))
-        
-        downloaded_files.append(os.path.join("/tmp", file_name))
-        logger.info('Finished downloading %s from %s', key, bucket)
-        
-    return downloaded_files
-
-def extract_files(files, delete_files=True, data_path="/tmp"):
-    extracted_files = []
-    
-    for file in files:
-        print("\nExtracting:", file)
-        try:
-            if (file.endswith("tar.gz")):
-                tar = tarfile.open(file, "r:gz")
-                tar.extractall(data_path)
-                tar.close()
-            elif (file.endswith("tar")):
-                tar = tarfile.open(file, "r:")
-                tar.extractall()
-                tar.close()
-            
-            extracted_files.append(file)
-            if delete_files:
-                # if everything was properly extracted we can delete the file
-                os.remove(file)
-        except:
-            print("Error extracting", file)
-            
-    return extracted_files
-
-# convert all currencies to EUR
-def convert_currencies(values, currencies):
-    url = "https://api.exchangeratesapi.io/latest"
-    content = urllib.request.urlopen(url).read()
-    exchange_rates = json.loads(content.decode())
-    results = []
-    
-    for value, currency in zip(values, currencies):
-        if currency == "EUR":
-            results.append(value)
-            
-        else:
-            try:
-                exchange_rate = exchange_rates['rates'][currency]
-                converted_value = float(value) / exchange_rate
-                results.append(converted_value)
-            # if we don't have a rate for the currency use NaN
-            except:
-                results.append(np.nan)
-                
-    return results
 
+# path trie of everything that can end up in the output columns, compiled once
+PROJECTION = xml_stream.compile_projection(USE_COLS + LIST_COLS)
+ 
 def unwind_descriptions(short_desc):
     # get the text from the OrderedDicts in the short descriptions
     for i, foo in enumerate(short_desc):
@@ -325,26 +267,34 @@ def extract_xml(xml_dict, parent_key="", results_dict={}):
     
 data_path = "/tmp"
 
-## Function load_data - 
-## Params -
-## - data_dir - directory to extract from
-## - language - languages to extract from the XML
-## - doc_type_filter - if specified function will only return XML documents of the specified type
-## Returns - 
-## - dataframe of parsed documents
-def load_data(data_dir, language="EN", doc_type_filter=['Contract award notice', 'Contract notice', 'Additional information']):
+# parse the files with xml_stream on several processes, the workers send back the USE_COLS columns directly
+def parse_streaming(data_dir, language, doc_type_filter, workers=None):
+    xml_files = parallel_parse.list_xml_files(data_dir)
+    builder = parallel_parse.parse_files(xml_files, USE_COLS, LIST_COLS, language, doc_type_filter, PROJECTION,
+                                         workers=workers)
+    
+    # delete the directories we just read from to avoid conflicts and duplicates
+    for dir_ in os.listdir(data_dir):
+        if os.path.isdir(os.path.join(data_dir, dir_)):
+            shutil.rmtree(os.path.join(data_dir, dir_))
+    
+    return builder
+
+# parse the files with xmltodict and flatten them with extract_xml
+def parse_legacy(data_dir, language, doc_type_filter):
     language_tenders = []
     all_tenders = []
+    builder = columnar.TableBuilder(USE_COLS, LIST_COLS)
     
         
     # loop through the files
-    for dir_ in os.listdir(data_dir):
+    for dir_ in sorted(os.listdir(data_dir)):
         try:
             files = os.listdir(os.path.join(data_dir, dir_))
         except:
             continue
         date = dir_.split("_")[0]
-        xml_files = [file for file in files if file.endswith('.xml')]
+        xml_files = [file for file in sorted(files) if file.endswith('.xml')]
         for file in xml_files:
             # read the contents of the file
             # logger.info('Parsing data from %s', file)
@@ -401,7 +351,7 @@ def load_data(data_dir, language="EN", doc_type_filter=['Contract award notice',
                             all_tenders.append((header_info, form_contents))
                             language_tenders.append((header_info, form_contents))
                     except Exception as e:
-                        print("File 1", file, e)
+                        logger.warning('Could not read the forms of %s: %s', file, e)
             # logger.info('Finished parsing data from %s', file)
         
         # delete the directory we just read from to avoid conflicts and duplicates
@@ -411,8 +361,6 @@ def load_data(data_dir, language="EN", doc_type_filter=['Contract award notice',
     if language == None:
         language_tenders = all_tenders
     
-    parsed_data = []
-    
     # we don't need all tenders anymore, let's delete it
     del(all_tenders)
     
@@ -425,68 +373,44 @@ def load_data(data_dir, language="EN", doc_type_filter=['Contract award notice',
         
         flattened = extract_xml(tender, "", flattened)
         
-        parsed_data.append(flattened)
+        builder.append(flattened)
     
     # clean up unneeded data
     del(language_tenders)
     
-    df = pd.DataFrame(parsed_data)
-    
-    # garbage collecting       
-    del(parsed_data)
-    
-    # try convert Currencies to Euros, some doc types don't have this so it's not a big deal if there's an error
-    try:
-        df['VALUE_EUR'] = convert_currencies(df['VALUES_VALUE'].values, df['VALUES_VALUE_CURRENCY'].values)
-    except:
-        pass
-    
-    return_df = pd.DataFrame(columns=USE_COLS)
-    for col in USE_COLS:
-        # catch the possibility that the column doesn't exist in the dataframe
-        try:
-            column_data = df[col].values
+    return builder
 
-            is_list_col = (col in LIST_COLS)
-            for i, item in enumerate(column_data):
-                if is_list_col and not isinstance(item, list):
-                    column_data[i] = [item]
-                elif is_list_col:
-                    column_data[i] = item
-                elif not is_list_col and isinstance(item, list):
-                    column_data[i] = ";".join(item)
-                else:
-                    column_data[i] = item
-
-            return_df[col] = column_data   
-        except:
-            pass
-      
-    return return_df
+## Function load_data - 
+## Params -
+## - data_dir - directory to extract from
+## - language - languages to extract from the XML
+## - doc_type_filter - if specified function will only return XML documents of the specified type
+## - streaming - if True parse the files with xml_stream on several processes instead of xmltodict + extract_xml
+## - workers - number of processes to parse with when streaming, by default one per (v)CPU
+## Returns - 
+## - pyarrow Table of parsed documents with the USE_COLS columns (numbers and dates typed, see typed_columns.py) and
+##   PARSE_ERRORS, rows ordered by directory and file name
+def load_data(data_dir, language="EN", doc_type_filter=['Contract award notice', 'Contract notice', 'Additional information'], streaming=True, workers=None):
+    if streaming:
+        builder = parse_streaming(data_dir, language, doc_type_filter, workers)
+    else:
+        builder = parse_legacy(data_dir, language, doc_type_filter)
+    
+    return typed_columns.convert_table(builder.finish())
 
-def download_and_merge_files(file_name, df, data_path="/tmp"):
-    # try to download current month's parquet file
-    month_file = file_name[:6] + "00_ALL.parquet"
-    data_file_path = os.path.join(data_path, month_file)
-    try:
-        bucket = s3.Bucket("1-cca-ted-extracted-dev")
-        bucket.download_file(month_file,data_file_path)
-        print("New DF:", len(df))
-        # append current data to it
-        month_df = pd.read_parquet(data_file_path)
-        print("Old DF:", len(month_df))
-        month_df = pd.concat([month_df, df], axis=0)
-        print("Combined DF:", len(month_df))
-        # write it back to Parquet
-        month_df.to_parquet(data_file_path)
-        del(month_df)
-    except Exception as e:
-        print(e)
-        # if it doesn't exist we will use the current file
-        df.to_parquet(data_file_path)
-    del(df)
+## Function load_data_from_archives - 
+## Params -
+## - fileobjs - file-like objects with the content of the daily packages (tar.gz), e.g. S3 get_object bodies
+## - language - languages to extract from the XML
+## - doc_type_filter - if specified function will only return XML documents of the specified type
+## - workers - number of processes to parse with, by default one per (v)CPU
+## Returns - 
+## - pyarrow Table of parsed documents, same as extract_files + load_data but nothing is written to disk
+def load_data_from_archives(fileobjs, language="EN", doc_type_filter=['Contract award notice', 'Contract notice', 'Additional information'], workers=None):
+    builder = parallel_parse.parse_archives(fileobjs, USE_COLS, LIST_COLS, language, doc_type_filter, PROJECTION,
+                                            workers=workers)
     
-    return data_file_path, month_file
+    return typed_columns.convert_table(builder.finish())
 
 # delete files in /tmp so we can free up some memory
 def cleanup_files():
@@ -502,34 +426,49 @@ def cleanup_files():
                 logger.info('Error deleting file %s', file)
     
 def lambda_handler(event, context):
-    downloaded_files = download_file(event)
-    logger.info('Extracting files...')
-    extracted_files = extract_files(downloaded_files)
-    df = load_data("/tmp")
+    # read the packages straight from S3, nothing is downloaded or extracted to /tmp
+    keys = [object_['s3']['object']['key'] for object_ in event['Records']]
+    bodies = (s3.Object(object_['s3']['bucket']['name'], object_['s3']['object']['key']).get()['Body'] for object_ in event['Records'])
+    logger.info('Parsing files...')
+    table = load_data_from_archives(bodies)
     logger.info('Done parsing...')
-    file_name = downloaded_files[0].split("/")[-1].split(".")[0] + ".parquet"
+    package = keys[0].split("/")[-1].split(".")[0]
+    file_name = package + ".parquet"
     
     if "test" not in event['Records'][0]:
-        # merge the current data with this month's data, if it exists
-        data_file_path, file_name = download_and_merge_files(file_name, df)
-        del(df)
-        
-        # upload the new file to S3
-        logger.info('Uploading to S3.')
-        s3.meta.client.upload_file(Filename = data_file_path, Bucket = "1-cca-ted-extracted-dev", Key = file_name)
+        # add the day to this month's dataset, only the new data is written
+        logger.info('Appending to the monthly dataset.')
+        monthly_dataset.append_part(s3.meta.client, s3_extracted_bucket, package[:6], package, table)
+        del(table)
     else:    
-        print("Test mode:", file_name)
-        df.to_parquet("/tmp/" + file_name)
-        del(df)
+        logger.info('Test mode, writing %s', file_name)
+        buffer = io.BytesIO()
+        pq.write_table(table, buffer)
+        buffer.seek(0)
+        del(table)
         
         # upload the file to S3
         logger.info('Uploading to S3.')
-        s3.meta.client.upload_file(Filename = os.path.join("/tmp/", file_name), Bucket = "1-cca-ted-extracted-dev", Key = file_name)
-   
-    # delete files to free memory 
-    cleanup_files()
+        s3.meta.client.upload_fileobj(Fileobj = buffer, Bucket = s3_extracted_bucket, Key = file_name)
      
     return {
         'statusCode': 200,
         'body': json.dumps(file_name)
     }
+
+# fold the daily parts of a month into one Parquet file, by default the previous month
+#     {"year": 2019, "month": 3}
+def compact_handler(event, context):
+    if 'year' in event and 'month' in event:
+        year_month = str(event['year']) + str(event['month']).zfill(2)
+    else:
+        last_month = datetime.date.today().replace(day=1) - datetime.timedelta(days=1)
+        year_month = last_month.strftime("%Y%m")
+    
+    logger.info('Compacting %s.', year_month)
+    key = monthly_dataset.compact_month(s3.meta.client, s3_extracted_bucket, year_month)
+    
+    return {
+        'statusCode': 200,
+        'body': json.dumps(key)
+    }
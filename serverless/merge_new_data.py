@@ -0,0 +1,191 @@
+# Folds the daily files of merged/new_data/ into the merged table partitioned by year and month.
+#
+# process_extractions writes the daily (non batch) extractions to merged/new_data/ "for future merging", and the only
+# merge was glue/merge_files.py rewriting a whole year. lambda_handler only looks at the files added since the last
+# run (a bookmark of the newest LastModified already merged) and appends each one to its partition of the table the
+# Glue jobs write (glue/partitioning.py, crawled as merged_by_month), as
+# TABLE_PREFIX/year=YYYY/month=MM/<package>.parquet with the lower case column names of that table and without the
+# year partition column. A day is one new file and no month is rewritten, so the cost follows the new data; a retried
+# file overwrites its own key and is never counted twice.
+#
+# The Glue jobs replace the months of a year they write and read its new_data files too (glue/partitioning.py); the
+# files they wrote are listed in a marker of the year and aren't appended again while their ETag is the same.
+#
+# The new_data files are kept by default: merged/ is still crawled as the old merged table, and its readers would lose
+# the days, and so would the months written again by a Glue job. {"delete_new_data": true} removes them once they are
+# merged, before the bookmark is moved.
+
+from datetime import datetime
+import io
+import json
+import logging
+import os
+
+import boto3
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import columnar
+import s3_listing
+import typed_columns
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+s3 = boto3.client('s3')
+
+s3_extracted_bucket = f'{os.environ["INITIALS"]}-cca-ted-extracted-{os.environ["STAGE"]}'
+
+NEW_DATA_PREFIX = 'merged/new_data/'
+# glue/partitioning.TABLE_PREFIX and PARTITION_COLUMNS
+TABLE_PREFIX = 'merged_by_month'
+PARTITION_COLUMNS = ['year', 'month']
+# outside the table, the crawler doesn't read it
+BOOKMARK_KEY = '_bookmarks/merge_new_data.json'
+# glue/partitioning.MARKER_PREFIX, <year>.json: {'keys': {key: ETag}} of the new_data files a Glue job wrote
+MARKER_PREFIX = '_bookmarks/merged_by_month/'
+
+
+def read_bookmark(bucket):
+    """
+    :return: {'last_modified': ISO timestamp or None, 'keys': {key: ETag} of the files merged with that exact timestamp}
+    """
+    try:
+        return json.loads(s3.get_object(Bucket=bucket, Key=BOOKMARK_KEY)['Body'].read().decode())
+    except s3.exceptions.NoSuchKey:
+        return {'last_modified': None, 'keys': {}}
+
+
+def write_bookmark(bucket, bookmark):
+    s3.put_object(Bucket=bucket, Key=BOOKMARK_KEY, Body=json.dumps(bookmark).encode())
+
+
+def read_written_by_glue(bucket, year):
+    """
+    :return: {key: ETag} of the new_data files of year the last Glue job of the year wrote to the table
+    """
+    try:
+        body = s3.get_object(Bucket=bucket, Key=f'{MARKER_PREFIX}{year}.json')['Body'].read()
+    except s3.exceptions.NoSuchKey:
+        return {}
+    return json.loads(body.decode())['keys']
+
+
+def _since(bookmark):
+    return datetime.fromisoformat(bookmark['last_modified']) if bookmark['last_modified'] else None
+
+
+def new_files(bucket, bookmark):
+    """
+    :return: the new_data objects added after the bookmark, oldest first
+    """
+    since = _since(bookmark)
+    # LastModified has a resolution of a second, a file written again in the same second has another ETag
+    done = bookmark['keys']
+    objects = [object_ for object_ in s3_listing.list_prefix(s3, bucket, NEW_DATA_PREFIX)
+               if object_['Key'].endswith('.parquet')
+               and (since is None or object_['LastModified'] > since
+                    or (object_['LastModified'] == since and done.get(object_['Key']) != object_['ETag']))]
+    return sorted(objects, key=lambda object_: (object_['LastModified'], object_['Key']))
+
+
+def not_written_by_glue(bucket, objects):
+    """
+    :return: objects without the files a Glue job wrote to the table since they were last modified
+    """
+    written = {year: read_written_by_glue(bucket, year) for year in {_year_month(o['Key'])[:4] for o in objects}}
+    return [object_ for object_ in objects
+            if written[_year_month(object_['Key'])[:4]].get(object_['Key']) != object_['ETag']]
+
+
+def _year_month(key):
+    # new_data files are named after the package, YYYYMMDD_NNN.parquet
+    return os.path.basename(key)[:6]
+
+
+def month_prefix(year_month):
+    """
+    :param year_month: month as 'YYYYMM'
+    :return: key prefix of the month's partition in the merged table, ending with '/'
+    """
+    return f'{TABLE_PREFIX}/year={year_month[:4]}/month={year_month[4:]}/'
+
+
+def table_key(year_month, package):
+    """
+    :param package: daily package, e.g. 20190102_001
+    :return: key of the package in the merged table
+    """
+    return f'{month_prefix(year_month)}{package}.parquet'
+
+
+def to_table_columns(table):
+    """
+    :param table: extracted table
+    :return: table with the columns of the merged table: lower case names, the partition columns left out
+    """
+    if typed_columns.ERROR_COLUMN not in table.schema.names:
+        # written before the numbers and dates were typed, the Glue table has them typed
+        table = typed_columns.convert_table(table)
+    names = [name for name in table.schema.names if name.lower() not in PARTITION_COLUMNS]
+    # Columns (pyarrow 0.11) would keep their upper case names, from_arrays only applies names to arrays
+    return pa.Table.from_arrays([columnar.column_data(table.column(table.schema.names.index(name))) for name in names],
+                                names=[name.lower() for name in names])
+
+
+def merge(bucket=None, delete=False):
+    """
+    Appends the new daily files to the merged table.
+    :param bucket: extracted bucket
+    :param delete: if True the merged new_data files are deleted
+    :return: {'files': number merged, 'keys': keys written to the merged table}
+    """
+    bucket = bucket or s3_extracted_bucket
+    bookmark = read_bookmark(bucket)
+    objects = new_files(bucket, bookmark)
+    if not objects:
+        logger.info('No new files since %s', bookmark['last_modified'])
+        return {'files': 0, 'keys': []}
+
+    # the bookmark still moves past the files written by Glue
+    merged = not_written_by_glue(bucket, objects)
+    result = {'files': len(merged), 'keys': []}
+    for object_ in merged:
+        package = os.path.basename(object_['Key']).split('.')[0]
+        body = s3.get_object(Bucket=bucket, Key=object_['Key'])['Body'].read()
+        table = to_table_columns(pq.read_table(pa.BufferReader(body)))
+        buffer = io.BytesIO()
+        pq.write_table(table, buffer)
+        buffer.seek(0)
+        key = table_key(_year_month(object_['Key']), package)
+        s3.upload_fileobj(Fileobj=buffer, Bucket=bucket, Key=key)
+        result['keys'].append(key)
+        logger.info('Merged %s into %s (%d rows)', object_['Key'], key, table.num_rows)
+
+    if delete:
+        keys = [object_['Key'] for object_ in objects]
+        for i in range(0, len(keys), 1000):
+            s3.delete_objects(Bucket=bucket, Delete={'Objects': [{'Key': key} for key in keys[i:i + 1000]]})
+
+    last_modified = objects[-1]['LastModified']
+    # files merged by the previous run in the same second are still done
+    done = dict(bookmark['keys']) if _since(bookmark) == last_modified else {}
+    done.update((object_['Key'], object_['ETag']) for object_ in objects if object_['LastModified'] == last_modified)
+    write_bookmark(bucket, {
+        'last_modified': last_modified.isoformat(),
+        'keys': done,
+        'updated': datetime.utcnow().isoformat(),
+    })
+    return result
+
+
+def lambda_handler(event, context):
+    """
+    Merges merged/new_data/ into the merged table.
+    :param event: {"delete_new_data": true} to delete the merged daily files
+    """
+    result = merge(delete=event.get('delete_new_data', False))
+    return {
+        'statusCode': 200,
+        'body': json.dumps(result)
+    }
@@ -0,0 +1,193 @@
+# Append-only monthly Parquet dataset on S3.
+#
+# The merge Lambda used to download YYYYMM00_ALL.parquet, concatenate the new day to it and upload the whole month
+# again on every event, so a day cost O(month) and two invocations running at the same time lost one of the days.
+# Here every daily package is written once as its own part and never rewritten:
+#
+#   <prefix>/YYYYMM/parts/<package>.parquet    data of one daily package
+#   <prefix>/YYYYMM/_parts/<package>.json      manifest entry of the part, written after the data (the commit)
+#   <prefix>/YYYYMM/_manifest.json             written by compact_month: the compacted file and the folded parts
+#   <prefix>/YYYYMM/compacted-<timestamp>.parquet
+#
+# The logical monthly table is the compacted file (if any) plus every part that has a manifest entry and isn't
+# listed as folded in _manifest.json. Appends only write their own keys, so concurrent days don't conflict, and
+# writing the same package again (a retried event) replaces its part instead of duplicating it. compact_month folds
+# everything into one file when the month closes; the folded parts are deleted after the new manifest is written,
+# so readers see either the parts or the compacted file, never both. Compactions of one month must not run
+# concurrently.
+
+from datetime import datetime
+import io
+import json
+import logging
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import s3_listing
+import typed_columns
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+DEFAULT_PREFIX = 'monthly'
+
+
+def month_prefix(year_month, prefix=DEFAULT_PREFIX):
+    """
+    :param year_month: month as 'YYYYMM'
+    :param prefix: key prefix of the dataset
+    :return: key prefix of the month, ending with '/'
+    """
+    return f'{prefix}/{year_month}/'
+
+
+def _write_parquet(s3, bucket, key, table):
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer)
+    size = buffer.tell()
+    buffer.seek(0)
+    s3.upload_fileobj(Fileobj=buffer, Bucket=bucket, Key=key)
+    return size
+
+
+def _read_parquet(s3, bucket, key):
+    body = s3.get_object(Bucket=bucket, Key=key)['Body'].read()
+    table = pq.read_table(pa.BufferReader(body))
+    if typed_columns.ERROR_COLUMN not in table.schema.names:
+        # written before the numbers and dates were typed, parse them so the month concatenates
+        table = typed_columns.convert_table(table)
+    return table
+
+
+def _read_json(s3, bucket, key):
+    try:
+        return json.loads(s3.get_object(Bucket=bucket, Key=key)['Body'].read().decode())
+    except s3.exceptions.NoSuchKey:
+        return None
+
+
+def _list_keys(s3, bucket, key_prefix):
+    return [object_['Key'] for object_ in s3_listing.list_prefix(s3, bucket, key_prefix)]
+
+
+def read_manifest(s3, bucket, year_month, prefix=DEFAULT_PREFIX):
+    """
+    :return: the month's manifest: {'compacted': key or None, 'folded': [part names]}
+    """
+    manifest = _read_json(s3, bucket, month_prefix(year_month, prefix) + '_manifest.json')
+    return manifest or {'compacted': None, 'folded': []}
+
+
+def list_parts(s3, bucket, year_month, prefix=DEFAULT_PREFIX, manifest=None):
+    """
+    Lists the committed parts of a month that haven't been folded into the compacted file.
+    :param manifest: the month's manifest if the caller already read it, the parts must be filtered with the manifest
+        the caller uses or a compaction in between shows the folded parts twice or not at all
+    :return: list of manifest entries {'name', 'key', 'rows', 'bytes', 'created'}, sorted by name
+    """
+    if manifest is None:
+        manifest = read_manifest(s3, bucket, year_month, prefix)
+    folded = set(manifest['folded'])
+    entries = []
+    for key in sorted(_list_keys(s3, bucket, month_prefix(year_month, prefix) + '_parts/')):
+        entry = _read_json(s3, bucket, key)
+        if entry is not None and entry['name'] not in folded:
+            entries.append(entry)
+    return entries
+
+
+def append_part(s3, bucket, year_month, name, table, prefix=DEFAULT_PREFIX):
+    """
+    Adds the data of one daily package to the month; the cost only depends on the size of the package.
+    :param s3: boto3 S3 client
+    :param bucket: bucket of the dataset
+    :param year_month: month as 'YYYYMM'
+    :param name: name of the part, e.g. the package name '20190102_001', appending the same name again replaces it
+    :param table: pyarrow Table to append
+    :param prefix: key prefix of the dataset
+    :return: the manifest entry of the part, or None if the part was already folded into the compacted file
+    """
+    if name in read_manifest(s3, bucket, year_month, prefix)['folded']:
+        logger.warning('Part %s of %s is already compacted, skipping it', name, year_month)
+        return None
+    key = month_prefix(year_month, prefix) + 'parts/' + name + '.parquet'
+    size = _write_parquet(s3, bucket, key, table)
+    entry = {
+        'name': name,
+        'key': key,
+        'rows': table.num_rows,
+        'bytes': size,
+        'created': datetime.utcnow().isoformat(),
+    }
+    # the entry is written last, the part only becomes visible once its data is complete
+    s3.put_object(Bucket=bucket, Key=month_prefix(year_month, prefix) + '_parts/' + name + '.json',
+                  Body=json.dumps(entry).encode())
+    logger.info('Appended %d rows to %s as %s', table.num_rows, year_month, key)
+    return entry
+
+
+def data_keys(s3, bucket, year_month, prefix=DEFAULT_PREFIX):
+    """
+    :return: keys of the Parquet files that make up the logical monthly table
+    """
+    manifest = read_manifest(s3, bucket, year_month, prefix)
+    keys = [manifest['compacted']] if manifest['compacted'] else []
+    return keys + [entry['key'] for entry in list_parts(s3, bucket, year_month, prefix, manifest)]
+
+
+def read_month(s3, bucket, year_month, prefix=DEFAULT_PREFIX, attempts=3):
+    """
+    Reads the logical monthly table.
+    :param attempts: a compaction committing while the files are read deletes some of them, the files are then listed
+        again from the new manifest, at most attempts times
+    :return: pyarrow Table, or None if the month has no data yet
+    """
+    for attempt in range(attempts):
+        try:
+            tables = [_read_parquet(s3, bucket, key) for key in data_keys(s3, bucket, year_month, prefix)]
+            break
+        except s3.exceptions.NoSuchKey:
+            if attempt == attempts - 1:
+                raise
+            logger.info('A file of %s was compacted while reading it, reading the month again', year_month)
+    if not tables:
+        return None
+    return pa.concat_tables(tables)
+
+
+def compact_month(s3, bucket, year_month, prefix=DEFAULT_PREFIX):
+    """
+    Folds the compacted file and the parts of a month into a single new Parquet file, e.g. when the month closes.
+    Parts appended while the compaction runs are left as parts.
+    :return: key of the compacted file, None if the month has no data
+    """
+    manifest = read_manifest(s3, bucket, year_month, prefix)
+    parts = list_parts(s3, bucket, year_month, prefix, manifest)
+    if not parts:
+        logger.info('Nothing to compact in %s', year_month)
+        return manifest['compacted']
+
+    keys = ([manifest['compacted']] if manifest['compacted'] else []) + [entry['key'] for entry in parts]
+    table = pa.concat_tables([_read_parquet(s3, bucket, key) for key in keys])
+    key = '%scompacted-%s.parquet' % (month_prefix(year_month, prefix), datetime.utcnow().strftime('%Y%m%dT%H%M%S%f'))
+    _write_parquet(s3, bucket, key, table)
+
+    # switching the manifest is the commit, everything after it only removes files the readers don't use anymore
+    new_manifest = {
+        'compacted': key,
+        'folded': sorted(set(manifest['folded']) | set(entry['name'] for entry in parts)),
+        'rows': table.num_rows,
+    }
+    s3.put_object(Bucket=bucket, Key=month_prefix(year_month, prefix) + '_manifest.json',
+                  Body=json.dumps(new_manifest).encode())
+    logger.info('Compacted %d parts of %s into %s (%d rows)', len(parts), year_month, key, table.num_rows)
+
+    garbage = [entry['key'] for entry in parts]
+    if manifest['compacted']:
+        garbage.append(manifest['compacted'])
+    for entry in parts:
+        garbage.append(month_prefix(year_month, prefix) + '_parts/' + entry['name'] + '.json')
+    for i in range(0, len(garbage), 1000):
+        s3.delete_objects(Bucket=bucket, Delete={'Objects': [{'Key': key} for key in garbage[i:i + 1000]]})
+    return key
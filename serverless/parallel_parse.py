@@ -0,0 +1,313 @@
+# Parses the XML files of extracted daily packages on several processes.
+#
+# The files are listed in a fixed order (daily directories and files sorted by name) and split into contiguous
+# shards. Each worker parses its shard with xml_stream.parse_notice into a columnar.TableBuilder holding the
+# requested columns only, instead of a list of wide dicts. The builders are merged in shard order, so the row order
+# is the same whatever the number of workers.
+#
+# Daily packages can also be parsed straight from their tar.gz stream with parse_archives, without extracting them:
+# the calling process reads the archives and fans the XML files out to the same number of workers.
+#
+# Workers are forked so they don't re-import the calling script (parse_month.py runs everything at import time). On
+# AWS Lambda there is no /dev/shm, so multiprocessing.Pool and concurrent.futures.ProcessPoolExecutor can't be used;
+# there the shards are run with plain multiprocessing.Process and Pipe.
+
+from concurrent.futures import ProcessPoolExecutor
+import math
+import multiprocessing
+import multiprocessing.connection
+import os
+import tarfile
+
+import columnar
+import xml_stream
+
+# memory at which Lambda gives a function a full vCPU, and the most vCPUs it gives
+LAMBDA_MB_PER_VCPU = 1769
+LAMBDA_MAX_VCPUS = 6
+
+# number of shards per worker, a few per worker so one slow shard doesn't hold up the others
+SHARDS_PER_WORKER = 4
+# XML files per message sent to a worker when parsing archive streams
+ARCHIVE_CHUNK_FILES = 32
+
+
+def _on_lambda():
+    return "AWS_LAMBDA_FUNCTION_NAME" in os.environ
+
+
+def default_workers():
+    """
+    Number of worker processes to use: on Lambda one per vCPU the configured memory gives us, elsewhere one per core.
+    :return: number of workers
+    """
+    cpus = os.cpu_count() or 1
+    memory = os.environ.get("AWS_LAMBDA_FUNCTION_MEMORY_SIZE")
+    if memory is None:
+        return cpus
+    vcpus = min(LAMBDA_MAX_VCPUS, int(math.ceil(int(memory) / LAMBDA_MB_PER_VCPU)))
+    return max(1, min(cpus, vcpus))
+
+
+def list_xml_files(data_dir):
+    """
+    Lists the XML files of the extracted daily packages in data_dir, sorted by directory and file name.
+    :param data_dir: directory the daily packages were extracted to
+    :return: list of (path, date, file name)
+    """
+    xml_files = []
+    for dir_ in sorted(os.listdir(data_dir)):
+        try:
+            files = os.listdir(os.path.join(data_dir, dir_))
+        except Exception:
+            continue
+        date = dir_.split("_")[0]
+        for file in sorted(files):
+            if file.endswith('.xml'):
+                xml_files.append((os.path.join(data_dir, dir_, file), date, file))
+    return xml_files
+
+
+def _header(header_fields, date, file):
+    values = {'DATE': date, 'YEAR': date[:4], 'FILE': file}
+    return {field: values[field] for field in header_fields}
+
+
+def _new_builder(options):
+    return columnar.TableBuilder(options['columns'], options['list_columns'])
+
+
+def _append_rows(builder, rows, options):
+    row_hook = options['row_hook']
+    for row in rows:
+        if row_hook is not None:
+            row = row_hook(row)
+        builder.append(row)
+
+
+def _parse_xml(xml, date, file, options):
+    return xml_stream.parse_notice(xml, _header(options['header_fields'], date, file), options['language'],
+                                   options['doc_type_filter'], options['projection'])
+
+
+def _parse_shard(shard, options):
+    builder = _new_builder(options)
+    for path, date, file in shard:
+        with open(path, 'rb') as f:
+            xml = f.read()
+        _append_rows(builder, _parse_xml(xml, date, file, options), options)
+    return builder
+
+
+def _parse_shards(shards, options):
+    return [_parse_shard(shard, options) for shard in shards]
+
+
+def _process_worker(connection, shards, options):
+    connection.send(_parse_shards(shards, options))
+    connection.close()
+
+
+def _context():
+    try:
+        return multiprocessing.get_context('fork')
+    except ValueError:
+        return multiprocessing.get_context()
+
+
+def _run_processes(shards, options, workers):
+    # round robin the shards over the workers, then put the results back in shard order
+    context = _context()
+    assignments = [list(range(i, len(shards), workers)) for i in range(workers)]
+    processes = []
+    for indices in assignments:
+        parent_connection, child_connection = context.Pipe(False)
+        process = context.Process(target=_process_worker,
+                                  args=(child_connection, [shards[i] for i in indices], options))
+        process.start()
+        processes.append((process, parent_connection, indices))
+
+    results = [None] * len(shards)
+    for process, connection, indices in processes:
+        for i, result in zip(indices, connection.recv()):
+            results[i] = result
+        process.join()
+    return results
+
+
+def _merge(builders, options):
+    merged = _new_builder(options)
+    for builder in builders:
+        merged.merge(builder)
+    return merged
+
+
+def _options(columns, list_columns, language, doc_type_filter, projection, row_hook, header_fields):
+    return {
+        'columns': list(columns),
+        'list_columns': list(list_columns),
+        'language': language,
+        'doc_type_filter': doc_type_filter,
+        'projection': projection,
+        'row_hook': row_hook,
+        'header_fields': tuple(header_fields),
+    }
+
+
+def parse_files(xml_files, columns, list_columns=(), language="EN", doc_type_filter=None, projection=None,
+                row_hook=None, header_fields=('DATE', 'FILE'), workers=None):
+    """
+    Parses XML notices on several processes.
+    :param xml_files: list of (path, date, file name), see list_xml_files
+    :param columns: columns to return
+    :param list_columns: columns that hold lists, see columnar.TableBuilder
+    :param language: language of the forms to keep, see xml_stream.parse_notice
+    :param doc_type_filter: document types to keep, see xml_stream.parse_notice
+    :param projection: optional xml_stream.Projection
+    :param row_hook: optional module level function applied to every flattened row before the columns are taken
+    :param header_fields: header fields to add to every row, any of DATE, YEAR and FILE
+    :param workers: number of processes, default_workers() if None, 1 parses in the current process
+    :return: columnar.TableBuilder with the rows of all the files
+    """
+    if workers is None:
+        workers = default_workers()
+    options = _options(columns, list_columns, language, doc_type_filter, projection, row_hook, header_fields)
+
+    if workers <= 1 or len(xml_files) < 2:
+        return _parse_shard(xml_files, options)
+
+    n_shards = min(len(xml_files), workers * SHARDS_PER_WORKER)
+    size = int(math.ceil(len(xml_files) / n_shards))
+    shards = [xml_files[i:i + size] for i in range(0, len(xml_files), size)]
+    workers = min(workers, len(shards))
+
+    if _on_lambda():
+        builders = _run_processes(shards, options, workers)
+    else:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=_context()) as executor:
+            builders = list(executor.map(_parse_shard, shards, [options] * len(shards)))
+    return _merge(builders, options)
+
+
+def iter_archive(fileobj):
+    """
+    Iterates over the XML files of a daily package (tar.gz) without extracting it. The archive is read as a stream
+    (mode 'r|gz'), so fileobj only needs a read method, e.g. the Body of an S3 get_object response.
+    :param fileobj: file-like object with the tar.gz content
+    :return: generator of (XML content as bytes, package directory, file name), in archive order
+    """
+    with tarfile.open(fileobj=fileobj, mode='r|gz') as tar:
+        for member in tar:
+            dir_, file = os.path.split(member.name)
+            # like list_xml_files, only the XML files in the package directory
+            if not member.isfile() or not dir_ or not file.endswith('.xml'):
+                continue
+            yield tar.extractfile(member).read(), os.path.basename(dir_), file
+
+
+def _archive_chunks(fileobjs, size=ARCHIVE_CHUNK_FILES):
+    # lists of at most size (XML content, package directory, file name), read from the archives in turn
+    chunk = []
+    for fileobj in fileobjs:
+        for member in iter_archive(fileobj):
+            chunk.append(member)
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+def _parse_chunk(chunk, options):
+    # one small builder per file, as tar members don't have to be in name order
+    builders = []
+    for xml, dir_, file in chunk:
+        builder = _new_builder(options)
+        _append_rows(builder, _parse_xml(xml, dir_.split("_")[0], file, options), options)
+        if len(builder):
+            builders.append(((dir_, file), builder))
+    return builders
+
+
+def _archive_worker(connection, options):
+    # parses the chunks it is sent until it gets None, acknowledging each one, then sends back its builders
+    builders = []
+    while True:
+        chunk = connection.recv()
+        if chunk is None:
+            break
+        builders.extend(_parse_chunk(chunk, options))
+        connection.send(True)
+    connection.send(builders)
+    connection.close()
+
+
+def _run_archive_workers(chunks, options, workers):
+    # the main process reads the archives and hands every chunk to an idle worker, so reading the stream (S3, gzip)
+    # overlaps with parsing; Process and Pipe only, they work on Lambda
+    context = _context()
+    processes = []
+    idle = []
+    busy = []
+    try:
+        for _ in range(workers):
+            parent_connection, child_connection = context.Pipe()
+            process = context.Process(target=_archive_worker, args=(child_connection, options))
+            process.start()
+            child_connection.close()
+            processes.append((process, parent_connection))
+            idle.append(parent_connection)
+
+        for chunk in chunks:
+            if not idle:
+                for connection in multiprocessing.connection.wait(busy):
+                    connection.recv()
+                    busy.remove(connection)
+                    idle.append(connection)
+            connection = idle.pop()
+            connection.send(chunk)
+            busy.append(connection)
+        for connection in busy:
+            connection.recv()
+
+        builders = []
+        for process, connection in processes:
+            connection.send(None)
+            builders.extend(connection.recv())
+            process.join()
+        return builders
+    finally:
+        for process, _ in processes:
+            if process.is_alive():
+                process.terminate()
+
+
+def parse_archives(fileobjs, columns, list_columns=(), language="EN", doc_type_filter=None, projection=None,
+                   row_hook=None, header_fields=('DATE', 'FILE'), workers=None):
+    """
+    Parses the XML notices of daily packages straight from the archive streams, nothing is written to disk. The
+    archives are read sequentially by the current process, which sends the XML files in chunks of
+    ARCHIVE_CHUNK_FILES to the workers; only the chunks in flight are held in memory. The rows come out in the same
+    order as with list_xml_files + parse_files on the extracted packages.
+    :param fileobjs: iterable of file-like objects with the tar.gz content of the packages
+    :param columns: columns to return
+    :param list_columns: columns that hold lists, see columnar.TableBuilder
+    :param language: language of the forms to keep, see xml_stream.parse_notice
+    :param doc_type_filter: document types to keep, see xml_stream.parse_notice
+    :param projection: optional xml_stream.Projection
+    :param row_hook: optional module level function applied to every flattened row before the columns are taken
+    :param header_fields: header fields to add to every row, any of DATE, YEAR and FILE
+    :param workers: number of processes, default_workers() if None, 1 parses in the current process
+    :return: columnar.TableBuilder with the rows of all the packages
+    """
+    if workers is None:
+        workers = default_workers()
+    options = _options(columns, list_columns, language, doc_type_filter, projection, row_hook, header_fields)
+
+    chunks = _archive_chunks(fileobjs)
+    if workers <= 1:
+        builders = [item for chunk in chunks for item in _parse_chunk(chunk, options)]
+    else:
+        builders = _run_archive_workers(chunks, options, workers)
+    builders.sort(key=lambda item: item[0])
+    return _merge((builder for _, builder in builders), options)
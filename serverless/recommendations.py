@@ -1,53 +1,196 @@
+from contextlib import closing
 import json
 import logging
 import os
+import sqlite3
 import time
 
 import boto3
+from botocore.exceptions import ClientError
+import numpy as np
+
+import ann_index
+import athena_query
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 athena = boto3.client('athena')
+s3 = boto3.client('s3')
+
+# the function times out after 30 s
+QUERY_TIMEOUT = 25
+
+# lookup file written by glue/make_recommendations.py, an SQLite database indexed by contractor and by service
+LOOKUP_BUCKET = f'{os.environ["INITIALS"]}-cca-ted-extracted-{os.environ["STAGE"]}'
+LOOKUP_KEY = 'recommendations_lookup/recommendations.sqlite'
+# factors of the same model, for the similarity queries, and their indexes (ann_index.save_indexes)
+FACTORS_KEY = 'recommendations_lookup/factors.npz'
+INDEXES_KEY = 'recommendations_lookup/indexes.npz'
+# seconds between two checks of the ETag of the lookup file
+VERSION_CHECK_SECONDS = 60
+MAX_RESULTS = 100
+# neighbours returned by the similarity queries by default
+DEFAULT_SIMILAR = 10
+
+# files loaded in memory, kept by warm containers: key -> {'value', 'etag', 'checked'}
+_cache = {}
+
+
+def _load_if_changed(key, load):
+    """
+    Loads an S3 object once per container and again when its ETag changes, checking at most every
+    VERSION_CHECK_SECONDS; a missing object is checked again after VERSION_CHECK_SECONDS too.
+    :param key: key in LOOKUP_BUCKET
+    :param load: function(local path) -> value
+    :return: the loaded value, None if the object doesn't exist
+    """
+    entry = _cache.setdefault(key, {'value': None, 'etag': None, 'checked': None})
+    if entry['checked'] is not None and time.time() - entry['checked'] < VERSION_CHECK_SECONDS:
+        return entry['value']
+    try:
+        etag = s3.head_object(Bucket=LOOKUP_BUCKET, Key=key)['ETag']
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+            raise
+        logger.warning('No s3://%s/%s', LOOKUP_BUCKET, key)
+        # the value loaded before the object was deleted, if any, is kept
+        entry['checked'] = time.time()
+        return entry['value']
+    if etag != entry['etag']:
+        logger.info('Loading s3://%s/%s %s', LOOKUP_BUCKET, key, etag)
+        path = os.path.join('/tmp', os.path.basename(key))
+        s3.download_file(LOOKUP_BUCKET, key, path)
+        try:
+            entry['value'] = load(path)
+        finally:
+            os.remove(path)
+        entry['etag'] = etag
+    entry['checked'] = time.time()
+    return entry['value']
+
+
+def _load_lookup(path):
+    connection = sqlite3.connect(':memory:', check_same_thread=False)
+    # the with block of a connection only commits, closing releases the file before it is removed
+    with closing(sqlite3.connect(path)) as file_connection:
+        file_connection.backup(connection)
+    return connection
+
+
+def get_lookup():
+    """
+    The lookup database, loaded once per container and reloaded when the file on S3 changes.
+    :return: sqlite3 connection to an in-memory copy, None if there is no lookup file
+    """
+    return _load_if_changed(LOOKUP_KEY, _load_lookup)
+
+
+def _build_indexes(path):
+    with np.load(path) as factors:
+        return ann_index.build_indexes(factors)
+
+
+def get_indexes():
+    """
+    Similarity indexes over the ALS factors, loaded once per container and again when the file on S3 changes; built
+    from the factors if the indexes haven't been saved.
+    :return: {'contractor': RandomProjectionIndex, 'service': RandomProjectionIndex}, None if there are no factors
+    """
+    indexes = _load_if_changed(INDEXES_KEY, ann_index.load_indexes)
+    if indexes is not None:
+        return indexes
+    return _load_if_changed(FACTORS_KEY, _build_indexes)
+
+
+def _similar(kind, label, k):
+    indexes = get_indexes()
+    if indexes is None:
+        return _response({'error': 'Recommendation factors not available'}, 503)
+    if label not in indexes[kind]:
+        return _response({'error': f'Unknown {kind} {label}'}, 404)
+    return _response([{kind: similar_label, 'similarity': similarity}
+                      for similar_label, similarity in indexes[kind].similar(label, k)])
+
+
+def _lookup_rows(connection, column, value):
+    cursor = connection.execute(
+        f'SELECT rating, contractor, service FROM recommendations WHERE {column} = ? ORDER BY rating DESC LIMIT ?',
+        (value, MAX_RESULTS)
+    )
+    return [{'rating': rating, 'contractor': contractor, 'service': service} for rating, contractor, service in cursor]
+
+
+def _response(body, status_code=200):
+    return {
+        'body': json.dumps(body),
+        'headers': {
+            'Content-Type': 'application/json'
+        },
+        'statusCode': status_code
+    }
+
 
 def fetch(event, context):
+    """
+    GET /recommendations?contractor=... (services recommended for a contractor) or ?service=... (contractors
+    recommended for a service); ?similar_contractor=... or ?similar_service=... (with &k=..., 1 to MAX_RESULTS)
+    for the most similar contractors or services; without parameters the recommendations of 10 contractors.
+    """
     logger.info('Fetching')
-    logger.info('Starting query execution')
-    start_query_execution_response = athena.start_query_execution(
-        QueryExecutionContext={
-            'Database': f'cca_ted_extracted_{os.environ["STAGE"]}'
-        },
-        QueryString='''SELECT *
-                       FROM recommendations
-                       WHERE contractor IN (
-                           SELECT DISTINCT contractor
-                           FROM recommendations
-                           LIMIT 10
-                       )''',
-        ResultConfiguration={
-            'OutputLocation': f's3://{os.environ["INITIALS"]}-cca-ted-fetch-recommendations-{os.environ["STAGE"]}'
-        }
-    )
-    logger.info('Finished starting query execution')
-    time.sleep(15)
-    logger.info('Fetching query results')
-    get_query_results_response = athena.get_query_results(
-        QueryExecutionId=start_query_execution_response['QueryExecutionId']
-    )
-    logger.info('Finished fetching query results')
-    rows = [row['Data'] for row in get_query_results_response['ResultSet']['Rows'][1:]]
+    parameters = (event or {}).get('queryStringParameters') or {}
+    for kind in ('contractor', 'service'):
+        if 'similar_' + kind in parameters:
+            try:
+                k = int(parameters.get('k', DEFAULT_SIMILAR))
+            except ValueError:
+                return _response({'error': 'k must be an integer'}, 400)
+            if k < 1:
+                return _response({'error': 'k must be at least 1'}, 400)
+            return _similar(kind, parameters['similar_' + kind], min(k, MAX_RESULTS))
+    connection = get_lookup()
+    if connection is not None:
+        for column in ('contractor', 'service'):
+            if column in parameters:
+                return _response(_lookup_rows(connection, column, parameters[column]))
+        cursor = connection.execute(
+            '''SELECT rating, contractor, service
+               FROM recommendations
+               WHERE contractor IN (
+                   SELECT DISTINCT contractor
+                   FROM recommendations
+                   LIMIT 10
+               )'''
+        )
+        return _response([{'rating': rating, 'contractor': contractor, 'service': service}
+                          for rating, contractor, service in cursor])
+
+    # no lookup file yet, query the table
+    if 'contractor' in parameters or 'service' in parameters:
+        return _response({'error': 'Recommendation lookup not available'}, 503)
+    try:
+        rows = athena_query.run_query(
+            '''SELECT *
+               FROM recommendations
+               WHERE contractor IN (
+                   SELECT DISTINCT contractor
+                   FROM recommendations
+                   LIMIT 10
+               )''',
+            f'cca_ted_extracted_{os.environ["STAGE"]}',
+            f's3://{os.environ["INITIALS"]}-cca-ted-fetch-recommendations-{os.environ["STAGE"]}',
+            athena=athena,
+            timeout=QUERY_TIMEOUT
+        )
+    except athena_query.QueryFailed as e:
+        logger.error('Fetching failed: %s', e)
+        return _response({'error': str(e)}, 504 if e.state == 'TIMEOUT' else 502)
     recommendations = []
     for row in rows:
         recommendation = {}
-        recommendation['rating'] = row[0]['VarCharValue']
-        recommendation['contractor'] = row[1]['VarCharValue']
-        recommendation['service'] = row[2]['VarCharValue']
+        recommendation['rating'] = row['rating']
+        recommendation['contractor'] = row['contractor']
+        recommendation['service'] = row['service']
         recommendations.append(recommendation)
     logger.info('Finished fetching')
-    return {
-        'body': json.dumps(recommendations),
-        'headers': {
-            'Content-Type': 'application/json'
-        },
-        'statusCode': 200
-    }
\ No newline at end of file
+    return _response(recommendations)
@@ -0,0 +1,108 @@
+# NUTS region hierarchy of the extracted notices.
+#
+# The NUTS codes of the notices (FR101) are only strings: a query by country or by NUTS 1 / NUTS 2 region has to
+# string-match prefixes, and the NUTS country of Greece (EL) isn't its code in the country list of ISO_COUNTRY__VALUE
+# (GR). NutsHierarchy precomputes, for every code of the 2016 NUTS list, the position of its NUTS 1, 2 and 3 ancestors
+# in that list and of its country in the country list (code_lists.py). enrich looks up each distinct code of a column
+# once and adds the hierarchy as dictionary-encoded columns over these fixed vocabularies, so the columns cost an int32
+# per row and group by without string comparisons.
+#
+# The schemas only list the codes, the added columns hold codes too (a label table can be joined on them).
+
+import collections
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+import code_lists
+import columnar
+
+# NUTS code column -> prefix of the added columns: <prefix>__COUNTRY, <prefix>__NUTS1, <prefix>__NUTS2, <prefix>__NUTS3
+NUTS_COLUMNS = collections.OrderedDict([
+    ('MAIN_n2016:PERFORMANCE_NUTS__CODE', 'PERFORMANCE_NUTS'),
+    ('MAIN_n2016:TENDERER_NUTS__CODE', 'TENDERER_NUTS'),
+    ('CONTRACTING_BODY__ADDRESS_CONTRACTING_BODY__n2016:NUTS__CODE', 'CONTRACTING_BODY_NUTS'),
+])
+NUTS_LEVELS = (1, 2, 3)
+# NUTS country codes that aren't the code of the country in countries.xsd
+NUTS_TO_ISO = {'EL': 'GR'}
+
+
+class NutsHierarchy(object):
+    """
+    Country and NUTS 1 to 3 ancestors of the NUTS codes.
+    """
+
+    def __init__(self, nuts, countries):
+        """
+        :param nuts: CodeList of the NUTS codes
+        :param countries: CodeList of the ISO country codes
+        """
+        self.nuts = nuts
+        self.countries = countries
+        codes = nuts.values.tolist()
+        # a code of level l has l + 2 characters; the ancestor at a deeper level than the code is unknown (-1)
+        self.ancestors = np.array([[nuts.position(code[:level + 2]) if len(code) >= level + 2 else -1
+                                    for level in NUTS_LEVELS] for code in codes], dtype=np.int32)
+        self.country = np.array([countries.position(NUTS_TO_ISO.get(code[:2], code[:2])) for code in codes],
+                                dtype=np.int32)
+
+    def positions(self, values):
+        """
+        :param values: NUTS codes, a ";" separated list counts as its first code
+        :return: int32 positions in the NUTS list, -1 for missing and unknown codes
+        """
+        ids, uniques = pd.factorize(np.asarray(values, dtype=object))
+        positions = np.array([self.nuts.position(value.split(';')[0].strip()) for value in uniques] + [-1],
+                             dtype=np.int32)
+        return positions[ids]
+
+    def columns(self, values, prefix):
+        """
+        :return: list of (name, DictionaryArray) of the country and NUTS 1 to 3 of values
+        """
+        positions = self.positions(values)
+        known = positions >= 0
+        safe = np.where(known, positions, 0)
+        result = [(prefix + '__COUNTRY', self.countries.dictionary_array(np.where(known, self.country[safe], -1)))]
+        for i, level in enumerate(NUTS_LEVELS):
+            result.append(('%s__NUTS%d' % (prefix, level),
+                           self.nuts.dictionary_array(np.where(known, self.ancestors[safe, i], -1))))
+        return result
+
+    def enrich(self, table, columns=NUTS_COLUMNS):
+        """
+        :param table: pyarrow Table of extracted notices
+        :param columns: NUTS code column -> prefix of the added columns, the columns missing from table are skipped
+        :return: table with the region columns added after the others
+        """
+        names = list(table.schema.names)
+        arrays = [columnar.column_data(table.column(i)) for i in range(table.num_columns)]
+        for column, prefix in columns.items():
+            if column not in names:
+                continue
+            for name, array in self.columns(arrays[names.index(column)].to_pandas(), prefix):
+                names.append(name)
+                arrays.append(array)
+        return pa.Table.from_arrays(arrays, names=names)
+
+
+_hierarchy = None
+
+
+def get_hierarchy():
+    """
+    :return: NutsHierarchy of the 2016 NUTS list, built once per process
+    """
+    global _hierarchy
+    if _hierarchy is None:
+        _hierarchy = NutsHierarchy(code_lists.get_code_list('nuts'), code_lists.get_code_list('countries'))
+    return _hierarchy
+
+
+def enrich(table):
+    """
+    Adds the country and NUTS 1 to 3 columns of every NUTS_COLUMNS column, see NutsHierarchy.enrich.
+    """
+    return get_hierarchy().enrich(table)
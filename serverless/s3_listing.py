@@ -0,0 +1,169 @@
+# Parallel listing of the raw and extracted buckets.
+#
+# The job starters, find_orphans and the Glue jobs used to list a bucket with one paginator over a broad prefix, so a
+# backfill listed every object since 2011 through a single stream of 1000-key pages. The keys follow a YYYY/MM
+# hierarchy, so the listing can be split: iter_objects lists known prefixes (e.g. month_prefixes) on a thread pool and
+# walk discovers the hierarchy with Delimiter='/' and lists the leaves on a thread pool. Both yield the objects as a
+# single generator, in key order of the prefixes.
+#
+# A ListingCache keeps the listing of a prefix with the time it was made, so scanning the same prefix again in the
+# same run doesn't call S3; invalidate a prefix after writing to it.
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import itertools
+import threading
+import time
+
+DEFAULT_CONCURRENCY = 16
+FIRST_YEAR_MONTH = '201101'
+
+
+class ListingCache(object):
+    """
+    Listings by (bucket, prefix), kept for ttl seconds.
+    """
+
+    def __init__(self, ttl=None):
+        """
+        :param ttl: seconds a listing is reused, None to keep it for the life of the cache
+        """
+        self.ttl = ttl
+        self._listings = {}
+        self._lock = threading.Lock()
+
+    def get(self, bucket, prefix):
+        """
+        :return: the cached objects, or None if the prefix wasn't listed or the listing expired
+        """
+        with self._lock:
+            entry = self._listings.get((bucket, prefix))
+        if entry is None or (self.ttl is not None and time.time() - entry[0] > self.ttl):
+            return None
+        return entry[1]
+
+    def put(self, bucket, prefix, objects):
+        with self._lock:
+            self._listings[(bucket, prefix)] = (time.time(), objects)
+
+    def invalidate(self, bucket, prefix=''):
+        """
+        Drops the listings of the prefixes that overlap prefix.
+        """
+        with self._lock:
+            for key in [key for key in self._listings
+                        if key[0] == bucket and (key[1].startswith(prefix) or prefix.startswith(key[1]))]:
+                del self._listings[key]
+
+
+def list_prefix(s3, bucket, prefix, cache=None):
+    """
+    Lists every object under a prefix with one paginator.
+    :param s3: boto3 S3 client
+    :param cache: ListingCache, None to always call S3
+    :return: list of objects as returned by list_objects_v2 (Key, LastModified, ETag, Size, ...)
+    """
+    if cache is not None:
+        objects = cache.get(bucket, prefix)
+        if objects is not None:
+            return objects
+    objects = []
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        objects.extend(page.get('Contents', []))
+    if cache is not None:
+        cache.put(bucket, prefix, objects)
+    return objects
+
+
+def iter_objects(s3, bucket, prefixes, concurrency=DEFAULT_CONCURRENCY, cache=None):
+    """
+    Lists several prefixes at the same time.
+    :param prefixes: key prefixes, they shouldn't overlap or objects are yielded more than once
+    :param concurrency: number of prefixes listed at the same time
+    :return: generator of objects, prefix by prefix in the order of prefixes
+    """
+    prefixes = iter(prefixes)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while True:
+            # a window at a time, a long list of prefixes isn't all held in memory
+            window = list(itertools.islice(prefixes, concurrency * 4))
+            if not window:
+                break
+            for objects in executor.map(lambda sub_prefix: list_prefix(s3, bucket, sub_prefix, cache), window):
+                for object_ in objects:
+                    yield object_
+
+
+def month_prefixes(start=FIRST_YEAR_MONTH, end=None, template='{year}/{month}/'):
+    """
+    :param start: first month as 'YYYYMM'
+    :param end: last month as 'YYYYMM', included, the current month by default
+    :param template: prefix of a month, formatted with year and month ('%02d')
+    :return: list of prefixes, one per month
+    """
+    if end is None:
+        end = datetime.today().strftime('%Y%m')
+    year, month = int(start[:4]), int(start[4:])
+    prefixes = []
+    while f'{year}{month:02d}' <= end:
+        prefixes.append(template.format(year=year, month=f'{month:02d}'))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return prefixes
+
+
+def _split(s3, bucket, prefix):
+    # one level of the hierarchy: (objects directly under prefix, sub-prefixes)
+    objects, sub_prefixes = [], []
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter='/'):
+        objects.extend(page.get('Contents', []))
+        sub_prefixes.extend(common['Prefix'] for common in page.get('CommonPrefixes', []))
+    return objects, sub_prefixes
+
+
+def walk(s3, bucket, prefix='', depth=2, concurrency=DEFAULT_CONCURRENCY, cache=None):
+    """
+    Lists everything under prefix, fanning out over the first depth levels of '/' separated sub-prefixes, e.g. the
+    years and months of the raw bucket with prefix '' and depth 2.
+    :param depth: levels of the hierarchy discovered before the leaves are listed
+    :return: generator of objects in key order
+    """
+    if cache is not None:
+        objects = cache.get(bucket, prefix)
+        if objects is not None:
+            for object_ in objects:
+                yield object_
+            return
+    # the last level of a prefix that doesn't end with '/' (e.g. '2019/0') is completed by the listing
+    level = [prefix]
+    loose = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for _ in range(depth):
+            next_level = []
+            for objects, sub_prefixes in executor.map(lambda sub_prefix: _split(s3, bucket, sub_prefix), level):
+                loose.extend(objects)
+                next_level.extend(sub_prefixes)
+            level = next_level
+            if not level:
+                break
+    leaves = iter_objects(s3, bucket, level, concurrency, cache)
+    # the objects found while discovering sit between the leaves in key order
+    loose.sort(key=lambda object_: object_['Key'])
+    result = [] if cache is not None else None
+    loose_index = 0
+    for object_ in leaves:
+        while loose_index < len(loose) and loose[loose_index]['Key'] < object_['Key']:
+            yield _collect(result, loose[loose_index])
+            loose_index += 1
+        yield _collect(result, object_)
+    for object_ in loose[loose_index:]:
+        yield _collect(result, object_)
+    if cache is not None:
+        cache.put(bucket, prefix, result)
+
+
+def _collect(result, object_):
+    if result is not None:
+        result.append(object_)
+    return object_
@@ -0,0 +1,117 @@
+# Sends many messages to an SQS queue with SendMessageBatch.
+#
+# The job starters used to call send_message once per file, a round trip per message (tens of thousands for a
+# backfill since 2011). enqueue groups the messages in batches of up to 10 (and 256 KB), sends several batches at
+# the same time on a thread pool, resends the entries SQS reports as failed with exponential backoff, and can just
+# count what it would send (dry_run).
+
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import json
+import logging
+import time
+
+import boto3
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# SendMessageBatch limits
+MAX_BATCH_MESSAGES = 10
+MAX_BATCH_BYTES = 256 * 1024
+
+# batches in flight at the same time
+DEFAULT_CONCURRENCY = 8
+# attempts per batch, for throttling and entries SQS failed on its side
+DEFAULT_ATTEMPTS = 5
+BACKOFF_SECONDS = 0.2
+
+
+def _batches(bodies):
+    batch = []
+    size = 0
+    for body in bodies:
+        if not isinstance(body, str):
+            body = json.dumps(body)
+        body_size = len(body.encode('utf-8'))
+        if batch and (len(batch) == MAX_BATCH_MESSAGES or size + body_size > MAX_BATCH_BYTES):
+            yield batch
+            batch = []
+            size = 0
+        batch.append(body)
+        size += body_size
+    if batch:
+        yield batch
+
+
+def _send_batch(sqs, queue_url, batch, attempts):
+    # returns the bodies that could not be sent
+    pending = {str(i): body for i, body in enumerate(batch)}
+    failed = []
+    for attempt in range(attempts):
+        if attempt:
+            time.sleep(BACKOFF_SECONDS * 2 ** (attempt - 1))
+        try:
+            response = sqs.send_message_batch(
+                QueueUrl=queue_url,
+                Entries=[{'Id': id_, 'MessageBody': body} for id_, body in pending.items()]
+            )
+        except Exception as e:
+            logger.warning('Sending a batch of %d messages failed (attempt %d): %s', len(pending), attempt + 1, e)
+            continue
+        retry = {}
+        for entry in response.get('Failed', []):
+            if entry.get('SenderFault'):
+                # the message itself is invalid, sending it again won't help
+                logger.error('Message rejected by SQS: %s %s', entry.get('Code'), entry.get('Message'))
+                failed.append(pending[entry['Id']])
+            else:
+                retry[entry['Id']] = pending[entry['Id']]
+        pending = retry
+        if not pending:
+            break
+    return failed + list(pending.values())
+
+
+def enqueue(queue_url, bodies, sqs=None, concurrency=DEFAULT_CONCURRENCY, attempts=DEFAULT_ATTEMPTS, dry_run=False):
+    """
+    Sends messages to a queue in batches.
+    :param queue_url: URL of the queue
+    :param bodies: iterable of message bodies, str or JSON-serialisable objects; it is consumed as it is sent, so it
+        can be a generator walking an FTP server or paging through S3
+    :param sqs: boto3 SQS client, a new one by default
+    :param concurrency: number of batches sent at the same time
+    :param attempts: attempts per batch before its messages are reported as failed
+    :param dry_run: if True nothing is sent, the messages are only counted
+    :return: {'messages': number of messages, 'batches': number of batches, 'sent': number sent,
+        'failed': bodies that could not be sent, 'dry_run': dry_run}
+    """
+    result = {'messages': 0, 'batches': 0, 'sent': 0, 'failed': [], 'dry_run': dry_run}
+    batches = _batches(bodies)
+
+    if dry_run:
+        for batch in batches:
+            result['messages'] += len(batch)
+            result['batches'] += 1
+        logger.info('Dry run: would send %d messages in %d batches to %s', result['messages'], result['batches'],
+                    queue_url)
+        return result
+
+    if sqs is None:
+        sqs = boto3.client('sqs')
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while True:
+            # a few windows ahead of the workers, so the producer isn't read all at once
+            window = list(itertools.islice(batches, concurrency * 4))
+            if not window:
+                break
+            for batch, failed in zip(window, executor.map(lambda batch: _send_batch(sqs, queue_url, batch, attempts),
+                                                          window)):
+                result['messages'] += len(batch)
+                result['batches'] += 1
+                result['sent'] += len(batch) - len(failed)
+                result['failed'].extend(failed)
+
+    logger.info('Sent %d of %d messages in %d batches to %s', result['sent'], result['messages'], result['batches'],
+                queue_url)
+    return result
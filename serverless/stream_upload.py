@@ -0,0 +1,245 @@
+# Streams a file from the FTP server into an S3 multipart upload.
+#
+# The transfers used to download every daily package to /tmp (ftp_fs.download, urlretrieve) and then upload_file it,
+# so a package could not be larger than the Lambda's /tmp, the upload only started once the download was over, and
+# any error restarted the package from zero. upload_stream reads the source on a thread into a bounded queue of parts
+# while the calling thread uploads them with upload_part, so the download and the upload overlap and at most
+# QUEUE_PARTS + 1 parts are in memory.
+#
+# Failures are retried per part: an upload_part error resends the part from memory, a broken FTP connection is opened
+# again at the offset already read (FTP REST). The expected size is used to tell a dropped data connection (which
+# fs's FTPFile reports as an early end of file) from the real end of the file. Files smaller than a part are sent
+# with a single put_object; a failed multipart upload is aborted so no orphan parts are billed, and the reader is
+# stopped and its connection closed so it doesn't keep downloading a file nobody uploads.
+
+from ftplib import FTP
+import logging
+import queue
+import socket
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# S3 needs at least 5 MB per part (except the last one) and allows 10000 parts
+PART_SIZE = 16 * 1024 * 1024
+# parts read ahead of the upload
+QUEUE_PARTS = 2
+# attempts per part, for upload_part and for (re)opening the source
+DEFAULT_ATTEMPTS = 5
+BACKOFF_SECONDS = 1.0
+# bytes per read from the source
+READ_SIZE = 1024 * 1024
+FTP_TIMEOUT = 60
+
+
+class IncompleteRead(IOError):
+    pass
+
+
+class ReadStopped(IOError):
+    pass
+
+
+def _backoff(attempt):
+    time.sleep(BACKOFF_SECONDS * 2 ** attempt)
+
+
+class _Reader(object):
+    """
+    Reads a source in parts, reopening it at the current offset when the connection breaks.
+    """
+
+    def __init__(self, open_stream, size, part_size, attempts):
+        self.open_stream = open_stream
+        self.size = size
+        self.part_size = part_size
+        self.attempts = attempts
+        self.offset = 0
+        self.stream = None
+        # set when the upload is aborted, checked between reads
+        self.stopped = threading.Event()
+
+    def _read(self, n):
+        failures = 0
+        while True:
+            if self.stopped.is_set():
+                raise ReadStopped(f'stopped at {self.offset} bytes')
+            try:
+                if self.stream is None:
+                    self.stream = self.open_stream(self.offset)
+                chunk = self.stream.read(n)
+                if not chunk and self.size is not None and self.offset < self.size:
+                    raise IncompleteRead(f'connection closed at {self.offset} of {self.size} bytes')
+                self.offset += len(chunk)
+                return chunk
+            except Exception as e:
+                self.close()
+                if self.stopped.is_set() or failures + 1 >= self.attempts:
+                    raise
+                logger.warning('Reading failed at byte %d (attempt %d), reopening: %s', self.offset, failures + 1, e)
+                _backoff(failures)
+                failures += 1
+
+    def read_part(self):
+        chunks = []
+        remaining = self.part_size
+        while remaining:
+            chunk = self._read(min(READ_SIZE, remaining))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        return b''.join(chunks)
+
+    def close(self):
+        stream, self.stream = self.stream, None
+        if stream is not None:
+            try:
+                stream.close()
+            except Exception:
+                pass
+
+    def stop(self):
+        # called from the uploading thread: the next read raises ReadStopped, and closing the connection interrupts
+        # the read in progress
+        self.stopped.set()
+        self.close()
+
+
+def _read_parts(reader, parts):
+    # producer thread: puts the parts, then None at the end or the exception that stopped it
+    try:
+        while True:
+            part = reader.read_part()
+            parts.put(part)
+            if len(part) < reader.part_size:
+                parts.put(None)
+                return
+    except Exception as e:
+        parts.put(e)
+    finally:
+        reader.close()
+
+
+def _get(parts):
+    item = parts.get()
+    if isinstance(item, Exception):
+        raise item
+    return item
+
+
+def _upload_part(s3, bucket, key, upload_id, number, data, attempts):
+    for attempt in range(attempts):
+        try:
+            response = s3.upload_part(Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=number, Body=data)
+            return {'PartNumber': number, 'ETag': response['ETag']}
+        except Exception as e:
+            if attempt + 1 == attempts:
+                raise
+            logger.warning('Uploading part %d of %s failed (attempt %d): %s', number, key, attempt + 1, e)
+            _backoff(attempt)
+
+
+def upload_stream(open_stream, s3, bucket, key, size=None, part_size=PART_SIZE, queue_parts=QUEUE_PARTS,
+                  attempts=DEFAULT_ATTEMPTS):
+    """
+    Uploads a stream to S3 without staging it on disk.
+    :param open_stream: function(offset) returning a binary file object positioned at offset
+    :param s3: boto3 S3 client
+    :param bucket: destination bucket
+    :param key: destination key
+    :param size: expected size in bytes, to detect and resume truncated reads; None to trust the end of the stream
+    :param part_size: bytes per part, at least 5 MB
+    :param queue_parts: number of parts read ahead of the upload
+    :param attempts: attempts per part and per read
+    :return: number of bytes uploaded
+    """
+    reader = _Reader(open_stream, size, part_size, attempts)
+    parts = queue.Queue(maxsize=queue_parts)
+    thread = threading.Thread(target=_read_parts, args=(reader, parts), daemon=True)
+    thread.start()
+
+    first = _get(parts)
+    if len(first) < part_size:
+        # a single part: no multipart upload needed
+        s3.put_object(Bucket=bucket, Key=key, Body=first)
+        thread.join()
+        return len(first)
+
+    upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+    completed = []
+    total = 0
+    try:
+        data = first
+        while data:
+            completed.append(_upload_part(s3, bucket, key, upload_id, len(completed) + 1, data, attempts))
+            total += len(data)
+            logger.info('Uploaded part %d of %s (%d bytes so far)', len(completed), key, total)
+            data = _get(parts)
+        s3.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id,
+                                     MultipartUpload={'Parts': completed})
+    except BaseException:
+        logger.error('Aborting the upload of %s after %d parts', key, len(completed))
+        reader.stop()
+        s3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        # unblock the reader if it is waiting on a full queue
+        while thread.is_alive():
+            try:
+                parts.get(timeout=1)
+            except queue.Empty:
+                pass
+        raise
+    thread.join()
+    return total
+
+
+def fs_opener(ftp_fs, path):
+    """
+    :param ftp_fs: fs FTPFS
+    :param path: path of the file on the server
+    :return: open_stream function for upload_stream
+    """
+    def open_stream(offset):
+        f = ftp_fs.openbin(path)
+        if offset:
+            f.seek(offset)
+        return f
+    return open_stream
+
+
+class _FtpStream(object):
+
+    def __init__(self, ftp, conn):
+        self.ftp = ftp
+        self.conn = conn
+
+    def read(self, n):
+        return self.conn.recv(n)
+
+    def close(self):
+        try:
+            # shutdown, unlike close, wakes up a recv blocked in the reader thread
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            self.conn.close()
+        finally:
+            self.ftp.close()
+
+
+def ftplib_opener(host, user, passwd, path, timeout=FTP_TIMEOUT):
+    """
+    :param host: FTP server
+    :param user: user name
+    :param passwd: password
+    :param path: path of the file on the server
+    :return: open_stream function for upload_stream, one FTP connection per (re)open
+    """
+    def open_stream(offset):
+        ftp = FTP(host, user=user, passwd=passwd, timeout=timeout)
+        ftp.voidcmd('TYPE I')
+        return _FtpStream(ftp, ftp.transfercmd('RETR ' + path, rest=offset or None))
+    return open_stream
@@ -0,0 +1,207 @@
+# Full-text search over the titles and short descriptions of the notices, without a search server.
+#
+# The text of the notices was only explored in the EDA notebook (a TfidfVectorizer fitted in memory). Segment is a
+# compressed inverted index of the notices of one month, built offline by scripts/build_text_index.py: the sorted
+# terms, and per term the sorted positions of the notices that contain it (stored as gaps, small numbers that zlib
+# compresses well) with the number of occurrences, plus the length of every notice and its NO_DOC_OJS. The tokens
+# are the words of the notebook (token_pattern \b\w+\b, lower case, accents stripped) minus its stop words, which are
+# saved in the segment so the queries are tokenised like the notices.
+#
+# TextIndex merges the segments of several months: the document frequencies and the average length are summed over
+# every segment, so the BM25 scores are the ones of a single index over all the months. A query reads the postings of
+# its terms only and adds their scores into one array per segment, a few milliseconds for a year of notices. Only
+# NumPy is needed to query.
+
+import glob
+import os
+import re
+import unicodedata
+
+import numpy as np
+import pandas as pd
+
+TEXT_COLUMNS = ['OBJECT_CONTRACT__TITLE', 'OBJECT_CONTRACT__SHORT_DESCR']
+ID_COLUMN = 'NO_DOC_OJS'
+STOPWORDS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'notebooks', 'stopwords-en.txt')
+
+# token_pattern of the TfidfVectorizer of notebooks/ted_eda.ipynb
+TOKEN = re.compile(r'(?u)\b\w+\b')
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+MAX_FREQUENCY = np.iinfo(np.uint16).max
+
+
+def read_stopwords(path=STOPWORDS_PATH):
+    """
+    :param path: text file with one stop word per line
+    :return: frozenset of the stop words
+    """
+    with open(path, encoding='utf-8') as f:
+        return frozenset(line.strip() for line in f if line.strip())
+
+
+def _strip_accents(text):
+    # strip_accents='unicode' of the notebook
+    return ''.join(c for c in unicodedata.normalize('NFKD', text) if not unicodedata.combining(c))
+
+
+def tokenize(text, stopwords=frozenset()):
+    """
+    :param text: str or None
+    :param stopwords: set of the tokens to leave out
+    :return: list of the tokens of text, in order
+    """
+    if not text:
+        return []
+    return [token for token in TOKEN.findall(_strip_accents(text.lower())) if token not in stopwords]
+
+
+class Segment(object):
+    """
+    Inverted index of the notices of a month.
+    """
+
+    def __init__(self, terms, offsets, gaps, frequencies, lengths, ids, stopwords=()):
+        """
+        Use build or load.
+        :param terms: sorted array of the terms
+        :param offsets: int64 array (terms + 1), the postings of term i are [offsets[i], offsets[i + 1])
+        :param gaps: uint32 array, the first notice of a postings list then the gaps to the previous one
+        :param frequencies: uint16 array, occurrences of the term in the notice of the posting
+        :param lengths: uint32 array, number of tokens of every notice
+        :param ids: array of the NO_DOC_OJS of the notices
+        :param stopwords: stop words left out of the notices
+        """
+        self.terms = np.asarray(terms, dtype=str)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.gaps = np.asarray(gaps, dtype=np.uint32)
+        self.frequencies = np.asarray(frequencies, dtype=np.uint16)
+        self.lengths = np.asarray(lengths, dtype=np.uint32)
+        self.ids = np.asarray(ids, dtype=object)
+        self.stopwords = frozenset(stopwords)
+
+    @classmethod
+    def build(cls, ids, texts, stopwords=()):
+        """
+        :param ids: NO_DOC_OJS of the notices
+        :param texts: text of every notice
+        :param stopwords: tokens to leave out
+        :return: Segment
+        """
+        stopwords = frozenset(stopwords)
+        tokens = [tokenize(text, stopwords) for text in texts]
+        lengths = np.array([len(notice) for notice in tokens], dtype=np.uint32)
+        notices = np.repeat(np.arange(len(tokens), dtype=np.int64), lengths)
+        term_ids, terms = pd.factorize(np.array([token for notice in tokens for token in notice], dtype=object),
+                                       sort=True)
+        # one key per (term, notice), sorted by term then notice
+        keys, frequencies = np.unique(term_ids.astype(np.int64) * max(len(tokens), 1) + notices, return_counts=True)
+        term_of = keys // max(len(tokens), 1)
+        postings = keys % max(len(tokens), 1)
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(term_of, minlength=len(terms)))]).astype(np.int64)
+        gaps = postings.copy()
+        gaps[1:] -= postings[:-1]
+        gaps[offsets[:-1]] = postings[offsets[:-1]]
+        return cls(np.asarray(terms, dtype=str), offsets, gaps, np.minimum(frequencies, MAX_FREQUENCY),
+                   lengths, np.asarray(ids, dtype=object), stopwords)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def _range(self, term):
+        position = np.searchsorted(self.terms, term)
+        if position == len(self.terms) or self.terms[position] != term:
+            return 0, 0
+        return self.offsets[position], self.offsets[position + 1]
+
+    def document_frequency(self, term):
+        start, end = self._range(term)
+        return end - start
+
+    def postings(self, term):
+        """
+        :return: (int64 array of the positions of the notices containing term, their numbers of occurrences)
+        """
+        start, end = self._range(term)
+        return np.cumsum(self.gaps[start:end], dtype=np.int64), self.frequencies[start:end]
+
+    def save(self, f):
+        np.savez_compressed(f, terms=self.terms, offsets=self.offsets, gaps=self.gaps, frequencies=self.frequencies,
+                            lengths=self.lengths, ids=self.ids.astype(str),
+                            stopwords=np.array(sorted(self.stopwords), dtype=str))
+
+    @classmethod
+    def load(cls, f):
+        with np.load(f) as data:
+            return cls(data['terms'], data['offsets'], data['gaps'], data['frequencies'], data['lengths'],
+                       data['ids'], data['stopwords'].tolist())
+
+
+class TextIndex(object):
+    """
+    BM25 search over several segments.
+    """
+
+    def __init__(self, segments):
+        """
+        :param segments: list of Segment
+        """
+        self.segments = list(segments)
+        self.documents = sum(len(segment) for segment in self.segments)
+        self.average_length = (sum(float(segment.lengths.sum()) for segment in self.segments)
+                               / max(self.documents, 1))
+        self.stopwords = frozenset().union(*[segment.stopwords for segment in self.segments])
+
+    @classmethod
+    def load(cls, paths):
+        """
+        :param paths: segment files or directories of segment files (*.npz)
+        :return: TextIndex
+        """
+        files = []
+        for path in paths:
+            files += sorted(glob.glob(os.path.join(path, '*.npz'))) if os.path.isdir(path) else [path]
+        return cls([Segment.load(path) for path in files])
+
+    def __len__(self):
+        return self.documents
+
+    def idf(self, term):
+        frequency = sum(segment.document_frequency(term) for segment in self.segments)
+        return np.log(1.0 + (self.documents - frequency + 0.5) / (frequency + 0.5))
+
+    def search(self, text, k=10):
+        """
+        :param text: query, tokenised like the notices
+        :param k: number of hits
+        :return: list of (NO_DOC_OJS, BM25 score), best first
+        """
+        terms = sorted(set(tokenize(text, self.stopwords)))
+        weights = [(term, self.idf(term)) for term in terms]
+        scores = []
+        ids = []
+        for segment in self.segments:
+            segment_scores = None
+            for term, idf in weights:
+                notices, frequencies = segment.postings(term)
+                if not len(notices):
+                    continue
+                if segment_scores is None:
+                    segment_scores = np.zeros(len(segment))
+                frequencies = frequencies.astype(np.float64)
+                norms = K1 * (1 - B + B * segment.lengths[notices] / self.average_length)
+                # a notice appears once in the postings of a term
+                segment_scores[notices] += idf * frequencies * (K1 + 1) / (frequencies + norms)
+            if segment_scores is None:
+                continue
+            hits = np.flatnonzero(segment_scores)
+            top = hits[np.argsort(-segment_scores[hits], kind='mergesort')[:k]]
+            scores.append(segment_scores[top])
+            ids.append(segment.ids[top])
+        if not scores:
+            return []
+        scores = np.concatenate(scores)
+        ids = np.concatenate(ids)
+        top = np.argsort(-scores, kind='mergesort')[:k]
+        return [(ids[i], float(scores[i])) for i in top]
@@ -0,0 +1,169 @@
+# Typed value, count and date columns for the extracted tables.
+#
+# The notices give every value as text, and the extracted files kept them as strings: every query on an amount or a
+# date range cast at scan time, and the Parquet min/max statistics of these columns were string statistics, useless
+# to skip row groups. convert_table parses the columns of a table to float64, int32 or date32 with vectorised pandas
+# operations (a distinct text is parsed once whatever the number of rows), list columns element by element, and adds
+# a list<string> column with, for every row, the names of the columns whose text couldn't be parsed; these values
+# become null instead of failing the file.
+#
+# Numbers accept spaces and commas as thousands separators and a decimal comma ("1 234,50"), dates are YYYYMMDD or
+# YYYY-MM-DD with an optional time zone ("2019-02-15+01:00"). A number that can be read two ways is an error rather
+# than a guess: "12,000" (twelve thousand or twelve) and points before a decimal comma ("1.234,50").
+#
+# Columns that are already of their type (VALUE_EUR, computed as floats, and the files converted before) are kept.
+
+import collections
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+import columnar
+
+FLOAT64 = 'float64'
+INT32 = 'int32'
+DATE32 = 'date32'
+ARROW_TYPES = {FLOAT64: pa.float64(), INT32: pa.int32(), DATE32: pa.date32()}
+
+ERROR_COLUMN = 'PARSE_ERRORS'
+# typed columns of the extracted tables; the list columns become lists of that type. YEAR stays a string as the
+# partition key of the merged tables, DT_DATE_FOR_SUBMISSION has a time
+TYPED_COLS = collections.OrderedDict([
+ ('DATE', DATE32), ('DS_DATE_DISPATCH', DATE32), ('COMPLEMENTARY_INFO__DATE_DISPATCH_NOTICE', DATE32),
+ ('PROCEDURE__DATE_RECEIPT_TENDERS', DATE32), ('PROCEDURE__OPENING_CONDITION__DATE_OPENING_TENDERS', DATE32),
+ ('AWARD_CONTRACT__AWARDED_CONTRACT__DATE_CONCLUSION_CONTRACT', DATE32),
+ ('VALUES__VALUE', FLOAT64), ('VALUE_EUR', FLOAT64), ('OBJECT_CONTRACT__VAL_TOTAL', FLOAT64),
+ ('AWARD_CONTRACT__AWARDED_CONTRACT__VALUES__VAL_TOTAL', FLOAT64),
+ ('AWARD_CONTRACT__AWARDED_CONTRACT__TENDERS__NB_TENDERS_RECEIVED', INT32),
+ ('PROCEDURE__DURATION_TENDER_VALID', INT32),
+ ('OBJECT_CONTRACT__OBJECT_DESCR__DURATION', INT32), ('MAIN_OBJECT_CONTRACT__OBJECT_DESCR__DURATION', INT32)])
+INT32_MAX = np.iinfo(np.int32).max
+
+
+def _present(texts):
+    # True where there is a non blank text
+    return (texts.notnull() & (texts.fillna('').str.strip() != '')).values
+
+
+def parse_numbers(values):
+    """
+    :param values: sequence of str or None
+    :return: (float64 array with NaN for missing and unparsable values, bool array of the unparsable values)
+    """
+    texts = pd.Series(np.asarray(values, dtype=object)).astype(object)
+    present = _present(texts)
+    cleaned = texts.fillna('').str.replace(r'\s', '', regex=True)
+    has_comma = cleaned.str.contains(',', regex=False)
+    has_point = cleaned.str.contains('.', regex=False)
+    ambiguous = ((has_comma & ~has_point & cleaned.str.match(r'^[+-]?\d+,\d{3}$'))
+                 | (has_comma & has_point & (cleaned.str.rfind(',') > cleaned.str.rfind('.')))).values
+    # otherwise a comma without a point is a decimal comma, and commas before a point separate thousands
+    decimal_comma = has_comma & ~has_point
+    cleaned = cleaned.where(~decimal_comma, cleaned.str.replace(',', '.', regex=False))
+    cleaned = cleaned.str.replace(',', '', regex=False)
+    numbers = pd.to_numeric(cleaned, errors='coerce').values.astype(np.float64)
+    numbers[ambiguous] = np.nan
+    return numbers, present & np.isnan(numbers)
+
+
+def parse_integers(values):
+    """
+    :return: (float64 array of integral values, NaN for missing and unparsable ones, bool array of the unparsable
+        values: not numbers, not integral or out of the int32 range)
+    """
+    numbers, errors = parse_numbers(values)
+    with np.errstate(invalid='ignore'):
+        bad = ~np.isnan(numbers) & ((numbers != np.round(numbers)) | (np.abs(numbers) > INT32_MAX))
+    numbers[bad] = np.nan
+    return numbers, errors | bad
+
+
+def parse_dates(values):
+    """
+    :return: (datetime64[D] array with NaT for missing and unparsable values, bool array of the unparsable values)
+    """
+    texts = pd.Series(np.asarray(values, dtype=object)).astype(object)
+    present = _present(texts)
+    digits = texts.fillna('').str.strip().str.replace('-', '', regex=False).str[:8]
+    dates = pd.to_datetime(digits, format='%Y%m%d', errors='coerce').values.astype('datetime64[D]')
+    return dates, present & np.isnat(dates)
+
+
+def _parse(values, kind):
+    # (arrow array of kind, bool array of the unparsable values)
+    if kind == DATE32:
+        dates, errors = parse_dates(values)
+        return pa.array(dates, type=pa.date32(), mask=np.isnat(dates)), errors
+    numbers, errors = parse_integers(values) if kind == INT32 else parse_numbers(values)
+    missing = np.isnan(numbers)
+    if kind == INT32:
+        return pa.array(np.where(missing, 0, numbers).astype(np.int32), type=pa.int32(), mask=missing), errors
+    return pa.array(numbers, type=pa.float64(), mask=missing), errors
+
+
+def convert_column(column, kind):
+    """
+    :param column: pyarrow string or list<string> Array, ChunkedArray or Column
+    :param kind: FLOAT64, INT32 or DATE32
+    :return: (the parsed array, of kind or list<kind>, bool array of the rows with an unparsable value)
+    """
+    column = columnar.column_data(column)
+    if isinstance(column, pa.ChunkedArray):
+        parsed = [convert_column(chunk, kind) for chunk in column.chunks]
+        if not parsed:
+            return pa.array([], type=ARROW_TYPES[kind]), np.zeros(0, dtype=bool)
+        return (pa.chunked_array([array for array, _ in parsed]),
+                np.concatenate([errors for _, errors in parsed]))
+    if isinstance(column, pa.ListArray):
+        offsets = np.frombuffer(column.buffers()[1], dtype=np.int32)[column.offset:column.offset + len(column) + 1]
+        values, errors = _parse(columnar.list_values(column).to_pandas(), kind)
+        # a row is in error if one of its values is
+        counts = np.concatenate([[0], np.cumsum(errors, dtype=np.int64)])
+        offsets = offsets - offsets[0]
+        # a null offset makes a null list
+        nulls = np.append(pd.isnull(column.to_pandas()), False)
+        return (pa.ListArray.from_arrays(pa.array(offsets, type=pa.int32(), mask=nulls), values),
+                counts[offsets[1:]] > counts[offsets[:-1]])
+    return _parse(column.to_pandas(), kind)
+
+
+def is_text(type_):
+    """
+    :return: True for string and list<string> Arrow types, the types convert_table parses
+    """
+    return pa.types.is_string(type_) or (pa.types.is_list(type_) and pa.types.is_string(type_.value_type))
+
+
+def error_array(errors, names):
+    """
+    :param errors: bool array (rows x columns)
+    :param names: names of the columns
+    :return: list<string> array with the names of the columns in error of every row
+    """
+    rows, columns = np.nonzero(errors)
+    offsets = np.concatenate([[0], np.cumsum(errors.sum(axis=1))]).astype(np.int32)
+    return pa.ListArray.from_arrays(pa.array(offsets, type=pa.int32()),
+                                    pa.array(np.asarray(names, dtype=object)[columns].tolist(), type=pa.string()))
+
+
+def convert_table(table, columns=TYPED_COLS, error_column=ERROR_COLUMN):
+    """
+    :param table: pyarrow Table with string and list<string> columns
+    :param columns: column -> FLOAT64, INT32 or DATE32; the columns missing from table or not text are skipped
+    :param error_column: name of the added column of the unparsable columns of every row
+    :return: table with the columns converted in place and error_column at the end
+    """
+    names = list(table.schema.names)
+    arrays = []
+    converted = []
+    errors = []
+    for i, name in enumerate(names):
+        column = columnar.column_data(table.column(i))
+        if name in columns and is_text(column.type):
+            column, column_errors = convert_column(column, columns[name])
+            converted.append(name)
+            errors.append(column_errors)
+        arrays.append(column)
+    errors = np.stack(errors, axis=1) if errors else np.zeros((table.num_rows, 0), dtype=bool)
+    return pa.Table.from_arrays(arrays + [error_array(errors, converted)], names=names + [error_column])
@@ -0,0 +1,470 @@
+# Streaming version of xmltodict.parse + extract_xml.
+#
+# load_data used to read every notice into a string, build the full xmltodict OrderedDict tree and then walk that
+# tree again with the recursive extract_xml to get the flattened PARENT__CHILD keys. The handler in this module sits
+# directly on the expat events (it extends the _DictSAXHandler from xmltodict.py) and produces the same flattened
+# keys in one pass, without ever building the tree.
+#
+# extract_xml has a few quirks (repeated elements become lists, P paragraphs are folded into their parent, FT is
+# dropped, lists of strings overwrite earlier values...) and whether an element is a string or a dict is only known
+# once it is closed. To reproduce it exactly every closed element is turned into a small list of operations on the
+# flattened dict ("ops"), which are merged into the parent in the same order xmltodict would have grouped them and
+# replayed on the result dict at the end of the notice.
+#
+# With a projection (see compile_projection) the handler only materialises the paths that can end up in one of the
+# selected columns and skips every other subtree, and notices whose TD_DOCUMENT_TYPE is filtered out are rejected
+# as soon as CODIF_DATA/TD_DOCUMENT_TYPE has been read.
+
+from xml.parsers import expat
+
+from xmltodict import _DictSAXHandler, ParsingInterrupted
+
+# operations on the flattened dict
+# - ADD: set the key if missing, otherwise turn the value into a list and append (what extract_xml does for strings)
+# - SET: overwrite the key with a string
+# - SET_LIST: overwrite the key with a new list of strings
+ADD = 0
+SET = 1
+SET_LIST = 2
+
+# kinds of closed elements, mirroring the value xmltodict would have built for them
+_NONE = 0
+_STR = 1
+_DICT = 2
+
+# frame roles
+_ROOT = 0
+_CODED_DATA = 1
+_FORMS = 2
+_SECTION = 3
+_NODE = 4
+
+
+# columns load_data builds from other paths, and the flattened keys they are read from
+DERIVED_SOURCES = {
+    'VALUES__VALUE': ['VALUES__VALUE',
+                      'VALUES_LIST__VALUES__SINGLE_VALUE__VALUE',
+                      'VALUES_LIST__VALUES__RANGE_VALUE__VALUE'],
+    'VALUES__VALUE__CURRENCY': ['VALUES__VALUE__CURRENCY',
+                                'VALUES_LIST__VALUES__SINGLE_VALUE__VALUE__CURRENCY',
+                                'VALUES_LIST__VALUES__RANGE_VALUE__VALUE__CURRENCY'],
+    'ORIGINAL_CPV_CODE': ['ORIGINAL_CPV'],
+    'ORIGINAL_CPV_TEXT': ['ORIGINAL_CPV'],
+    'REF_NO': ['REF_NOTICE__NO_DOC_OJS'],
+}
+DERIVED_SOURCES['VALUE_EUR'] = DERIVED_SOURCES['VALUES__VALUE'] + DERIVED_SOURCES['VALUES__VALUE__CURRENCY']
+
+# paths parse_notice always needs, whatever the selected columns are
+REQUIRED_KEYS = ['TD_DOCUMENT_TYPE', 'ORIGINAL_CPV', 'ORIGINAL_CPV__CODE', 'REF_NOTICE__NO_DOC_OJS']
+
+
+class _Node(object):
+    __slots__ = ('children', 'terminal')
+
+    def __init__(self):
+        self.children = {}
+        self.terminal = False
+
+
+# trie node for paragraphs of a selected element: the P itself is kept (its text goes to the parent key) but
+# nothing below it is
+_LEAF = _Node()
+
+
+class Projection(object):
+    """
+    Path trie of the flattened keys that feed a set of columns. Keys are split on "__" so that
+    'OBJECT_CONTRACT__CPV_MAIN__CPV_CODE__CODE' becomes OBJECT_CONTRACT -> CPV_MAIN -> CPV_CODE -> CODE.
+    """
+
+    def __init__(self, keys):
+        self.keys = frozenset(keys)
+        self.root = _Node()
+        for key in self.keys:
+            node = self.root
+            for name in key.split("__"):
+                child = node.children.get(name)
+                if child is None:
+                    child = node.children[name] = _Node()
+                node = child
+            node.terminal = True
+
+
+def compile_projection(columns):
+    """
+    Compiles the columns load_data keeps (e.g. USE_COLS + LIST_COLS) into a Projection, adding the paths the
+    derived columns are built from.
+    :param columns: list of output columns
+    :return: Projection
+    """
+    keys = set(REQUIRED_KEYS)
+    for column in columns:
+        keys.update(DERIVED_SOURCES.get(column, [column]))
+    return Projection(keys)
+
+
+class _Frame(object):
+    __slots__ = ('name', 'key', 'role', 'attrs', 'groups', 'data', 'has_children', 'node')
+
+    def __init__(self, name, key, role, attrs, node=None):
+        self.name = name
+        self.key = key
+        self.role = role
+        self.attrs = attrs
+        self.groups = None
+        self.data = None
+        self.has_children = False
+        self.node = node
+
+
+class _Form(object):
+    __slots__ = ('name', 'kind', 'lg', 'ops', 'text')
+
+    def __init__(self, name, kind, lg, ops, text):
+        self.name = name
+        self.kind = kind
+        self.lg = lg
+        self.ops = ops
+        self.text = text
+
+
+def _join_key(parent_key, key):
+    # same key building as extract_xml
+    if len(parent_key):
+        if key != "text":
+            return parent_key + "__" + key
+        return parent_key
+    return key
+
+
+class FlatteningSAXHandler(_DictSAXHandler):
+    """
+    Expat handler for one TED_EXPORT notice. Collects the flattened CODIF_DATA and NOTICE_DATA sections and one op
+    list per form in FORM_SECTION. Use parse_notice instead of driving it directly.
+    :param projection: optional Projection, only the paths it contains are materialised
+    :param doc_type_filter: optional list of TD_DOCUMENT_TYPE values, parsing stops with ParsingInterrupted as soon as
+        the notice's document type is known not to be in it
+    """
+
+    def __init__(self, projection=None, doc_type_filter=None):
+        super(FlatteningSAXHandler, self).__init__()
+        self.projection = projection
+        self.keys = projection.keys if projection is not None else None
+        self.doc_type_filter = doc_type_filter
+        self.frames = []
+        self.skip_depth = 0
+        self.codif_ops = []
+        self.notice_ops = []
+        self.forms = []
+        self.document_type = None
+        self.original_cpv = []
+        self.ref_no = None
+
+    def startElement(self, full_name, attrs):
+        if self.skip_depth:
+            self.skip_depth += 1
+            return
+
+        frames = self.frames
+        if not frames:
+            if full_name == 'TED_EXPORT':
+                frames.append(_Frame(full_name, "", _ROOT, None))
+            else:
+                self.skip_depth = 1
+            return
+
+        parent = frames[-1]
+        role = parent.role
+        if role == _NODE or role == _SECTION:
+            # FT is ignored by extract_xml, and URI_LIST is popped from NOTICE_DATA before flattening; they still
+            # make the parent a dict though
+            if full_name == 'FT' or (role == _SECTION and full_name == 'URI_LIST' and parent.name == 'NOTICE_DATA'):
+                parent.has_children = True
+                self.skip_depth = 1
+                return
+            node = None
+            if self.projection is not None:
+                if full_name == 'text' and len(parent.key):
+                    # extract_xml doesn't add "text" to the key, so its children share the parent's keys
+                    node = parent.node
+                else:
+                    node = parent.node.children.get(full_name)
+                if node is None and full_name == 'P' and parent.node.terminal:
+                    node = _LEAF
+                if node is None:
+                    # nothing below this element can end up in a selected column
+                    parent.has_children = True
+                    self.skip_depth = 1
+                    return
+            frame = _Frame(full_name, _join_key(parent.key, full_name), _NODE, attrs, node)
+        elif role == _FORMS:
+            frame = _Frame(full_name, "", _SECTION, attrs, self._root())
+        elif role == _CODED_DATA and (full_name == 'NOTICE_DATA' or full_name == 'CODIF_DATA'):
+            frame = _Frame(full_name, "", _SECTION, attrs, self._root())
+        elif role == _ROOT and full_name == 'CODED_DATA_SECTION':
+            frame = _Frame(full_name, "", _CODED_DATA, None)
+        elif role == _ROOT and full_name == 'FORM_SECTION':
+            frame = _Frame(full_name, "", _FORMS, None)
+        else:
+            # nothing we need in the rest of the document
+            self.skip_depth = 1
+            return
+        frames.append(frame)
+
+    def _root(self):
+        return self.projection.root if self.projection is not None else None
+
+    def characters(self, data):
+        if self.skip_depth:
+            return
+        frame = self.frames[-1]
+        if frame.data is None:
+            frame.data = [data]
+        else:
+            frame.data.append(data)
+
+    def endElement(self, full_name):
+        if self.skip_depth:
+            self.skip_depth -= 1
+            return
+
+        frame = self.frames.pop()
+        role = frame.role
+        if role != _NODE and role != _SECTION:
+            return
+
+        text = None
+        if frame.data is not None:
+            text = self.cdata_separator.join(frame.data)
+            if self.strip_whitespace:
+                text = text.strip() or None
+
+        if role == _SECTION:
+            self._end_section(frame, text)
+            return
+
+        parent = self.frames[-1]
+        if frame.attrs or frame.has_children:
+            result = (_DICT, self._ops(frame, text), text)
+        elif text is None:
+            result = (_NONE, None, None)
+        else:
+            result = (_STR, None, text)
+
+        parent.has_children = True
+        if parent.groups is None:
+            parent.groups = {full_name: [result]}
+        else:
+            group = parent.groups.get(full_name)
+            if group is None:
+                parent.groups[full_name] = [result]
+            else:
+                group.append(result)
+
+        if parent.role == _SECTION:
+            if parent.name == 'CODIF_DATA':
+                if full_name == 'TD_DOCUMENT_TYPE' and self.document_type is None:
+                    self.document_type = text
+                    if self.doc_type_filter is not None and text not in self.doc_type_filter:
+                        raise ParsingInterrupted()
+            elif parent.name == 'NOTICE_DATA':
+                if full_name == 'ORIGINAL_CPV':
+                    self.original_cpv.append((self._attr(frame, 'CODE'), text))
+                elif full_name == 'REF_NOTICE':
+                    self.ref_no = self._ref_no(frame)
+
+    def _end_section(self, frame, text):
+        if frame.name == 'CODIF_DATA' and self.frames[-1].role == _CODED_DATA:
+            self.codif_ops = self._ops(frame, text)
+        elif frame.name == 'NOTICE_DATA' and self.frames[-1].role == _CODED_DATA:
+            self.notice_ops = self._ops(frame, text)
+        else:
+            if frame.attrs or frame.has_children:
+                form = _Form(frame.name, _DICT, self._attr(frame, 'LG'), self._ops(frame, text), text)
+            elif text is None:
+                form = _Form(frame.name, _NONE, None, None, None)
+            else:
+                form = _Form(frame.name, _STR, None, None, text)
+            self.forms.append(form)
+
+    @staticmethod
+    def _attr(frame, name):
+        attrs = frame.attrs
+        if attrs:
+            for i in range(0, len(attrs), 2):
+                if attrs[i] == name:
+                    return attrs[i + 1]
+        return None
+
+    @staticmethod
+    def _ref_no(frame):
+        # notice_data['REF_NOTICE']['NO_DOC_OJS'], empty string if it doesn't exist
+        if frame.groups is None or 'NO_DOC_OJS' not in frame.groups:
+            return ""
+        # an empty NO_DOC_OJS is None, leave it out rather than writing "None" in the joined REF_NO
+        values = [value for _, _, value in frame.groups['NO_DOC_OJS'] if value is not None]
+        if not values:
+            return ""
+        if len(values) == 1:
+            return values[0]
+        return values
+
+    def _ops(self, frame, text):
+        # ops extract_xml would run for this element if it was an OrderedDict, in xmltodict's key order:
+        # attributes, children grouped by name in order of first appearance, then #text.
+        # With a projection only the ops on selected keys are kept; the children's ops are already filtered
+        keys = self.keys
+        key = frame.key
+        ops = []
+        attrs = frame.attrs
+        if attrs:
+            for i in range(0, len(attrs), 2):
+                name = attrs[i]
+                if name == 'FT':
+                    continue
+                attr_key = key if name == 'P' else _join_key(key, name)
+                if keys is None or attr_key in keys:
+                    ops.append((ADD, attr_key, attrs[i + 1]))
+
+        if frame.groups is not None:
+            for name, results in frame.groups.items():
+                is_p = name == 'P'
+                child_key = key if is_p else _join_key(key, name)
+                if len(results) == 1:
+                    kind, child_ops, child_text = results[0]
+                    if kind == _STR:
+                        if keys is None or child_key in keys:
+                            ops.append((ADD, child_key, child_text))
+                    elif kind == _DICT:
+                        # a single paragraph with text replaces the parent's value
+                        if is_p and child_text is not None:
+                            if keys is None or key in keys:
+                                ops.append((SET, key, child_text))
+                        else:
+                            ops.extend(child_ops)
+                else:
+                    strings = []
+                    for kind, child_ops, child_text in results:
+                        if kind == _DICT:
+                            ops.extend(child_ops)
+                        elif kind == _STR:
+                            strings.append(child_text)
+                    if strings and (keys is None or child_key in keys):
+                        ops.append((SET_LIST, child_key, strings))
+
+        if text:
+            text_key = key if len(key) else "text"
+            if keys is None or text_key in keys:
+                ops.append((ADD, text_key, text))
+        return ops
+
+
+def apply_ops(ops, results_dict):
+    """
+    Replays ops on a flattened dict, with the same update rules as extract_xml.
+    :param ops: list of (op, key, value) tuples
+    :param results_dict: dict to update in place
+    :return: results_dict
+    """
+    for op, key, value in ops:
+        if op == ADD:
+            if key not in results_dict:
+                results_dict[key] = value
+            else:
+                current = results_dict[key]
+                if isinstance(current, list):
+                    current.append(value)
+                elif isinstance(current, str):
+                    results_dict[key] = [current, value]
+        elif op == SET:
+            results_dict[key] = value
+        else:
+            results_dict[key] = list(value)
+    return results_dict
+
+
+def _create_parser(handler):
+    # same expat setup as xmltodict.parse without namespace processing
+    parser = expat.ParserCreate(None, None)
+    parser.ordered_attributes = True
+    parser.StartElementHandler = handler.startElement
+    parser.EndElementHandler = handler.endElement
+    parser.CharacterDataHandler = handler.characters
+    parser.buffer_text = True
+    parser.DefaultHandler = lambda x: None
+    parser.ExternalEntityRefHandler = lambda *x: 1
+    return parser
+
+
+def parse_notice(xml, header, language="EN", doc_type_filter=None, projection=None):
+    """
+    Parses one TED_EXPORT notice into flattened dicts, one per selected form, exactly like load_data did with
+    xmltodict.parse and extract_xml.
+    :param xml: bytes (or str) of the XML file
+    :param header: initial header fields, e.g. {'DATE': ..., 'FILE': ...}
+    :param language: language of the form to keep, None to keep all forms
+    :param doc_type_filter: list of TD_DOCUMENT_TYPE values to keep, None to keep everything
+    :param projection: optional Projection from compile_projection, the rows then only contain the selected keys
+        (plus the header fields)
+    :return: list of flattened dicts, empty if the notice is filtered out
+    """
+    handler = FlatteningSAXHandler(projection, doc_type_filter)
+    parser = _create_parser(handler)
+    if isinstance(xml, str):
+        xml = xml.encode('utf-8')
+    try:
+        parser.Parse(xml, True)
+    except ParsingInterrupted:
+        # rejected on TD_DOCUMENT_TYPE
+        return []
+
+    if doc_type_filter is not None and handler.document_type not in doc_type_filter:
+        return []
+
+    header_info = dict(header)
+    apply_ops(handler.codif_ops, header_info)
+    apply_ops(handler.notice_ops, header_info)
+
+    original_cpv = handler.original_cpv
+    if len(original_cpv) > 1:
+        header_info['ORIGINAL_CPV_CODE'] = [code for code, _ in original_cpv]
+        header_info['ORIGINAL_CPV_TEXT'] = [text for _, text in original_cpv]
+    elif len(original_cpv) == 1:
+        header_info['ORIGINAL_CPV_CODE'] = original_cpv[0][0]
+        header_info['ORIGINAL_CPV_TEXT'] = original_cpv[0][1]
+
+    header_info['REF_NO'] = handler.ref_no if handler.ref_no is not None else ""
+
+    # group the forms by name like the FORM_SECTION OrderedDict would
+    groups = {}
+    for form in handler.forms:
+        groups.setdefault(form.name, []).append(form)
+
+    tenders = []
+    for forms in groups.values():
+        if len(forms) == 1:
+            # if there is only one form use it regardless of language
+            if forms[0].kind == _DICT:
+                tenders.append(forms[0])
+        else:
+            # if there is a list of forms there are multiple languages and we should pick the one we want
+            for form in forms:
+                if language is None:
+                    tenders.append(form)
+                    continue
+                if form.kind != _DICT or form.lg is None:
+                    break
+                if form.lg == language:
+                    tenders.append(form)
+
+    rows = []
+    for form in tenders:
+        flattened = {}
+        for key in header_info.keys():
+            flattened[key] = header_info[key]
+        if form.kind == _DICT:
+            apply_ops(form.ops, flattened)
+        elif form.kind == _STR:
+            flattened[""] = form.text
+        rows.append(flattened)
+    return rows
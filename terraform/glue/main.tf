@@ -13,6 +13,27 @@ resource "aws_glue_crawler" "extracted" {
             path = "s3://${var.initials}-cca-ted-extracted-${var.stage}/merged"
         }
     ]
+    # the numbers and dates went from strings to typed columns: update the table and let the partitions crawled
+    # before inherit its schema instead of keeping their string columns
+    schema_change_policy {
+        update_behavior = "UPDATE_IN_DATABASE"
+        delete_behavior = "LOG"
+    }
+    configuration = <<EOF
+{"Version": 1.0, "CrawlerOutput": {"Partitions": {"AddOrUpdateBehavior": "InheritFromTable"}}}
+EOF
+}
+
+# the merged tables partitioned by year and month (glue/partitioning.py), the old merged/ keeps its YEAR= partitions
+resource "aws_glue_crawler" "merged_by_month" {
+    database_name = "${aws_glue_catalog_database.extracted.name}"
+    name = "cca_ted_merged_by_month_${var.stage}"
+    role = "${var.iam_role_arn}"
+    s3_target = [
+        {
+            path = "s3://${var.initials}-cca-ted-extracted-${var.stage}/merged_by_month"
+        }
+    ]
 }
 
 resource "aws_glue_crawler" "recommendations" {
@@ -157,23 +178,49 @@ EOF
 # Jobs
 resource "aws_glue_job" "make_recommendations" {
   command {
+    python_version = "3"
     script_location = "s3://${var.initials}-glue-scripts-${var.stage}/make_recommendations.py"
   }
   default_arguments = {
-    "--BUCKET" = "${var.initials}-cca-ted-extracted-${var.stage}"
+    "--BUCKET" = "${var.initials}-cca-ted-extracted-${var.stage}",
+    "--extra-py-files" = "s3://${var.initials}-glue-scripts-${var.stage}/implicit_als.py,s3://${var.initials}-glue-scripts-${var.stage}/ann_index.py,s3://${var.initials}-glue-scripts-${var.stage}/s3_listing.py,s3://${var.initials}-glue-scripts-${var.stage}/cpv_hierarchy.py,s3://${var.initials}-glue-scripts-${var.stage}/columnar.py",
+    # the CPV codes of cpv_hierarchy for --CPV_LEVEL, copied to the working directory of the job
+    "--extra-files" = "s3://${var.initials}-glue-scripts-${var.stage}/cpv_codes.npz",
+    # the warm start runs implicit_als on the driver
+    "--additional-python-modules" = "scipy,pyarrow"
   }
+  # --additional-python-modules needs Glue 2.0 (Python 3)
+  glue_version = "2.0"
   name = "make_recommendations_${var.stage}"
   role_arn = "${var.iam_role_arn}"
 }
 
+# daily update of the recommendations with the files extracted since the last run, once merge_new_data is over; a
+# full retraining is a run of the job without --WARM_START
+resource "aws_glue_trigger" "update_recommendations" {
+  actions {
+    arguments = {
+      "--WARM_START" = "true"
+    }
+    job_name = "${aws_glue_job.make_recommendations.name}"
+  }
+  name = "update_recommendations_${var.stage}"
+  schedule = "cron(0 23 ? * TUE-SAT *)"
+  type = "SCHEDULED"
+}
+
 resource "aws_glue_job" "merge_files" {
   command {
+    python_version = "3"
     script_location = "s3://${var.initials}-glue-scripts-${var.stage}/merge_files.py"
   }
   default_arguments = {
     "--BUCKET" = "${var.initials}-cca-ted-extracted-${var.stage}",
-    "--YEAR" = "2019"
+    "--YEAR" = "2019",
+    "--extra-py-files" = "s3://${var.initials}-glue-scripts-${var.stage}/partitioning.py,s3://${var.initials}-glue-scripts-${var.stage}/casting.py,s3://${var.initials}-glue-scripts-${var.stage}/s3_listing.py"
   }
+  # Python 3 needs Glue 1.0; the scripts are Python 3 only
+  glue_version = "1.0"
   name = "merge_files_${var.stage}"
   role_arn = "${var.iam_role_arn}"
 }
\ No newline at end of file
@@ -32,6 +32,62 @@ resource "aws_s3_bucket_object" "merge_files_script" {
   source = "../glue/merge_files.py"
 }
 
+resource "aws_s3_bucket_object" "partitioning_module" {
+  bucket = "${var.initials}-glue-scripts-${var.stage}"
+  etag = "${md5(file("../glue/partitioning.py"))}"
+  key    = "partitioning.py"
+  source = "../glue/partitioning.py"
+}
+
+resource "aws_s3_bucket_object" "casting_module" {
+  bucket = "${var.initials}-glue-scripts-${var.stage}"
+  etag = "${md5(file("../glue/casting.py"))}"
+  key    = "casting.py"
+  source = "../glue/casting.py"
+}
+
+resource "aws_s3_bucket_object" "s3_listing_module" {
+  bucket = "${var.initials}-glue-scripts-${var.stage}"
+  etag = "${md5(file("../serverless/s3_listing.py"))}"
+  key    = "s3_listing.py"
+  source = "../serverless/s3_listing.py"
+}
+
+resource "aws_s3_bucket_object" "implicit_als_module" {
+  bucket = "${var.initials}-glue-scripts-${var.stage}"
+  etag = "${md5(file("../scripts/implicit_als.py"))}"
+  key    = "implicit_als.py"
+  source = "../scripts/implicit_als.py"
+}
+
+resource "aws_s3_bucket_object" "ann_index_module" {
+  bucket = "${var.initials}-glue-scripts-${var.stage}"
+  etag = "${md5(file("../serverless/ann_index.py"))}"
+  key    = "ann_index.py"
+  source = "../serverless/ann_index.py"
+}
+
+resource "aws_s3_bucket_object" "cpv_hierarchy_module" {
+  bucket = "${var.initials}-glue-scripts-${var.stage}"
+  etag = "${md5(file("../serverless/cpv_hierarchy.py"))}"
+  key    = "cpv_hierarchy.py"
+  source = "../serverless/cpv_hierarchy.py"
+}
+
+resource "aws_s3_bucket_object" "columnar_module" {
+  bucket = "${var.initials}-glue-scripts-${var.stage}"
+  etag = "${md5(file("../serverless/columnar.py"))}"
+  key    = "columnar.py"
+  source = "../serverless/columnar.py"
+}
+
+resource "aws_s3_bucket_object" "cpv_codes" {
+  bucket = "${var.initials}-glue-scripts-${var.stage}"
+  etag = "${md5(file("../serverless/cpv_codes.npz"))}"
+  key    = "cpv_codes.npz"
+  source = "../serverless/cpv_codes.npz"
+}
+
 output "s3_bucket_extracted_arn" {
     value = "${aws_s3_bucket.extracted.arn}"
 }
\ No newline at end of file
@@ -0,0 +1,38 @@
+import os
+import sys
+
+# the modules of serverless/ import each other by name, and some build bucket names from these at import time
+os.environ.setdefault("INITIALS", "test")
+os.environ.setdefault("STAGE", "dev")
+os.environ.setdefault("AWS_DEFAULT_REGION", "eu-west-1")
+# the account of moto, in the queue URLs
+os.environ.setdefault("AWS_ACCOUNT_ID", "123456789012")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "serverless"))
+
+# after the path: moto imports xmltodict, the one of serverless/ (the version of the Lambda) has to be found first
+import boto3
+from moto import mock_aws
+import pytest
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+REGION = "eu-west-1"
+
+
+@pytest.fixture
+def bucket():
+    """
+    Bucket created by the s3 fixture, the extracted bucket of the test stage; override it or parametrize it for another
+    one.
+    """
+    return "test-cca-ted-extracted-dev"
+
+
+@pytest.fixture
+def s3(bucket):
+    """
+    :return: boto3 S3 client of a moto S3 with bucket created
+    """
+    with mock_aws():
+        client = boto3.client("s3", region_name=REGION)
+        client.create_bucket(Bucket=bucket, CreateBucketConfiguration={"LocationConstraint": REGION})
+        yield client
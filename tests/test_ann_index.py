@@ -0,0 +1,42 @@
+import io
+
+import numpy as np
+
+import ann_index
+
+
+def factors(n=2000, rank=10):
+    random = np.random.RandomState(1)
+    return {
+        'service_factors': random.randn(n // 4, rank).astype(np.float32),
+        'contractor_factors': random.randn(n, rank).astype(np.float32),
+        'service_labels': np.array(['s%d' % i for i in range(n // 4)]),
+        'contractor_labels': np.array(['c%d' % i for i in range(n)]),
+    }
+
+
+def test_truncated_candidates_keep_the_exact_buckets():
+    index = ann_index.RandomProjectionIndex.build(factors()['contractor_factors'], factors()['contractor_labels'])
+    vector = index.vectors[0]
+    codes = index._codes(vector[None, :])[:, 0]
+    exact = []
+    for table, code in enumerate(codes):
+        sorted_codes = index._sorted_codes[table]
+        exact.extend(index._order[table, np.searchsorted(sorted_codes, code):
+                                  np.searchsorted(sorted_codes, code, 'right')].tolist())
+    # one more than the exact buckets hold: the buckets one bit away are probed too, then truncated
+    candidates = index.candidates(vector, max_candidates=len(exact) + 1)
+    assert len(np.unique(candidates)) == len(candidates) == len(exact) + 1
+    assert set(candidates[:len(set(exact))].tolist()) == set(exact)
+
+
+def test_saved_indexes_answer_like_the_built_ones():
+    built = ann_index.build_indexes(factors())
+    f = io.BytesIO()
+    ann_index.save_indexes(f, built)
+    f.seek(0)
+    loaded = ann_index.load_indexes(f)
+    for kind in ann_index.KINDS:
+        assert np.array_equal(loaded[kind]._order, built[kind]._order)
+        label = built[kind].labels[3]
+        assert loaded[kind].similar(label, 5) == built[kind].similar(label, 5)
@@ -0,0 +1,127 @@
+from decimal import Decimal
+
+import pytest
+
+import athena_query
+
+COLUMNS = [{'Name': 'rating', 'Type': 'double'}, {'Name': 'contractor', 'Type': 'varchar'},
+           {'Name': 'count', 'Type': 'bigint'}, {'Name': 'value', 'Type': 'decimal'},
+           {'Name': 'awarded', 'Type': 'boolean'}]
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class StubAthena(object):
+    """
+    The Athena calls of athena_query: the query goes through states, one per get_query_execution, and its result
+    rows are served in pages of MaxResults rows, the header row first.
+    """
+
+    def __init__(self, states, rows=(), reason=''):
+        self.states = list(states)
+        self.rows = list(rows)
+        self.reason = reason
+        self.stopped = []
+        self.pages = []
+
+    def start_query_execution(self, QueryString, QueryExecutionContext, ResultConfiguration):
+        return {'QueryExecutionId': 'q1'}
+
+    def get_query_execution(self, QueryExecutionId):
+        state = self.states.pop(0) if len(self.states) > 1 else self.states[0]
+        return {'QueryExecution': {'QueryExecutionId': QueryExecutionId,
+                                   'Status': {'State': state, 'StateChangeReason': self.reason},
+                                   'Statistics': {'DataScannedInBytes': 10}}}
+
+    def get_query_results(self, QueryExecutionId, MaxResults, NextToken=None):
+        start = int(NextToken or 0)
+        self.pages.append(start)
+        header = {'Data': [{'VarCharValue': column['Name']} for column in COLUMNS]}
+        rows = ([header] + self.rows)[start:start + MaxResults]
+        response = {'ResultSet': {'Rows': rows, 'ResultSetMetadata': {'ColumnInfo': COLUMNS}}}
+        if start + MaxResults < len(self.rows) + 1:
+            response['NextToken'] = str(start + MaxResults)
+        return response
+
+    def stop_query_execution(self, QueryExecutionId):
+        self.stopped.append(QueryExecutionId)
+
+
+def row(i):
+    return {'Data': [{'VarCharValue': '%d.5' % i}, {'VarCharValue': 'c%d' % i}, {'VarCharValue': str(i)},
+                     {'VarCharValue': '1.10'}, {}]}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(athena_query, 'time', clock)
+    return clock
+
+
+def run(athena, **kwargs):
+    return athena_query.run_query('SELECT 1', 'db', 's3://bucket/results', athena=athena, **kwargs)
+
+
+def test_polls_with_backoff_until_the_query_succeeds(clock):
+    athena = StubAthena(['QUEUED', 'RUNNING', 'RUNNING', 'SUCCEEDED'], [row(1)])
+    assert run(athena) == [{'rating': 1.5, 'contractor': 'c1', 'count': 1, 'value': Decimal('1.10'),
+                            'awarded': None}]
+    assert clock.sleeps == [0.1, 0.2, 0.4]
+
+
+def test_the_backoff_is_capped(clock):
+    athena_query.wait('q1', StubAthena(['RUNNING'] * 8 + ['SUCCEEDED']))
+    assert clock.sleeps[-3:] == [athena_query.MAX_POLL_SECONDS] * 3
+
+
+def test_a_failed_query_raises(clock):
+    athena = StubAthena(['RUNNING', 'FAILED'], reason='SYNTAX_ERROR')
+    with pytest.raises(athena_query.QueryFailed) as error:
+        run(athena)
+    assert error.value.state == 'FAILED' and error.value.reason == 'SYNTAX_ERROR'
+    assert athena.stopped == []
+
+
+def test_a_query_still_running_at_the_timeout_is_stopped(clock):
+    athena = StubAthena(['RUNNING'])
+    with pytest.raises(athena_query.QueryFailed) as error:
+        run(athena, timeout=5)
+    assert error.value.state == 'TIMEOUT'
+    assert athena.stopped == ['q1']
+    assert sum(clock.sleeps) <= 5
+
+
+def test_the_results_are_read_page_by_page(clock):
+    athena = StubAthena(['SUCCEEDED'], [row(i) for i in range(2500)])
+    records = run(athena)
+    # 2501 rows with the header, in pages of 1000
+    assert athena.pages == [0, 1000, 2000]
+    assert [record['count'] for record in records] == list(range(2500))
+    assert records[1999]['contractor'] == 'c1999'
+
+    athena = StubAthena(['SUCCEEDED'], [row(i) for i in range(2500)])
+    assert len(run(athena, max_rows=1200)) == 1200
+    assert athena.pages == [0, 1000]
+
+
+def test_values_are_decoded_with_the_column_types():
+    columns = [{'Name': name, 'Type': kind} for name, kind in [('b', 'boolean'), ('i', 'integer'), ('f', 'real'),
+                                                                 ('d', 'date'), ('a', 'array(varchar)')]]
+    rows = [{'Data': [{'VarCharValue': 'true'}, {'VarCharValue': '-3'}, {'VarCharValue': '0.25'},
+                      {'VarCharValue': '2019-01-02'}, {'VarCharValue': '[a, b]'}]},
+            {'Data': [{'VarCharValue': 'false'}, {}, {}, {}, {}]}]
+    assert athena_query.decode_rows(rows, columns) == [
+        {'b': True, 'i': -3, 'f': 0.25, 'd': '2019-01-02', 'a': '[a, b]'},
+        {'b': False, 'i': None, 'f': None, 'd': None, 'a': None}]
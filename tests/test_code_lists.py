@@ -0,0 +1,31 @@
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import code_lists
+
+
+def test_dictionary_holds_the_used_codes_in_vocabulary_order():
+    array = code_lists.CodeList(['AT', 'BE', 'DE', 'FR']).dictionary_encode(['FR', None, 'BE', 'FR'])
+    assert array.dictionary.to_pylist() == ['BE', 'FR']
+    assert array.indices.to_pylist() == [1, None, 0, 1]
+    assert array.to_pylist() == ['FR', None, 'BE', 'FR']
+
+
+def test_unknown_values_are_kept_after_the_codes():
+    array = code_lists.CodeList(['AT', 'BE']).dictionary_encode(['XX', 'BE', 'XX', 'YY'], 'COUNTRY')
+    assert array.dictionary.to_pylist() == ['BE', 'XX', 'YY']
+    assert array.to_pylist() == ['XX', 'BE', 'XX', 'YY']
+
+
+def test_encode_table_read_back_from_parquet():
+    table = pa.Table.from_arrays([pa.array(['Open', None]), pa.array(['1', '2']), pa.array(['x', 'y'])],
+                                 names=['PR_PROC', 'PR_PROC__CODE', 'TITLE'])
+    buffer = pa.BufferOutputStream()
+    pq.write_table(table, buffer)
+    encoded = code_lists.encode_table(pq.read_table(pa.BufferReader(buffer.getvalue())),
+                                      {'PR_PROC': None, 'PR_PROC__CODE': 'procedure'})
+    assert encoded.schema.names == ['PR_PROC', 'PR_PROC__CODE', 'TITLE']
+    assert pa.types.is_dictionary(encoded.schema[0].type)
+    assert encoded.column(0).to_pylist() == ['Open', None]
+    assert encoded.column(1).to_pylist() == ['1', '2']
+    assert encoded.column(2).to_pylist() == ['x', 'y']
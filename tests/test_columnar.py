@@ -0,0 +1,67 @@
+import numpy as np
+import pyarrow as pa
+
+import columnar
+
+COLUMNS = ['TITLE', 'CPV', 'VALUE']
+LIST_COLUMNS = ['CPV']
+
+
+def to_pydict(table):
+    # per column, Table.to_pylist and to_pydict are missing from pyarrow 0.11
+    return {name: columnar.column_data(table.column(i)).to_pylist() for i, name in enumerate(table.schema.names)}
+
+
+def build(rows):
+    builder = columnar.TableBuilder(COLUMNS, LIST_COLUMNS)
+    builder.extend(rows)
+    return builder
+
+
+def test_rows_become_columns():
+    builder = build([
+        {'TITLE': 'Road salt', 'CPV': ['34927100', '44113910'], 'VALUE': 1234.5},
+        {'TITLE': ['Cleaning', None, 'schools'], 'CPV': '90911200'},
+        {'CPV': None},
+        {'CPV': []},
+    ])
+    assert len(builder) == 4
+    # the list column as an Arrow ListArray: offsets into one flat list of values
+    assert list(builder._offsets['CPV']) == [0, 2, 3, 3, 3]
+    table = builder.finish()
+    assert table.schema.equals(columnar.table_schema(COLUMNS, LIST_COLUMNS))
+    assert to_pydict(table) == {
+        'TITLE': ['Road salt', 'Cleaning;schools', None, None],
+        # a missing value and an empty list are both an empty list, a scalar is a list of one value
+        'CPV': [['34927100', '44113910'], ['90911200'], [], []],
+        'VALUE': ['1234.5', None, None, None],
+    }
+
+
+def test_the_schema_does_not_depend_on_the_rows():
+    expected = columnar.table_schema(COLUMNS, LIST_COLUMNS)
+    assert build([]).finish().schema.equals(expected)
+    assert build([{}, {'CPV': None, 'TITLE': None}]).finish().schema.equals(expected)
+    assert build([{'VALUE': 1, 'CPV': ['1'], 'OTHER': 'x'}]).finish().schema.equals(expected)
+
+
+def test_merge_keeps_the_order():
+    first = build([{'TITLE': 'a', 'CPV': ['1', '2']}, {'TITLE': 'b'}])
+    second = build([{'CPV': ['3']}, {'TITLE': 'd', 'CPV': ['4', '5']}])
+    first.merge(second)
+    first.merge(build([]))
+    assert len(first) == 4
+    assert list(first._offsets['CPV']) == [0, 2, 2, 3, 5]
+    assert to_pydict(first.finish()) == {
+        'TITLE': ['a', 'b', None, 'd'],
+        'CPV': [['1', '2'], [], ['3'], ['4', '5']],
+        'VALUE': [None] * 4,
+    }
+
+
+def test_valid_mask():
+    array = pa.array([None, 'a', None, 'b', 'c', None, 'd', 'e', None, 'f'])
+    expected = np.array([value is not None for value in array.to_pylist()])
+    assert list(columnar.valid_mask(array)) == list(expected)
+    assert list(columnar.valid_mask(array.slice(3, 6))) == list(expected[3:9])
+    assert list(columnar.valid_mask(pa.array(['a', 'b']))) == [True, True]
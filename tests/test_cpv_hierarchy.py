@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import cpv_hierarchy
+
+
+def hierarchy():
+    return cpv_hierarchy.get_hierarchy()
+
+
+def test_lineage_and_missing_levels():
+    assert hierarchy().lineage('45213100') == ['45000000', '45200000', '45210000', '45213000']
+    # the check digit is ignored
+    assert hierarchy().ancestor('45213100-4', 'group') == '45200000'
+    # 39250000 isn't a code, the class of 39254100 is its group
+    assert hierarchy().ancestor('39254100', 'class') == '39200000'
+    assert hierarchy().ancestor('99999999', 1) is None
+    assert hierarchy().ancestor('not a code', 1) is None
+
+
+def test_rollup_keeps_the_kind_of_the_values():
+    codes = ['45213100', None, '99999999', '45213100']
+    assert hierarchy().rollup(codes, 'division').tolist() == ['45000000', None, None, '45000000']
+    series = hierarchy().rollup(pd.Series(codes, name='MAIN_CPV_CODE'), 'division')
+    assert series.name == 'MAIN_CPV_CODE'
+    assert series.isnull().tolist() == [False, True, True, False] and series[0] == series[3] == '45000000'
+    assert hierarchy().rollup(pa.array(codes), 1).to_pylist() == ['45000000', None, None, '45000000']
+
+
+def test_rollup_of_lists_keeps_the_null_lists():
+    lists = pa.array([['45213100', '39254100'], None, [], ['99999999']])
+    assert hierarchy().rollup(lists, 'group').to_pylist() == [['45200000', '39200000'], None, [], [None]]
+    # a slice starts in the middle of the offsets and of the validity bitmap
+    assert hierarchy().rollup(lists[1:], 'group').to_pylist() == [None, [], [None]]
+    assert hierarchy().rollup(pa.array([], type=pa.list_(pa.string())), 'group').to_pylist() == []
+
+
+def test_add_rollup_columns_to_a_read_table():
+    table = pa.Table.from_arrays([pa.array(['45213100', None]), pa.array([['39254100'], None])],
+                                 names=['MAIN_CPV_CODE', 'ORIGINAL_CPV_CODE'])
+    buffer = pa.BufferOutputStream()
+    pq.write_table(table, buffer)
+    table = hierarchy().add_rollup_columns(pq.read_table(pa.BufferReader(buffer.getvalue())),
+                                           ['MAIN_CPV_CODE', 'ORIGINAL_CPV_CODE'], ['division', 'class'])
+    columns = {name: table.column(i).to_pylist() for i, name in enumerate(table.schema.names)}
+    assert list(columns) == ['MAIN_CPV_CODE', 'ORIGINAL_CPV_CODE', 'MAIN_CPV_CODE__DIVISION', 'MAIN_CPV_CODE__CLASS',
+                             'ORIGINAL_CPV_CODE__DIVISION', 'ORIGINAL_CPV_CODE__CLASS']
+    assert columns['MAIN_CPV_CODE__CLASS'] == ['45210000', None]
+    assert columns['ORIGINAL_CPV_CODE__DIVISION'] == [['39000000'], None]
+
+
+def test_the_index_file_has_the_codes_of_the_schema(tmp_path):
+    path = str(tmp_path / 'cpv_codes.npz')
+    cpv_hierarchy.CpvHierarchy.from_xsd().save(path)
+    loaded = cpv_hierarchy.CpvHierarchy.load(path)
+    assert np.array_equal(loaded.codes, hierarchy().codes)
+    assert np.array_equal(loaded.ancestors, hierarchy().ancestors)
@@ -0,0 +1,92 @@
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+from conftest import FIXTURES
+import exchange_rates
+import typed_columns
+
+RATES = os.path.join(FIXTURES, 'ecb_rates.csv')
+
+
+@pytest.fixture
+def table():
+    return exchange_rates.RateTable.from_csv(RATES)
+
+
+@pytest.fixture
+def snapshot(tmp_path, monkeypatch):
+    # no download, and only the snapshot of the test
+    path = str(tmp_path / 'exchange_rates.csv')
+    monkeypatch.setattr(exchange_rates, 'SNAPSHOT_PATH', path)
+    monkeypatch.setattr(exchange_rates, 'BUNDLED_PATH', str(tmp_path / 'bundled.csv'))
+
+    def fail(*args, **kwargs):
+        raise IOError('offline')
+
+    monkeypatch.setattr(exchange_rates, 'download_snapshot', fail)
+    return path
+
+
+def test_weekends_and_holidays_use_the_previous_business_day(table):
+    # 2018-12-29 to 2019-01-01: weekend, New Year's Eve and New Year's Day, 2019-01-05 a Saturday
+    converted = table.to_eur(['114.50'] * 4 + ['113.95'],
+                             ['USD'] * 5, ['20181228', '20181229', '20181231', '20190101', '20190105'])
+    np.testing.assert_allclose(converted, [100.0] * 5)
+
+
+def test_a_currency_not_quoted_on_a_day_keeps_its_previous_rate(table):
+    converted = table.to_eur(['257.15', '257.15'], ['CZK', 'CZK'], ['20190104', '20190107'])
+    np.testing.assert_allclose(converted, [10.0, 10.0])
+
+
+def test_unknown_currencies_dates_and_amounts(table):
+    converted = table.to_eur(['100', '100', '100', '100', None, 'n/a', '100'],
+                             ['XYZ', None, '', 'USD', 'USD', 'USD', 'EUR'],
+                             ['20190102', '20190102', '20190102', '20181201', '20190102', '20190102', '20181201'])
+    # no rate before the first quote, EUR needs none
+    assert np.isnan(converted[:6]).all()
+    assert converted[6] == 100.0
+
+
+def test_amounts_are_parsed_like_the_typed_columns(table):
+    amounts = ['1 234,50', '1,234.50', '1234.5', 1234.5, '']
+    converted = table.to_eur(amounts, ['EUR'] * 5, ['20190102'] * 5)
+    np.testing.assert_array_equal(converted[:4], [1234.5] * 4)
+    assert np.isnan(converted[4])
+    np.testing.assert_array_equal(exchange_rates.parse_amounts(amounts[:3]),
+                                  typed_columns.parse_numbers(amounts[:3])[0])
+
+
+def test_offline_without_snapshot_converts_eur_only(snapshot):
+    table = exchange_rates.load_rate_table(offline=True)
+    converted = table.to_eur(['100', '100'], ['EUR', 'USD'], ['20190102', '20190102'])
+    assert converted[0] == 100.0
+    assert np.isnan(converted[1])
+
+
+def test_offline_uses_a_stale_snapshot(snapshot):
+    shutil.copy(RATES, snapshot)
+    os.utime(snapshot, (0, 0))
+    table = exchange_rates.load_rate_table(offline=True)
+    assert table.currencies == ['USD', 'GBP', 'CZK']
+
+
+def test_failed_refresh_falls_back_to_the_snapshot(snapshot):
+    shutil.copy(RATES, snapshot)
+    os.utime(snapshot, (0, 0))
+    table = exchange_rates.load_rate_table(offline=False)
+    np.testing.assert_allclose(table.to_eur(['90.35'], ['GBP'], ['20190102']), [100.0])
+
+
+def test_rate_table_is_cached(snapshot):
+    shutil.copy(RATES, snapshot)
+    exchange_rates.clear_cache()
+    try:
+        first = exchange_rates.get_rate_table(offline=True)
+        assert exchange_rates.get_rate_table(offline=True) is first
+        assert exchange_rates.get_rate_table(offline=True, ttl=-1) is not first
+    finally:
+        exchange_rates.clear_cache()
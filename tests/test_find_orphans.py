@@ -0,0 +1,106 @@
+from datetime import datetime, timedelta
+import json
+import time
+
+import boto3
+import pyarrow as pa
+import pytest
+
+import find_orphans
+import monthly_dataset
+
+RAW_BUCKET = 'test-cca-ted-raw-dev'
+BUCKET = 'test-cca-ted-extracted-dev'
+
+
+@pytest.fixture
+def s3(s3, monkeypatch):
+    s3.create_bucket(Bucket=RAW_BUCKET, CreateBucketConfiguration={'LocationConstraint': 'eu-west-1'})
+    monkeypatch.setattr(find_orphans, 's3', s3)
+    return s3
+
+
+@pytest.fixture
+def sqs(s3, monkeypatch):
+    # inside the moto of the s3 fixture, the queue of extractions_queue_url
+    client = boto3.client('sqs', region_name='eu-west-3')
+    client.create_queue(QueueName='test_cca_ted_extractions_dev')
+    monkeypatch.setattr(find_orphans, 'sqs', client)
+    return client
+
+
+def put_raw(s3, package):
+    s3.put_object(Bucket=RAW_BUCKET, Key=f'{package[:4]}/{package[4:6]}/{package}.tar.gz', Body=b'')
+
+
+def put_extracted(s3, key):
+    s3.put_object(Bucket=BUCKET, Key=key, Body=b'')
+
+
+def queued(sqs):
+    messages = sqs.receive_message(QueueUrl=find_orphans.extractions_queue_url, MaxNumberOfMessages=10)
+    return sorted(json.loads(message['Body'])['key'] for message in messages.get('Messages', []))
+
+
+def wait_next_second():
+    # LastModified has a resolution of a second
+    time.sleep(1.1)
+
+
+def test_compare_files():
+    uploaded = datetime(2019, 1, 10)
+    raw = {
+        '20190102_001': ('2019/01/20190102_001.tar.gz', uploaded),
+        '20190103_001': ('2019/01/20190103_001.tar.gz', uploaded + timedelta(days=1)),
+        '20190104_001': ('2019/01/20190104_001.tar.gz', uploaded + timedelta(days=2)),
+    }
+    assert find_orphans.compare_files(raw, {'20190102_001'}) == (
+        ['2019/01/20190103_001.tar.gz', '2019/01/20190104_001.tar.gz'], 3)
+    # the month file covers the packages uploaded before it, up to the same second
+    assert find_orphans.compare_files(raw, set(), month_file=uploaded + timedelta(days=1)) == (
+        ['2019/01/20190104_001.tar.gz'], 3)
+    assert find_orphans.compare_files(raw, set(), candidates=lambda name, modified: name == '20190103_001') == (
+        ['2019/01/20190103_001.tar.gz'], 1)
+
+
+def test_reconcile_only_examines_the_new_and_pending_packages(s3, sqs, monkeypatch):
+    monkeypatch.setattr(find_orphans, 'WATERMARK_MARGIN', timedelta(0))
+    for package in ['20190102_001', '20190103_001', '20190104_001', '20190107_001', '20190108_001',
+                    '20190201_001', '20190202_001']:
+        put_raw(s3, package)
+    put_extracted(s3, '2019/20190102_001.parquet')
+    put_extracted(s3, 'merged/new_data/20190103_001.parquet')
+    # folded into the compacted file of the monthly dataset, only the manifest names it
+    monthly_dataset.append_part(s3, BUCKET, '201901', '20190104_001', pa.Table.from_arrays([pa.array([1])], ['A']))
+    monthly_dataset.compact_month(s3, BUCKET, '201901')
+    put_extracted(s3, 'merged_by_month/year=2019/month=01/20190107_001.parquet')
+    # covers the packages of February uploaded so far
+    put_extracted(s3, '20190200_ALL.parquet')
+
+    result = find_orphans.reconcile(['201901', '201902'])
+    assert result['months'] == {'201901': {'raw': 5, 'examined': 5, 'missing': 1},
+                                '201902': {'raw': 2, 'examined': 2, 'missing': 0}}
+    assert result['missing'] == ['2019/01/20190108_001.tar.gz'] and result['queued'] == 1
+    assert queued(sqs) == ['2019/01/20190108_001.tar.gz']
+    assert find_orphans.read_ledger('201901')['pending'] == ['20190108_001']
+    assert find_orphans.read_ledger('201902')['pending'] == []
+
+    wait_next_second()
+    put_extracted(s3, 'merged/new_data/20190108_001.parquet')
+    put_raw(s3, '20190109_001')
+    # uploaded after the month file
+    put_raw(s3, '20190203_001')
+
+    result = find_orphans.reconcile(['201901', '201902'])
+    # the pending package and the one uploaded after the watermark
+    assert result['months'] == {'201901': {'raw': 6, 'examined': 2, 'missing': 1},
+                                '201902': {'raw': 3, 'examined': 1, 'missing': 1}}
+    assert result['missing'] == ['2019/01/20190109_001.tar.gz', '2019/02/20190203_001.tar.gz']
+    assert find_orphans.read_ledger('201901')['pending'] == ['20190109_001']
+
+    result = find_orphans.reconcile(['201901', '201902'], full=True, dry_run=True)
+    assert [month['examined'] for month in result['months'].values()] == [6, 3]
+    assert result['missing'] == ['2019/01/20190109_001.tar.gz', '2019/02/20190203_001.tar.gz']
+    assert result['queued'] == 0
+    # a dry run leaves the ledger alone
+    assert find_orphans.read_ledger('201901')['pending'] == ['20190109_001']
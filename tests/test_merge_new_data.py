@@ -0,0 +1,95 @@
+import io
+import json
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+import merge_new_data
+
+BUCKET = 'test-cca-ted-extracted-dev'
+
+
+@pytest.fixture
+def s3(s3, monkeypatch):
+    monkeypatch.setattr(merge_new_data, 's3', s3)
+    return s3
+
+
+def put_new_data(s3, package, values):
+    table = pa.Table.from_arrays([pa.array([package[:4]] * len(values)), pa.array([package[:8]] * len(values)),
+                                  pa.array(values)], names=['YEAR', 'DATE', 'VALUES__VALUE'])
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer)
+    s3.put_object(Bucket=BUCKET, Key=merge_new_data.NEW_DATA_PREFIX + package + '.parquet', Body=buffer.getvalue())
+
+
+def read(s3, key):
+    return pq.read_table(pa.BufferReader(s3.get_object(Bucket=BUCKET, Key=key)['Body'].read()))
+
+
+def keys(s3, prefix):
+    return sorted(object_['Key'] for object_ in s3.list_objects_v2(Bucket=BUCKET, Prefix=prefix).get('Contents', []))
+
+
+def test_new_days_are_appended_to_their_partition(s3):
+    put_new_data(s3, '20190102_001', ['1 234,50'])
+    put_new_data(s3, '20190201_001', ['10'])
+    result = merge_new_data.merge(BUCKET)
+    assert sorted(result['keys']) == ['merged_by_month/year=2019/month=01/20190102_001.parquet',
+                                      'merged_by_month/year=2019/month=02/20190201_001.parquet']
+
+    table = read(s3, 'merged_by_month/year=2019/month=01/20190102_001.parquet')
+    # the columns of the Glue table: lower case, typed, the year only in the partition
+    assert table.schema.names == ['date', 'values__value', 'parse_errors']
+    assert table.column(1).to_pylist() == [1234.5]
+    # merged/ is still crawled, the daily files stay there
+    assert len(keys(s3, merge_new_data.NEW_DATA_PREFIX)) == 2
+
+    put_new_data(s3, '20190103_001', ['20'])
+    assert merge_new_data.merge(BUCKET)['keys'] == ['merged_by_month/year=2019/month=01/20190103_001.parquet']
+    # the month isn't rewritten, the day is one more file
+    assert keys(s3, merge_new_data.month_prefix('201901')) == [
+        'merged_by_month/year=2019/month=01/20190102_001.parquet',
+        'merged_by_month/year=2019/month=01/20190103_001.parquet']
+    assert merge_new_data.merge(BUCKET)['files'] == 0
+
+
+def test_a_file_extracted_again_replaces_its_day(s3):
+    put_new_data(s3, '20190102_001', ['1'])
+    merge_new_data.merge(BUCKET)
+    put_new_data(s3, '20190102_001', ['1', '2'])
+    merge_new_data.merge(BUCKET, delete=True)
+    assert keys(s3, merge_new_data.TABLE_PREFIX) == ['merged_by_month/year=2019/month=01/20190102_001.parquet']
+    assert read(s3, 'merged_by_month/year=2019/month=01/20190102_001.parquet').num_rows == 2
+    assert keys(s3, merge_new_data.NEW_DATA_PREFIX) == []
+
+
+def test_a_typed_file_gets_the_lower_case_names(s3):
+    # written by the extraction since the numbers are typed: PARSE_ERRORS is there and nothing is converted
+    errors = pa.array([['DATE']], type=pa.list_(pa.string()))
+    table = pa.Table.from_arrays([pa.array(['2019']), pa.array([1.5]), errors],
+                                 names=['YEAR', 'VALUES__VALUE', 'PARSE_ERRORS'])
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer)
+    s3.put_object(Bucket=BUCKET, Key=merge_new_data.NEW_DATA_PREFIX + '20190102_001.parquet', Body=buffer.getvalue())
+    merge_new_data.merge(BUCKET)
+
+    table = read(s3, 'merged_by_month/year=2019/month=01/20190102_001.parquet')
+    assert table.schema.names == ['values__value', 'parse_errors']
+    assert table.column(0).to_pylist() == [1.5]
+    assert table.column(1).to_pylist() == [['DATE']]
+
+
+def test_the_days_written_by_glue_are_skipped(s3):
+    put_new_data(s3, '20190102_001', ['1'])
+    put_new_data(s3, '20190103_001', ['2'])
+    listed = s3.list_objects_v2(Bucket=BUCKET, Prefix=merge_new_data.NEW_DATA_PREFIX)['Contents']
+    # glue/partitioning.write_marker after a run of 2019 that read 20190102_001
+    s3.put_object(Bucket=BUCKET, Key=merge_new_data.MARKER_PREFIX + '2019.json',
+                  Body=json.dumps({'keys': {listed[0]['Key']: listed[0]['ETag']}}).encode())
+    assert merge_new_data.merge(BUCKET)['keys'] == ['merged_by_month/year=2019/month=01/20190103_001.parquet']
+
+    # extracted again after the Glue run
+    put_new_data(s3, '20190102_001', ['1', '3'])
+    assert merge_new_data.merge(BUCKET)['keys'] == ['merged_by_month/year=2019/month=01/20190102_001.parquet']
@@ -0,0 +1,38 @@
+import pyarrow as pa
+
+import monthly_dataset
+
+BUCKET = 'test-cca-ted-extracted-dev'
+
+
+def day(name):
+    return pa.Table.from_arrays([pa.array([name])], names=['FILE'])
+
+
+def test_read_month_while_compacting(s3, monkeypatch):
+    for name in ['20190102_001', '20190103_001']:
+        monthly_dataset.append_part(s3, BUCKET, '201901', name, day(name))
+    read_parquet = monthly_dataset._read_parquet
+    calls = []
+
+    def compact_first(s3_, bucket, key):
+        # the compaction commits and deletes the parts after the reader listed them
+        calls.append(key)
+        if len(calls) == 1:
+            monthly_dataset.compact_month(s3_, bucket, '201901')
+        return read_parquet(s3_, bucket, key)
+
+    monkeypatch.setattr(monthly_dataset, '_read_parquet', compact_first)
+    table = monthly_dataset.read_month(s3, BUCKET, '201901')
+    assert sorted(table.column('FILE').to_pylist()) == ['20190102_001', '20190103_001']
+
+
+def test_parts_are_filtered_with_the_manifest_read(s3):
+    monthly_dataset.append_part(s3, BUCKET, '201901', '20190102_001', day('20190102_001'))
+    manifest = monthly_dataset.read_manifest(s3, BUCKET, '201901')
+    monthly_dataset.compact_month(s3, BUCKET, '201901')
+    monthly_dataset.append_part(s3, BUCKET, '201901', '20190103_001', day('20190103_001'))
+    # with the manifest of before the compaction, the new part is listed and not the folded one, which is gone
+    assert [entry['name'] for entry in monthly_dataset.list_parts(s3, BUCKET, '201901', manifest=manifest)] == \
+        ['20190103_001']
+    assert len(monthly_dataset.data_keys(s3, BUCKET, '201901')) == 2
@@ -0,0 +1,35 @@
+import io
+import os
+import tarfile
+
+from conftest import FIXTURES
+import extract_xml_lambda
+import parallel_parse
+
+
+def package(copies):
+    # a daily package with the fixture notice under several file names, out of name order
+    source = os.path.join(FIXTURES, "20190102_001", "000001_2019.xml")
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+        for i in reversed(range(copies)):
+            tar.add(source, arcname="20190102_001/%06d_2019.xml" % i)
+    buffer.seek(0)
+    return buffer
+
+
+def parse(workers):
+    return parallel_parse.parse_archives([package(70), package(3)], extract_xml_lambda.OUTPUT_COLS,
+                                         extract_xml_lambda.LIST_COLS, doc_type_filter=None,
+                                         projection=extract_xml_lambda.PROJECTION,
+                                         row_hook=extract_xml_lambda.prepare_row,
+                                         header_fields=('DATE', 'YEAR', 'FILE'), workers=workers).finish()
+
+
+def test_workers_give_the_same_rows_in_file_order():
+    sequential = parse(1)
+    parallel = parse(3)
+    assert sequential.num_rows == 73
+    assert parallel.equals(sequential)
+    files = parallel.column('FILE').to_pylist()
+    assert files == sorted(files)
@@ -0,0 +1,127 @@
+import json
+import os
+import sqlite3
+
+import numpy as np
+import pytest
+
+import ann_index
+import recommendations
+
+
+class Clock(object):
+    now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def bucket():
+    return recommendations.LOOKUP_BUCKET
+
+
+@pytest.fixture
+def s3(s3, monkeypatch):
+    monkeypatch.setattr(recommendations, 's3', s3)
+    monkeypatch.setattr(recommendations, '_cache', {})
+    return s3
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(recommendations, 'time', clock)
+    return clock
+
+
+def head_calls(monkeypatch, client):
+    calls = []
+    head_object = client.head_object
+
+    def counted(**kwargs):
+        calls.append(kwargs['Key'])
+        return head_object(**kwargs)
+    monkeypatch.setattr(client, 'head_object', counted)
+    return calls
+
+
+def put_lookup(s3, tmp_path, rows):
+    path = str(tmp_path / 'recommendations.sqlite')
+    if os.path.exists(path):
+        os.remove(path)
+    connection = sqlite3.connect(path)
+    connection.execute('CREATE TABLE recommendations (contractor TEXT NOT NULL, service TEXT NOT NULL, rating REAL)')
+    connection.executemany('INSERT INTO recommendations VALUES (?, ?, ?)', rows)
+    connection.commit()
+    connection.close()
+    s3.upload_file(path, recommendations.LOOKUP_BUCKET, recommendations.LOOKUP_KEY)
+
+
+def factors(n=400, rank=8):
+    random = np.random.RandomState(2)
+    return {
+        'service_factors': random.randn(n // 4, rank).astype(np.float32),
+        'contractor_factors': random.randn(n, rank).astype(np.float32),
+        'service_labels': np.array(['s%d' % i for i in range(n // 4)]),
+        'contractor_labels': np.array(['c%d' % i for i in range(n)]),
+    }
+
+
+def test_k_is_between_1_and_max_results(monkeypatch):
+    indexes = ann_index.build_indexes(factors())
+    monkeypatch.setattr(recommendations, 'get_indexes', lambda: indexes)
+    assert fetch(similar_contractor='c1', k='0')[0] == 400
+    assert fetch(similar_contractor='c1', k='-3')[0] == 400
+    assert fetch(similar_contractor='c1', k='three')[0] == 400
+    status, body = fetch(similar_contractor='c1', k='1000')
+    assert status == 200 and len(body) == recommendations.MAX_RESULTS
+    status, body = fetch(similar_service='s1')
+    assert status == 200 and len(body) == recommendations.DEFAULT_SIMILAR
+
+
+def fetch(**parameters):
+    response = recommendations.fetch({'queryStringParameters': parameters}, None)
+    return response['statusCode'], json.loads(response['body'])
+
+
+def test_the_lookup_is_reloaded_when_its_etag_changes(s3, clock, tmp_path):
+    put_lookup(s3, tmp_path, [('c1', 's1', 0.5), ('c1', 's2', 0.9), ('c2', 's1', 0.1)])
+    assert fetch(contractor='c1') == (200, [{'rating': 0.9, 'contractor': 'c1', 'service': 's2'},
+                                            {'rating': 0.5, 'contractor': 'c1', 'service': 's1'}])
+    assert fetch(service='s1')[1][0]['contractor'] == 'c1'
+
+    put_lookup(s3, tmp_path, [('c1', 's3', 0.7)])
+    # the ETag is only checked every VERSION_CHECK_SECONDS
+    assert len(fetch(contractor='c1')[1]) == 2
+    clock.now += recommendations.VERSION_CHECK_SECONDS
+    assert fetch(contractor='c1')[1] == [{'rating': 0.7, 'contractor': 'c1', 'service': 's3'}]
+    # the downloaded file is removed once copied in memory
+    assert not os.path.exists(os.path.join('/tmp', os.path.basename(recommendations.LOOKUP_KEY)))
+
+
+def test_a_missing_lookup_is_checked_again_after_a_while(s3, clock, tmp_path, monkeypatch):
+    calls = head_calls(monkeypatch, s3)
+    assert recommendations.get_lookup() is None
+    assert recommendations.get_lookup() is None
+    assert calls == [recommendations.LOOKUP_KEY]
+    # the lookup and the Athena table have no row per contractor without the file
+    assert fetch(contractor='c1')[0] == 503
+
+    put_lookup(s3, tmp_path, [('c1', 's1', 0.5)])
+    clock.now += recommendations.VERSION_CHECK_SECONDS
+    assert fetch(contractor='c1')[1] == [{'rating': 0.5, 'contractor': 'c1', 'service': 's1'}]
+
+
+def test_the_indexes_are_built_from_the_factors_when_they_are_missing(s3, clock, tmp_path, monkeypatch):
+    path = str(tmp_path / 'factors.npz')
+    np.savez(path, **factors())
+    s3.upload_file(path, recommendations.LOOKUP_BUCKET, recommendations.FACTORS_KEY)
+    calls = head_calls(monkeypatch, s3)
+    status, body = fetch(similar_contractor='c1', k='3')
+    assert status == 200 and len(body) == 3
+    assert calls[:2] == [recommendations.INDEXES_KEY, recommendations.FACTORS_KEY]
+    checked = len(calls)
+    # neither the missing indexes nor the factors are looked up again for every request
+    fetch(similar_contractor='c1', k='3')
+    assert len(calls) == checked
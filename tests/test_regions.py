@@ -0,0 +1,31 @@
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import regions
+
+COLUMN = 'MAIN_n2016:PERFORMANCE_NUTS__CODE'
+
+
+def enriched(values):
+    table = pa.Table.from_arrays([pa.array(values), pa.array(['x'] * len(values))], names=[COLUMN, 'TITLE'])
+    buffer = pa.BufferOutputStream()
+    pq.write_table(table, buffer)
+    table = regions.enrich(pq.read_table(pa.BufferReader(buffer.getvalue())))
+    return {name: table.column(i).to_pylist() for i, name in enumerate(table.schema.names)}
+
+
+def test_greek_nuts_codes_are_in_greece():
+    columns = enriched(['EL303', 'FR101;FR102'])
+    assert columns['PERFORMANCE_NUTS__COUNTRY'] == ['GR', 'FR']
+    assert columns['PERFORMANCE_NUTS__NUTS1'] == ['EL3', 'FR1']
+    assert columns['PERFORMANCE_NUTS__NUTS2'] == ['EL30', 'FR10']
+    assert columns['PERFORMANCE_NUTS__NUTS3'] == ['EL303', 'FR101']
+    assert columns['TITLE'] == ['x', 'x']
+
+
+def test_levels_below_the_code_and_unknown_codes_are_null():
+    columns = enriched(['FR1', 'XX123', None])
+    assert columns['PERFORMANCE_NUTS__COUNTRY'] == ['FR', None, None]
+    assert columns['PERFORMANCE_NUTS__NUTS1'] == ['FR1', None, None]
+    assert columns['PERFORMANCE_NUTS__NUTS2'] == [None, None, None]
+    assert columns['PERFORMANCE_NUTS__NUTS3'] == [None, None, None]
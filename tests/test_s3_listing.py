@@ -0,0 +1,39 @@
+import pytest
+
+import s3_listing
+
+BUCKET = 'test-cca-ted-raw-dev'
+
+
+@pytest.fixture
+def bucket():
+    return BUCKET
+
+
+def keys(objects):
+    return [object_['Key'] for object_ in objects]
+
+
+def test_walk_lists_every_month_in_key_order(s3):
+    for key in ['2019/02/20190201_001.tar.gz', '2018/12/20181228_001.tar.gz', '2019/01/20190102_001.tar.gz',
+                '2019/readme.txt']:
+        s3.put_object(Bucket=BUCKET, Key=key, Body=b'x')
+    assert keys(s3_listing.walk(s3, BUCKET, concurrency=2)) == [
+        '2018/12/20181228_001.tar.gz', '2019/01/20190102_001.tar.gz', '2019/02/20190201_001.tar.gz',
+        '2019/readme.txt']
+
+
+def test_cached_listing_until_invalidated(s3):
+    cache = s3_listing.ListingCache()
+    s3.put_object(Bucket=BUCKET, Key='2019/01/20190102_001.tar.gz', Body=b'x')
+    assert keys(s3_listing.list_prefix(s3, BUCKET, '2019/01/', cache)) == ['2019/01/20190102_001.tar.gz']
+
+    key = '2019/01/20190103_001.tar.gz'
+    s3.put_object(Bucket=BUCKET, Key=key, Body=b'x')
+    assert len(s3_listing.list_prefix(s3, BUCKET, '2019/01/', cache)) == 1
+    cache.invalidate(BUCKET, key)
+    assert len(s3_listing.list_prefix(s3, BUCKET, '2019/01/', cache)) == 2
+
+
+def test_month_prefixes():
+    assert s3_listing.month_prefixes('201811', '201902') == ['2018/11/', '2018/12/', '2019/01/', '2019/02/']
@@ -0,0 +1,103 @@
+import json
+
+import boto3
+from moto import mock_aws
+import pytest
+
+import sqs_batch
+
+
+@pytest.fixture
+def sqs(monkeypatch):
+    monkeypatch.setattr(sqs_batch, 'BACKOFF_SECONDS', 0)
+    with mock_aws():
+        client = boto3.client('sqs', region_name='eu-west-3')
+        client.create_queue(QueueName='test_cca_ted_extractions_dev')
+        yield client
+
+
+def queue_url(sqs):
+    return sqs.get_queue_url(QueueName='test_cca_ted_extractions_dev')['QueueUrl']
+
+
+def receive_all(sqs):
+    bodies = []
+    while True:
+        messages = sqs.receive_message(QueueUrl=queue_url(sqs), MaxNumberOfMessages=10).get('Messages', [])
+        if not messages:
+            return bodies
+        for message in messages:
+            bodies.append(message['Body'])
+            sqs.delete_message(QueueUrl=queue_url(sqs), ReceiptHandle=message['ReceiptHandle'])
+
+
+class FailingClient(object):
+    # the moto client, with the first send_message_batch calls reporting some entries as failed
+    def __init__(self, sqs, failures):
+        self.sqs = sqs
+        self.failures = list(failures)
+        self.calls = []
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self.calls.append([entry['MessageBody'] for entry in Entries])
+        failed = self.failures.pop(0) if self.failures else {}
+        response = self.sqs.send_message_batch(
+            QueueUrl=QueueUrl, Entries=[entry for entry in Entries if entry['MessageBody'] not in failed])
+        response['Failed'] = [{'Id': entry['Id'], 'SenderFault': failed[entry['MessageBody']], 'Code': 'Test'}
+                              for entry in Entries if entry['MessageBody'] in failed]
+        return response
+
+
+def test_batches_of_ten_messages_and_256_kb():
+    assert [len(batch) for batch in sqs_batch._batches(str(i) for i in range(25))] == [10, 10, 5]
+    bodies = ['x' * (100 * 1024)] * 5
+    batches = list(sqs_batch._batches(bodies))
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+    assert all(sum(len(body) for body in batch) <= sqs_batch.MAX_BATCH_BYTES for batch in batches)
+
+
+def test_enqueue_sends_every_message(sqs):
+    result = sqs_batch.enqueue(queue_url(sqs), ({'key': str(i)} for i in range(23)), sqs=sqs, concurrency=2)
+    assert (result['messages'], result['batches'], result['sent'], result['failed']) == (23, 3, 23, [])
+    assert sorted(json.loads(body)['key'] for body in receive_all(sqs)) == sorted(str(i) for i in range(23))
+
+
+def test_failed_entries_are_retried(sqs):
+    client = FailingClient(sqs, [{'1': False, '2': False}, {'2': False}])
+    result = sqs_batch.enqueue(queue_url(sqs), ['0', '1', '2'], sqs=client)
+    assert client.calls == [['0', '1', '2'], ['1', '2'], ['2']]
+    assert (result['sent'], result['failed']) == (3, [])
+    assert sorted(receive_all(sqs)) == ['0', '1', '2']
+
+
+def test_sender_faults_are_not_retried(sqs):
+    client = FailingClient(sqs, [{'1': True}])
+    result = sqs_batch.enqueue(queue_url(sqs), ['0', '1', '2'], sqs=client)
+    assert client.calls == [['0', '1', '2']]
+    assert (result['sent'], result['failed']) == (2, ['1'])
+    assert sorted(receive_all(sqs)) == ['0', '2']
+
+
+def test_entries_still_failing_are_reported(sqs):
+    client = FailingClient(sqs, [{'1': False}] * 3)
+    result = sqs_batch.enqueue(queue_url(sqs), ['0', '1'], sqs=client, attempts=3)
+    assert len(client.calls) == 3
+    assert (result['sent'], result['failed']) == (1, ['1'])
+
+
+def test_dry_run_sends_nothing(sqs):
+    client = FailingClient(sqs, [])
+    result = sqs_batch.enqueue(queue_url(sqs), (str(i) for i in range(15)), sqs=client, dry_run=True)
+    assert (result['messages'], result['batches'], result['sent']) == (15, 2, 0)
+    assert client.calls == []
+    assert receive_all(sqs) == []
+
+
+def test_queue_extractions(sqs, monkeypatch):
+    monkeypatch.setenv('AWS_ACCOUNT_ID', '123456789012')
+    import lambda_download_file
+    monkeypatch.setattr(lambda_download_file, 'sqs', sqs)
+    result = lambda_download_file.queue_extractions(['2019/01/20190102_001.tar.gz', '2019/01/20190103_001.tar.gz'])
+    assert (result['sent'], result['batches']) == (2, 1)
+    assert sorted(json.loads(body)['key'] for body in receive_all(sqs)) == ['2019/01/20190102_001.tar.gz',
+                                                                            '2019/01/20190103_001.tar.gz']
@@ -0,0 +1,69 @@
+import io
+
+import boto3
+from moto import mock_aws
+import pytest
+
+import stream_upload
+
+BUCKET = 'test-cca-ted-raw-dev'
+PART_SIZE = 5 * 1024 * 1024
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    monkeypatch.setattr(stream_upload, 'BACKOFF_SECONDS', 0)
+    with mock_aws():
+        client = boto3.client('s3', region_name='eu-west-1')
+        client.create_bucket(Bucket=BUCKET, CreateBucketConfiguration={'LocationConstraint': 'eu-west-1'})
+        yield client
+
+
+class Source(object):
+    # an endless stream counting the bytes read
+    def __init__(self):
+        self.read_bytes = 0
+        self.closed = 0
+
+    def open(self, offset):
+        return self
+
+    def read(self, n):
+        self.read_bytes += n
+        return b'x' * n
+
+    def close(self):
+        self.closed += 1
+
+
+class FailingParts(object):
+    def __init__(self, s3):
+        self.s3 = s3
+
+    def __getattr__(self, name):
+        return getattr(self.s3, name)
+
+    def upload_part(self, **kwargs):
+        raise IOError('upload failed')
+
+
+def test_upload_stream_resumes_broken_reads(s3):
+    data = bytes(range(256)) * (PART_SIZE // 128 + 3)
+
+    def open_stream(offset):
+        # every connection breaks after 3 MB
+        return io.BytesIO(data[offset:offset + 3 * 1024 * 1024])
+
+    assert stream_upload.upload_stream(open_stream, s3, BUCKET, 'key', size=len(data), part_size=PART_SIZE) \
+        == len(data)
+    assert s3.get_object(Bucket=BUCKET, Key='key')['Body'].read() == data
+
+
+def test_aborted_upload_stops_the_reader(s3):
+    source = Source()
+    with pytest.raises(IOError):
+        stream_upload.upload_stream(source.open, FailingParts(s3), BUCKET, 'key', part_size=PART_SIZE, attempts=2)
+    # the reader read at most the parts in flight, and closed its connection
+    assert source.read_bytes <= (stream_upload.QUEUE_PARTS + 2) * PART_SIZE
+    assert source.closed
+    assert not s3.list_multipart_uploads(Bucket=BUCKET).get('Uploads')
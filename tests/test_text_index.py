@@ -0,0 +1,83 @@
+import io
+
+import numpy as np
+import pytest
+
+import text_index
+
+STOPWORDS = {'of', 'the', 'for'}
+NOTICES = [
+    ('2019/S 001-000001', 'Supply of road salt'),
+    ('2019/S 001-000002', 'Road maintenance and road markings'),
+    ('2019/S 002-000003', None),
+    ('2019/S 002-000004', 'Cleaning of the schools'),
+]
+MORE_NOTICES = [
+    ('2019/S 030-000005', 'Salt for the winter roads'),
+    ('2019/S 031-000006', 'Café catering for the schools'),
+]
+
+
+def build(notices):
+    return text_index.Segment.build([id_ for id_, text in notices], [text for id_, text in notices], STOPWORDS)
+
+
+def test_tokenize():
+    assert text_index.tokenize('Café-restaurant of the École', STOPWORDS) == ['cafe', 'restaurant', 'ecole']
+    assert text_index.tokenize(None) == []
+
+
+def test_postings_are_stored_as_gaps():
+    segment = build(NOTICES)
+    assert list(segment.lengths) == [3, 5, 0, 2]
+    start, end = segment._range('road')
+    # the first notice, then the gap to the previous one
+    assert list(segment.gaps[start:end]) == [0, 1]
+    notices, frequencies = segment.postings('road')
+    assert list(notices) == [0, 1] and list(frequencies) == [1, 2]
+    notices, frequencies = segment.postings('schools')
+    assert list(notices) == [3] and list(frequencies) == [1]
+    assert len(segment.postings('unknown')[0]) == 0
+    assert segment.document_frequency('road') == 2
+    # the stop words aren't indexed
+    assert segment.document_frequency('of') == 0
+
+
+def test_save_and_load():
+    segment = build(NOTICES)
+    f = io.BytesIO()
+    segment.save(f)
+    f.seek(0)
+    loaded = text_index.Segment.load(f)
+    for name in ['terms', 'offsets', 'gaps', 'frequencies', 'lengths']:
+        assert np.array_equal(getattr(loaded, name), getattr(segment, name))
+        assert getattr(loaded, name).dtype == getattr(segment, name).dtype
+    assert list(loaded.ids) == [id_ for id_, text in NOTICES]
+    assert loaded.stopwords == STOPWORDS
+
+
+def test_load_a_directory(tmpdir):
+    build(NOTICES).save(str(tmpdir.join('201901.npz')))
+    build(MORE_NOTICES).save(str(tmpdir.join('201902.npz')))
+    index = text_index.TextIndex.load([str(tmpdir)])
+    assert len(index.segments) == 2 and len(index) == 6
+
+
+def test_two_segments_rank_like_one_index():
+    index = text_index.TextIndex([build(NOTICES), build(MORE_NOTICES)])
+    single = text_index.TextIndex([build(NOTICES + MORE_NOTICES)])
+    for query in ['road salt', 'schools', 'the winter']:
+        hits = index.search(query)
+        expected = single.search(query)
+        assert [id_ for id_, score in hits] == [id_ for id_, score in expected]
+        assert [score for id_, score in hits] == pytest.approx([score for id_, score in expected])
+
+    # the document frequency and the average length are the ones of both months
+    documents, frequency, average_length = 6, 2, 16 / 6
+    idf = np.log(1 + (documents - frequency + 0.5) / (frequency + 0.5))
+    norm = text_index.K1 * (1 - text_index.B + text_index.B * 3 / average_length)
+    hits = index.search('winter salt', k=1)
+    assert hits[0][0] == '2019/S 030-000005'
+    assert hits[0][1] == pytest.approx(idf * (text_index.K1 + 1) / (1 + norm)
+                                       + np.log(1 + (documents - 1 + 0.5) / 1.5) * (text_index.K1 + 1) / (1 + norm))
+    assert index.search('of the') == []
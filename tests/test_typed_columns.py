@@ -0,0 +1,34 @@
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import typed_columns
+
+
+def test_ambiguous_separators_are_errors():
+    numbers, errors = typed_columns.parse_numbers(['12,000', '1.234,50', '1 234,50', '1,234.50', '12,5', '', None])
+    np.testing.assert_array_equal(numbers, [np.nan, np.nan, 1234.5, 1234.5, 12.5, np.nan, np.nan])
+    assert errors.tolist() == [True, True, False, False, False, False, False]
+
+
+def test_typed_columns_are_kept():
+    table = pa.Table.from_arrays([pa.array([1.5, None], type=pa.float64()), pa.array(['12,000', '3'])],
+                                 names=['VALUE_EUR', 'VALUES__VALUE'])
+    converted = typed_columns.convert_table(table)
+    assert converted.column(0).to_pylist() == [1.5, None]
+    assert converted.column(1).to_pylist() == [None, 3.0]
+    assert converted.column(2).to_pylist() == [['VALUES__VALUE'], []]
+
+
+def test_table_read_back_from_parquet():
+    table = pa.Table.from_arrays(
+        [pa.array(['20190102', None]), pa.array([['3', 'x'], None], type=pa.list_(pa.string())), pa.array(['a', 'b'])],
+        names=['DATE', 'AWARD_CONTRACT__AWARDED_CONTRACT__TENDERS__NB_TENDERS_RECEIVED', 'TITLE'])
+    buffer = pa.BufferOutputStream()
+    pq.write_table(table, buffer)
+    converted = typed_columns.convert_table(pq.read_table(pa.BufferReader(buffer.getvalue())))
+    assert converted.schema.names == table.schema.names + [typed_columns.ERROR_COLUMN]
+    assert converted.column(0).type == pa.date32()
+    assert converted.column(1).to_pylist() == [[3, None], None]
+    assert converted.column(2).to_pylist() == ['a', 'b']
+    assert converted.column(3).to_pylist() == [['AWARD_CONTRACT__AWARDED_CONTRACT__TENDERS__NB_TENDERS_RECEIVED'], []]
@@ -0,0 +1,28 @@
+import os
+import shutil
+
+from conftest import FIXTURES
+import extract_xml_lambda
+
+
+def parse(tmp_path, parser, **kwargs):
+    # both parsers delete the directories they read
+    data_dir = str(tmp_path / parser.__name__)
+    shutil.copytree(os.path.join(FIXTURES, "20190102_001"), os.path.join(data_dir, "20190102_001"))
+    return parser(data_dir, "EN", None, **kwargs).finish()
+
+
+def test_streaming_matches_extract_xml(tmp_path):
+    legacy = parse(tmp_path, extract_xml_lambda.parse_legacy)
+    streaming = parse(tmp_path, extract_xml_lambda.parse_streaming, projected=False, workers=1)
+    assert legacy.num_rows == 1
+    assert streaming.equals(legacy)
+    assert streaming.to_pydict() == legacy.to_pydict()
+
+
+def test_empty_ref_no_is_left_out(tmp_path):
+    # Table.to_pylist is missing from pyarrow 0.11
+    row = {name: values[0] for name, values in
+           parse(tmp_path, extract_xml_lambda.parse_streaming, workers=1).to_pydict().items()}
+    assert row['REF_NO'] == '2018/S 200-455555;2018/S 210-477777'
+    assert 'None' not in row['REF_NOTICE__NO_DOC_OJS']